@@ -0,0 +1,163 @@
+"""
+Converts many Cavatina .rtf/.txt files at once on a pool of worker
+processes, each of which imports music21 only once. Outputs are named as
+by rtf2xml.py and a JSON manifest records the result of every file.
+
+Usage:
+    $ python -m cavatina.batch [options] path|directory|pattern ...
+"""
+import glob
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+from .pipeline import Pipeline
+from .io.cache import ConversionCache
+from .rtf2xml import outputFilename
+
+inputExtensions = ('.rtf', '.txt')
+
+
+def findInputs(paths):
+    """
+    Input files of a list of files, directories (searched recursively for
+    .rtf and .txt files) and glob patterns, without duplicates.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                found.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                             if os.path.splitext(f)[1].lower() in inputExtensions)
+        elif os.path.isfile(path):
+            found.append(path)
+        else:
+            found.extend(p for p in sorted(glob.glob(path, recursive=True)) if os.path.isfile(p))
+
+    seen = set()
+    inputs = []
+    for path in found:
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            inputs.append(path)
+    return inputs
+
+
+def initWorker(backend):
+    if backend == 'music21':
+        from . import translator  # imports music21 once per worker
+
+
+def convertFile(job):
+    """
+    Converts one file in a worker. Errors are reported in the result instead
+    of being raised, so that one bad file does not stop the batch.
+    """
+    filepath, wrtpath, fmt, backend, processes = job
+    result = {
+        'input': filepath,
+        'output': wrtpath,
+        'bytes': os.path.getsize(filepath),
+        'ok': False
+    }
+    start = time.time()
+    try:
+        pipeline = Pipeline.fromFile(filepath, keepTree=False, processes=processes)
+        pipeline.writeStream(fmt, wrtpath, ConversionCache.fromEnvironment(), backend)
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+        if os.path.isfile(wrtpath):
+            os.remove(wrtpath)  # incomplete output
+    result['seconds'] = time.time() - start
+    return result
+
+
+def convertBatch(paths, fmt='musicxml', outdir=None, jobs=None, backend='music21', manifest=None, processes=1):
+    """
+    Converts the input files of *paths* (see findInputs), largest first.
+    outdir: output directory, by default next to each input file
+    jobs: number of worker processes, by default one per CPU, or 1 if
+          *processes* is given
+    manifest: path of the JSON manifest to write, if any
+    processes: worker processes translating each file in turn (see
+               translator.translateToMusic21); the workers of *jobs* cannot
+               start processes of their own, so this needs jobs=1
+    Returns the per-file results, in the order the files were found.
+    """
+    inputs = findInputs(paths)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # names are assigned up front: workers finishing in any order could take each other's
+    reserved = set()
+    jobList = []
+    for filepath in inputs:
+        wrtpath = outputFilename(filepath, fmt, outdir, reserved)
+        reserved.add(wrtpath)
+        jobList.append((filepath, wrtpath, fmt, backend, processes))
+    jobList.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+
+    jobs = jobs or (multiprocessing.cpu_count() if processes == 1 else 1)
+    if processes != 1 and jobs != 1:
+        raise ValueError("Files translated by several processes are converted one at a time (jobs=1)")
+    start = time.time()
+    if jobs == 1 or len(jobList) <= 1:
+        initWorker(backend)
+        results = [convertFile(job) for job in jobList]
+    else:
+        pool = multiprocessing.Pool(min(jobs, len(jobList)), initWorker, (backend,))
+        try:
+            results = list(pool.imap_unordered(convertFile, jobList))
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+
+    order = dict((filepath, i) for i, filepath in enumerate(inputs))
+    results.sort(key=lambda result: order[result['input']])
+
+    if manifest:
+        with open(manifest, 'wt') as f:
+            json.dump({
+                'format': fmt,
+                'backend': backend,
+                'jobs': jobs,
+                'processes': processes,
+                'seconds': elapsed,
+                'converted': sum(1 for r in results if r['ok']),
+                'failed': sum(1 for r in results if not r['ok']),
+                'files': results
+            }, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog='python -m cavatina.batch',
+                                     description='Convert Cavatina .rtf/.txt files in parallel.')
+    parser.add_argument('paths', nargs='+', help='input files, directories or glob patterns')
+    parser.add_argument('-f', '--format', default='musicxml', choices=['musicxml', 'midi'])
+    parser.add_argument('-o', '--outdir', help='output directory (default: next to each input)')
+    parser.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('-b', '--backend', default='music21', choices=['music21', 'native'])
+    parser.add_argument('-m', '--manifest', default='manifest.json', help='JSON manifest path')
+    parser.add_argument('-P', '--processes', type=int, default=1,
+                        help='processes translating each file, one file at a time (0: one per CPU)')
+    args = parser.parse_args()
+
+    results = convertBatch(args.paths, args.format, args.outdir, args.jobs, args.backend, args.manifest,
+                           args.processes or None)
+    for result in results:
+        if not result['ok']:
+            print("{}: {}".format(result['input'], result['error']))
+    failed = sum(1 for r in results if not r['ok'])
+    print("{} converted, {} failed".format(len(results) - failed, failed))
+    sys.exit(1 if failed else 0)
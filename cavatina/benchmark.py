@@ -0,0 +1,284 @@
+"""
+Benchmarks of the conversion stages on synthetic scores. Run as
+
+    python -m cavatina.benchmark [-s 100,1000,10000] [-p parts] [--rtf] [-o results.json] [-c previous.json]
+    python -m cavatina.benchmark --memory
+
+Every stage is timed at each size; the report gives the throughput in notes
+per second and the scaling exponent k of time ~ notes**k (1 is linear).
+Results saved with -o can be compared with a later run with -c.
+"""
+import gc
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from .keyboard_layout import keyLayouts, inputTranslate
+from .language.syntax import ParseState, getTextAndRTFBoldRegion, parse, parse_tokens, tokenize
+from .language.structures import Chord
+from .io.formats import findFormat, writeNative
+from .io.writeRTF import writeRTFshort
+
+notes = 'ZXCVBNMASDFGHJQWERTYU'  # quarter notes in ascending pitch order
+diacritics = ['-', '=', "'", '"']
+formats = ('musicxml', 'midi')
+defaultSizes = (100, 1000, 10000)
+
+
+def syntheticScore(measures=1000,
+                   parts=1,
+                   chordDensity=0.2,
+                   boldRatio=0.0,
+                   diacriticDensity=0.1,
+                   rtf=False,
+                   measuresPerLine=4,
+                   seed=0):
+    """
+    Cavatina text (or RTF document if *rtf*) of *measures* measures per part
+    of quarter notes and chords, in lines of *measuresPerLine* measures.
+
+    parts: number of staves per system, joined as in a grand staff
+    chordDensity: probability of a beat being a three-note chord
+    boldRatio: fraction of bold (sixteenth-based) measures, RTF only
+    diacriticDensity: probability of a note or chord having an accidental or
+                      an articulation
+    seed: the same arguments and seed always give the same music, whether
+          as text or RTF
+    """
+    rng = random.Random(seed)
+
+    def measure():
+        beats = []
+        for _ in range(4):
+            if rng.random() < chordDensity:
+                beat = ''.join(notes[i] for i in sorted(rng.sample(range(len(notes)), 3)))
+            else:
+                beat = rng.choice(notes)
+            if rng.random() < diacriticDensity:
+                beat += rng.choice(diacritics)
+            beats.append(beat)
+        return ' '.join(beats)
+
+    segments = []  # (text, isBold)
+    for start in range(0, measures, measuresPerLine):
+        count = min(measuresPerLine, measures - start)
+        for part in range(parts):
+            if segments:
+                segments.append(('\n', False))
+            prefix = ',' if not part else ',\\'
+            segments.append((prefix + ('+' if part % 2 == 0 else '_') + ' ', False))
+            for i in range(count):
+                if i:
+                    segments.append((', ', False))
+                isBold = rng.random() < boldRatio
+                segments.append((measure(), rtf and isBold))
+            segments.append((',\\' if parts > 1 and part == parts - 1 else ',', False))
+
+    if not rtf:
+        return ''.join(s for s, _ in segments)
+    return writeRTFshort([(c, isBold) for s, isBold in segments for c in s])
+
+
+def countNotes(tree):
+    return sum(len(s) for s in tree if isinstance(s, Chord))
+
+
+def music21Available():
+    try:
+        import music21
+    except ImportError:
+        return False
+    return True
+
+
+def timeStage(function, repeat=3):
+    """
+    Best wall time of *repeat* calls of *function*, and its last result.
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def stageTimes(content, layouts=None, repeat=3, backends=('native', 'music21')):
+    """
+    Returns (number of notes, {stage: seconds}) for one conversion of
+    *content*. Stages needing music21 are left out when it is not installed.
+    layouts: keyboard layouts to time inputTranslate with (default: all)
+    """
+    times = {}
+    times['getTextAndRTFBoldRegion'], (text, boldRegion) = timeStage(lambda: getTextAndRTFBoldRegion(content), repeat)
+
+    for layout in (layouts or sorted(keyLayouts)):
+        if layout == 'US':
+            continue
+        typed = inputTranslate(text, 'US', layout)
+        times['inputTranslate:' + layout] = timeStage(lambda: inputTranslate(typed, layout), repeat)[0]
+
+    times['tokenize'], tokens = timeStage(lambda: tokenize(text), repeat)
+    times['parse'], tree = timeStage(
+        lambda: list(parse_tokens(tokens, ParseState(), boldRegion, lambda: (tokens, text))), repeat)
+
+    directory = tempfile.mkdtemp()
+    try:
+        if 'native' in backends:
+            for fmt in formats:
+                wrtpath = os.path.join(directory, 'native' + findFormat(fmt)[1])
+                times['writeNative:' + fmt] = timeStage(lambda: writeNative(tree, fmt, wrtpath), repeat)[0]
+
+        if 'music21' in backends and music21Available():
+            from . import translator
+            times['translateToMusic21'], score = timeStage(lambda: translator.translateToMusic21(tree), repeat)
+            for fmt in formats:
+                wrtpath = os.path.join(directory, 'music21' + findFormat(fmt)[1])
+                times['writeStream:' + fmt] = timeStage(lambda: translator.writeStream(score, fmt, wrtpath), repeat)[0]
+    finally:
+        shutil.rmtree(directory)
+
+    return countNotes(tree), times
+
+
+def scalingExponent(points):
+    """
+    Least squares slope of log(seconds) over log(notes) of (notes, seconds)
+    points, or None if there are fewer than two usable points.
+    """
+    points = [(math.log(n), math.log(s)) for n, s in points if n > 0 and s > 0]
+    if len(set(x for x, _ in points)) < 2:
+        return None
+    mx = sum(x for x, _ in points) / len(points)
+    my = sum(y for _, y in points) / len(points)
+    return sum((x - mx) * (y - my) for x, y in points) / sum((x - mx) ** 2 for x, _ in points)
+
+
+def runBenchmark(sizes=defaultSizes, repeat=3, layouts=None, backends=('native', 'music21'), **options):
+    """
+    Times all stages on synthetic scores of each number of measures in
+    *sizes*. options: arguments of syntheticScore
+    Returns the results as a JSON-serializable dict.
+    """
+    results = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'music21': music21Available(),
+        'options': dict(options, repeat=repeat),
+        'sizes': [],
+        'stages': {}
+    }
+    for measures in sizes:
+        content = syntheticScore(measures, **options)
+        count, times = stageTimes(content, layouts, repeat, backends)
+        results['sizes'].append({'measures': measures, 'notes': count, 'characters': len(content), 'seconds': times})
+
+    for stage in results['sizes'][0]['seconds']:
+        points = [(size['notes'], size['seconds'][stage]) for size in results['sizes'] if stage in size['seconds']]
+        results['stages'][stage] = {
+            'notesPerSecond': [n / s if s else None for n, s in points],
+            'exponent': scalingExponent(points)
+        }
+    return results
+
+
+def compareResults(previous, current):
+    """
+    Yields (stage, measures, previous seconds, current seconds) of the stages
+    and sizes present in both results of runBenchmark.
+    """
+    before = dict((size['measures'], size['seconds']) for size in previous['sizes'])
+    for size in current['sizes']:
+        if size['measures'] not in before:
+            continue
+        for stage, seconds in sorted(size['seconds'].items()):
+            if stage in before[size['measures']]:
+                yield stage, size['measures'], before[size['measures']][stage], seconds
+
+
+def printResults(results):
+    sizes = results['sizes']
+    print("{:<28}".format('notes/s') + ''.join("{:>14}".format(size['notes']) for size in sizes) + "{:>10}".format('k'))
+    for stage, summary in sorted(results['stages'].items()):
+        exponent = summary['exponent']
+        print("{:<28}".format(stage) +
+              ''.join("{:>14.0f}".format(rate) if rate else "{:>14}".format('-') for rate in summary['notesPerSecond']) +
+              ("{:>10.2f}".format(exponent) if exponent is not None else "{:>10}".format('-')))
+
+
+def treeMemory(content):
+    """
+    Returns (bytes allocated by the parse tree of *content*, number of notes).
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tree = parse(content)
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return size, countNotes(tree)
+
+
+def memoryBenchmark(sizes=(1000, 10000, 50000)):
+    """
+    Yields (measures, notes, bytes per note) of the parse trees of synthetic
+    scores of each size.
+    """
+    for measures in sizes:
+        size, count = treeMemory(syntheticScore(measures))
+        yield measures, count, float(size) / count
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m cavatina.benchmark', description='Cavatina conversion benchmarks.')
+    parser.add_argument('-s', '--sizes', default=','.join(str(s) for s in defaultSizes),
+                        help='comma separated numbers of measures per part')
+    parser.add_argument('-p', '--parts', type=int, default=1)
+    parser.add_argument('--chords', type=float, default=0.2, help='chord density')
+    parser.add_argument('--bold', type=float, default=0.0, help='ratio of bold measures (RTF only)')
+    parser.add_argument('--diacritics', type=float, default=0.1, help='diacritic density')
+    parser.add_argument('--rtf', action='store_true', help='RTF documents instead of plain text')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per stage, the best one is kept')
+    parser.add_argument('-l', '--layouts', help='comma separated keyboard layouts (default: all)')
+    parser.add_argument('-b', '--backend', choices=['native', 'music21'], help='time one backend only')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('-c', '--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--memory', action='store_true', help='measure the memory of the parse trees instead')
+    args = parser.parse_args()
+
+    if args.memory:
+        print("{:>10} {:>10} {:>15}".format('measures', 'notes', 'bytes/note'))
+        for measures, count, bytesPerNote in memoryBenchmark():
+            print("{:>10} {:>10} {:>15.1f}".format(measures, count, bytesPerNote))
+    else:
+        results = runBenchmark([int(s) for s in args.sizes.split(',')],
+                               args.repeat,
+                               args.layouts.split(',') if args.layouts else None,
+                               (args.backend,) if args.backend else ('native', 'music21'),
+                               parts=args.parts,
+                               chordDensity=args.chords,
+                               boldRatio=args.bold,
+                               diacriticDensity=args.diacritics,
+                               rtf=args.rtf)
+        printResults(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                previous = json.load(f)
+            print("\n{:<28}{:>10}{:>14}{:>14}{:>10}".format('stage', 'measures', 'before (s)', 'after (s)', 'speedup'))
+            for stage, measures, before, after in compareResults(previous, results):
+                print("{:<28}{:>10}{:>14.4f}{:>14.4f}{:>10.2f}".format(stage, measures, before, after,
+                                                                          before / after if after else float('inf')))
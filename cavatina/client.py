@@ -0,0 +1,79 @@
+"""
+Command line client of the conversion server (see server.py), with the same
+arguments and output names as rtf2xml.py. If no server is running, the file
+is converted in this process instead.
+
+Usage:
+    $ python client.py [path] [format]
+"""
+import os
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+
+class ServerError(Exception):
+    """
+    The server rejected the conversion (status: HTTP status code).
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def convert(content, fmt='musicxml', address=None, timeout=600, **options):
+    """
+    Returns the bytes of *content* (Cavatina text or RTF) exported by the
+    server. Raises ServerError if the server rejects the request, and
+    URLError if no server is reachable.
+    options: layout, title, composer, tempo, instruments (a list), backend
+    """
+    if address is None:
+        from .server import serverAddress
+        address = serverAddress()
+    query = dict((k, ','.join(v) if isinstance(v, (list, tuple)) else v) for k, v in options.items() if v is not None)
+    query['format'] = fmt
+    url = 'http://{}:{}/convert?{}'.format(address[0], address[1], urlencode(query))
+    request = Request(url, content.encode('utf-8'), {'Content-Type': 'text/plain; charset=utf-8'})
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            return response.read()
+    except HTTPError as e:
+        raise ServerError(e.code, e.read().decode('utf-8', 'replace'))
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) >= 2:
+        # run as a script: make the cavatina package importable
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from cavatina.client import convert, ServerError
+        from cavatina.rtf2xml import outputFilename
+
+        filepath = sys.argv[1]
+        fmt = "musicxml"
+        if len(sys.argv) == 3:
+            if sys.argv[2] not in ["musicxml", "midi"]:
+                raise SyntaxError(sys.argv[2] + " is not a valid format.")
+            fmt = sys.argv[2]
+        wrtpath = outputFilename(filepath, fmt)
+
+        with open(filepath, "rt") as fin:
+            content = fin.read()
+        try:
+            data = convert(content, fmt)
+        except ServerError as e:
+            sys.exit(str(e))
+        except URLError:
+            # no server: convert here
+            from cavatina.pipeline import Pipeline
+            from cavatina.io.cache import ConversionCache
+            Pipeline(content, keepTree=False).writeStream(fmt, wrtpath, ConversionCache.fromEnvironment())
+        else:
+            with open(wrtpath, "wb") as fout:
+                fout.write(data)
+
+    else:
+        print("Usage:\n\t$ python client.py [path] [format]\nAvailable formats are 'musicxml' (default) and 'midi'.")
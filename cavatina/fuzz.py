@@ -0,0 +1,426 @@
+"""
+Differential fuzzing: random Cavatina documents go through the reference
+implementation of each stage and through every registered alternative, and
+any difference is shrunk to a minimal failing document.
+
+Checks (keys of *alternatives*):
+    tokens: token stacks, against syntax.tokenize_reference
+    tree: str() of the parsed structures, against syntax.parse_reference
+    notes: [(start, end, midi key)] of each part of the exported score, in
+           quarters and with tied notes merged, against translateToMusic21
+           (or, without music21 or with --native, the native MIDI writer against
+           the native MusicXML one)
+
+Every tokenizer of syntax.tokenizers is checked as well. An outcome is
+either the result or the name of the raised exception, so invalid documents
+have to fail the same way. A reference that crashes where an alternative
+does not is a failure as well, reported once per exception: translateToMusic21
+fails on some odd but valid documents (e.g. a lone dynamic) which the native
+writers accept.
+
+Usage:
+    $ python -m cavatina.fuzz [-n cases] [-s seed] [--native]
+"""
+import io
+import random
+import xml.etree.ElementTree as ET
+from fractions import Fraction
+
+from .language.syntax import parse, parse_iter, parse_reference, tokenize_reference, tokenizers
+from .language.symbols import note_range, rests
+from .language.semantics import accidentals, articulations, ornaments, dynamics
+from .language.document import Document
+from .io.writeMusicXML import MusicXMLWriter
+from .io.writeMIDI import MIDIWriter
+
+# -- generator
+
+modifiers = ['~', '~~', '<', '~<']
+diacritics = sorted(accidentals) + sorted(articulations) + ['>', 'L', '`', '.']
+restSymbols = rests + [']~', '}~', ']<', ']]', ']~~']
+markings = sorted(dynamics) + ['l', 'll', 'i', 'I', 'k', 'K', 'ki', 'KI', 'p', 'pp', 'O', 'O`']
+splitters = [' '] * 6 + ['/', '//']
+barlines = [','] * 12 + [',,', ';', ':', '.']
+headers = ['+', '_', '+_', '+--', '+=', '_---', '+=======', '+~44', '_~34', '+-~68', '+~128', '+~c', '_=~c~']
+alphabet = note_range + "~`-='\"<>[{]}.,;:/\\|lpoOkKiIP+_L? \n0123456789"
+
+
+def randomElement(rng):
+    """
+    One note, chord, rest or marking.
+    """
+    r = rng.random()
+    if r < 0.75:
+        element = ''.join(rng.choice(note_range) for _ in range(rng.choice((1, 1, 1, 2, 3))))
+        if rng.random() < 0.25:
+            element += rng.choice(modifiers)
+        for _ in range(rng.choice((0, 0, 0, 1, 2))):
+            element += rng.choice(diacritics)
+        if rng.random() < 0.1:
+            element += rng.choice(sorted(ornaments))
+        if len(element) > 1 and element[1] in note_range and rng.random() < 0.1:
+            element += 'P'  # arpeggio
+        return element
+    if r < 0.9:
+        return rng.choice(restSymbols)
+    return rng.choice(markings)
+
+
+def randomMeasure(rng):
+    measure = ''
+    for i in range(rng.randint(1, 5)):
+        if i:
+            measure += rng.choice(splitters)
+        measure += randomElement(rng)
+    return measure
+
+
+def randomStaff(rng, measures):
+    staff = rng.choice(headers) if rng.random() < 0.5 else ''
+    staff += rng.choice(barlines)
+    ending = False
+    for _ in range(measures):
+        if rng.random() < 0.1:
+            staff += rng.choice(['o', 'oo']) + ' '
+            ending = True
+        staff += ' ' + randomMeasure(rng)
+        if ending and rng.random() < 0.5:
+            staff += ' o`'
+            ending = False
+        staff += rng.choice(barlines)
+    return staff
+
+
+def randomDocument(rng, lines=3, measures=3, noise=0.02):
+    """
+    Random Cavatina text (US layout) of up to *lines* lines, or grand staff
+    systems, of up to *measures* measures, mostly valid.
+    noise: probability of replacing each character by an arbitrary symbol
+    """
+    systems = []
+    for _ in range(rng.randint(1, lines)):
+        parts = rng.choice((1, 1, 1, 2, 3))
+        count = rng.randint(1, measures)
+        staves = [randomStaff(rng, count) for _ in range(parts)]
+        if parts > 1:
+            staves = [staves[0]] + [',\\' + s.lstrip(',') for s in staves[1:]]
+            staves[-1] += '\\'
+        systems.append('\n'.join(staves))
+    document = '\n'.join(systems)
+    if noise:
+        document = ''.join(rng.choice(alphabet) if rng.random() < noise else c for c in document)
+    return document
+
+
+# -- outcomes
+
+
+def referenceTree(text):
+    return [str(s) for s in parse_reference(text, 'US')]
+
+
+def referenceNotes(text):
+    """
+    Notes of each part of the music21 score of *text*.
+    """
+    from .translator import translateToMusic21
+
+    parts = []
+    for part in translateToMusic21(parse_reference(text, 'US')).parts:
+        notes = []
+        for n in part.recurse().notes:
+            start = Fraction(n.getOffsetInHierarchy(part))
+            for m in (n.notes if n.isChord else [n]):  # ties are per note
+                tieStart = m.tie is not None and m.tie.type in ('start', 'continue')
+                notes.append((start, start + Fraction(n.quarterLength), m.pitch.midi, tieStart,
+                              (m.pitch.step, m.pitch.alter, m.pitch.octave)))
+        parts.append(mergeTies(notes))
+    return parts
+
+
+def mergeTies(notes):
+    """
+    Sorted [(start, end, key)] of [(start, end, key, tie start, pitch)]
+    notes: a tie start extends the note into the note of the same pitch
+    (step, alter, octave) at the next onset, if there is one (music21 does
+    not mark it as a tie stop). Overlapping notes of the same key are paired
+    as in a MIDI file (see pairUnisons).
+    """
+    merged, tied, ties, onset = [], {}, {}, None
+    for start, end, key, tieStart, pitch in sorted(notes, key=lambda n: n[0]):
+        if start != onset:
+            tied, ties, onset = ties, {}, start  # ties started at the previous onset
+        if pitch in tied:
+            note = tied.pop(pitch)
+            note[1] = end
+        else:
+            note = [start, end, key]
+            merged.append(note)
+        if tieStart:
+            ties[pitch] = note
+    return pairUnisons(merged)
+
+
+def pairUnisons(notes):
+    """
+    Sorted [(start, end, key)] pairing the sorted starts and ends of each key,
+    the only pairing of overlapping unisons a MIDI file can tell apart.
+    """
+    starts, ends = {}, {}
+    for start, end, key in notes:
+        starts.setdefault(key, []).append(start)
+        ends.setdefault(key, []).append(end)
+    return sorted((start, end, key) for key in starts for start, end in zip(sorted(starts[key]), sorted(ends[key])))
+
+
+steps = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+
+def musicXMLNotes(data):
+    """
+    Notes of each part of a MusicXML document.
+    """
+    parts = []
+    for part in ET.fromstring(data).findall('part'):
+        divisions, measureStart, notes = 1, 0, []
+        for measure in part.findall('measure'):
+            position = end = onset = 0
+            for e in measure:
+                if e.tag == 'attributes' and e.find('divisions') is not None:
+                    divisions = int(e.findtext('divisions'))
+                elif e.tag in ('backup', 'forward'):
+                    length = Fraction(int(e.findtext('duration')), divisions)
+                    position += length if e.tag == 'forward' else -length
+                elif e.tag == 'note':
+                    length = Fraction(int(e.findtext('duration', '0')), divisions)
+                    if e.find('chord') is None:
+                        onset = position
+                        position += length
+                    end = max(end, position)
+                    if e.find('rest') is not None:
+                        continue
+                    pitch = (e.findtext('pitch/step'), float(e.findtext('pitch/alter', '0')),
+                             int(e.findtext('pitch/octave')))
+                    key = 12 * (pitch[2] + 1) + steps[pitch[0]] + int(pitch[1])
+                    tieStart = any(t.get('type') == 'start' for t in e.findall('tie'))
+                    notes.append((measureStart + onset, measureStart + onset + length, key, tieStart, pitch))
+                end = max(end, position)
+            measureStart += end
+        parts.append(mergeTies(notes))
+    return parts
+
+
+def readVariable(data, i):
+    value = 0
+    while True:
+        value = (value << 7) | (data[i] & 0x7F)
+        i += 1
+        if not data[i - 1] & 0x80:
+            return value, i
+
+
+def midiNotes(data):
+    """
+    Notes of each track of a Standard MIDI File but the first (tempo) one.
+    """
+    quarter = int.from_bytes(data[12:14], 'big')
+    tracks = []
+    pos = 8 + int.from_bytes(data[4:8], 'big')
+    while pos < len(data):
+        length = int.from_bytes(data[pos + 4:pos + 8], 'big')
+        track = data[pos + 8:pos + 8 + length]
+        pos += 8 + length
+        i, tick, status, sounding, notes = 0, 0, 0, {}, []
+        while i < len(track):
+            delta, i = readVariable(track, i)
+            tick += delta
+            if track[i] & 0x80:
+                status = track[i]
+                i += 1
+            if status == 0xFF:
+                length, i = readVariable(track, i + 1)
+                i += length
+            elif status in (0xF0, 0xF7):
+                length, i = readVariable(track, i)
+                i += length
+            elif status & 0xF0 in (0xC0, 0xD0):
+                i += 1
+            else:
+                kind, key, velocity = status & 0xF0, track[i], track[i + 1]
+                i += 2
+                if kind == 0x90 and velocity:
+                    sounding.setdefault(key, []).append(tick)
+                elif kind in (0x80, 0x90) and sounding.get(key):  # unisons end in the order they started
+                    notes.append((Fraction(sounding[key].pop(0), quarter), Fraction(tick, quarter), key))
+        tracks.append(sorted(notes))
+    return tracks[1:]
+
+
+def nativeNotes(writer, read):
+    def notes(text):
+        f = io.BytesIO()
+        writer(f).write(list(parse_iter(text, 'US')))
+        return read(f.getvalue())
+    return notes
+
+
+alternatives = {  # check : {name : function(text) -> result to compare with the reference}
+    'tokens': {},
+    'tree': {
+        'parse': lambda text: [str(s) for s in parse(text, 'US')],
+        'parse_iter': lambda text: [str(s) for s in parse_iter(text, 'US')],
+        'document': lambda text: [str(s) for s in Document(text, 'US').tree()]
+    },
+    'notes': {
+        'musicxml': nativeNotes(lambda f: MusicXMLWriter(io.TextIOWrapper(f, 'utf-8', write_through=True)),
+                                musicXMLNotes),
+        'midi': nativeNotes(MIDIWriter, midiNotes)
+    }
+}
+
+
+def music21Available():
+    try:
+        import music21
+    except ImportError:
+        return False
+    return True
+
+
+def registered(names=None, music21=None):
+    """
+    {check: (reference, {name: alternative})} of the checks in *names*
+    (default: all).
+    music21: whether translateToMusic21 is the reference of the notes check,
+             by default if music21 is installed; otherwise the native
+             writers are only compared with each other
+    """
+    checks = {
+        'tokens': (tokenize_reference, dict(alternatives['tokens'])),
+        'tree': (referenceTree, dict(alternatives['tree']))
+    }
+    for engine in tokenizers:
+        if engine != 'reference':
+            checks['tokens'][1]['tokenizer:' + engine] = lambda text, engine=engine: list(tokenizers[engine](text))
+            checks['tree'][1]['tokenizer:' + engine] = \
+                lambda text, engine=engine: [str(s) for s in parse_iter(text, 'US', engine)]
+
+    notes = dict(alternatives['notes'])
+    if music21 or (music21 is None and music21Available()):
+        checks['notes'] = (referenceNotes, notes)
+    else:
+        checks['notes'] = (notes.pop('musicxml'), notes)
+    return dict((name, checks[name]) for name in (names or checks))
+
+
+def outcome(function, text):
+    try:
+        return function(text)
+    except Exception as e:
+        return type(e).__name__
+
+
+def differences(text, checks=None):
+    """
+    Yields (check, alternative name, reference outcome, alternative outcome)
+    of every alternative that disagrees with the reference on *text*.
+    checks: as returned by registered(), by default all checks
+    """
+    for check, (reference, others) in sorted((checks or registered()).items()):
+        expected = outcome(reference, text)
+        for name, function in sorted(others.items()):
+            got = outcome(function, text)
+            if got != expected:
+                yield check, name, expected, got
+
+
+def crash(expected, got):
+    """
+    Name of the exception raised by the reference where the alternative
+    succeeded, or None.
+    """
+    return expected if isinstance(expected, str) and not isinstance(got, str) else None
+
+
+# -- shrinking
+
+
+def splitLines(text):
+    return text.splitlines(True)
+
+
+def splitTokens(text):
+    try:
+        return tokenize_reference(text)
+    except Exception:
+        return list(text)
+
+
+def shrink(text, failing):
+    """
+    Shortest text found by removing lines, tokens and then characters of
+    *text* while failing(text) holds.
+    """
+    changed = True
+    while changed:
+        changed = False
+        for split in (splitLines, splitTokens, list):
+            units = split(text)
+            size = len(units) // 2
+            while size:
+                i = 0
+                while i < len(units):
+                    candidate = units[:i] + units[i + size:]
+                    if candidate and failing(''.join(candidate)):
+                        units = candidate
+                        changed = True
+                    else:
+                        i += size
+                size //= 2
+            text = ''.join(units)
+    return text
+
+
+def fuzz(cases=1000, seed=0, checks=None, **options):
+    """
+    Checks *cases* random documents. Returns a list of failures, one per
+    disagreeing check and alternative, and per exception of a reference
+    crashing where the alternative does not (see crash). Each is a dict with
+    the minimal document and both outcomes on it.
+    options: arguments of randomDocument
+    """
+    checks = checks or registered()
+    rng = random.Random(seed)
+    failures = {}
+    for case in range(cases):
+        text = randomDocument(rng, **options)
+        for check, name, expected, got in differences(text, checks):
+            key = (check, name, crash(expected, got))
+            if key in failures:
+                continue
+            single = {check: (checks[check][0], {name: checks[check][1][name]})}
+            same = lambda t: [d[2:] for d in differences(t, single) if crash(*d[2:]) == key[2]]
+            minimal = shrink(text, same)
+            expected, got = same(minimal)[0]
+            failures[key] = {'check': check, 'alternative': name, 'crash': key[2], 'case': case, 'document': text,
+                             'minimal': minimal, 'expected': expected, 'got': got}
+    return [failures[key] for key in sorted(failures, key=lambda key: key[:2] + (key[2] or '',))]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m cavatina.fuzz',
+                                     description='Compare the alternative implementations with the reference ones.')
+    parser.add_argument('-n', '--cases', type=int, default=1000)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('--noise', type=float, default=0.02, help='probability of an arbitrary symbol')
+    parser.add_argument('--native', action='store_true', help='compare the native writers with each other only')
+    args = parser.parse_args()
+
+    found = fuzz(args.cases, args.seed, registered(music21=False if args.native else None), noise=args.noise)
+    for failure in found:
+        print("{check} / {alternative} (case {case}): {minimal!r}\n  reference:   {expected!r}\n"
+              "  alternative: {got!r}".format(**failure))
+    print("{} cases, {} failures ({} reference crashes)".format(
+        args.cases, len(found), sum(1 for failure in found if failure['crash'])))
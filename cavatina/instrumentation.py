@@ -0,0 +1,188 @@
+"""
+Timings and counts of the conversion stages. Nothing is recorded, and the
+hooks cost about one attribute lookup each, until a listener is added:
+
+    from cavatina import instrumentation
+    instrumentation.addListener(print)  # called with one record per conversion
+
+or, for the conversions of a block only:
+
+    with instrumentation.Recorder() as records:
+        Pipeline(content).writeStream('musicxml')
+
+A record is a dict:
+    conversion: name of the outermost instrumented call (parse, translate,
+                writeStream, pipeline, writeNative), plus any annotations
+                (e.g. format, backend, cache)
+    wall, cpu: seconds of the whole conversion
+    stages: {name: {'wall': seconds, 'cpu': seconds, 'calls': n}} of
+            rtf, layout, tokenize, parse, translate (which includes
+            repeats), metadata and export
+    counts: {name: n} of tokens, chords, notes, rests, repeat endings,
+            parts and measures
+    error: name of the exception that ended the conversion, or None
+
+Instrumented calls made during a conversion (e.g. the parse of a Pipeline)
+add to its record instead of emitting their own.
+"""
+import functools
+import threading
+import time
+
+from .language.structures import Chord, Rest, RepeatSectionStart
+
+listeners = []  # callables receiving each record
+local = threading.local()  # record of the conversion running on this thread
+
+
+def addListener(listener):
+    listeners.append(listener)
+
+
+def removeListener(listener):
+    listeners.remove(listener)
+
+
+def enabled():
+    """
+    True inside a recorded conversion.
+    """
+    return getattr(local, 'record', None) is not None
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+nullStage = NullStage()
+
+
+class Stage(object):
+    __slots__ = ('timings', 'wall', 'cpu')
+
+    def __init__(self, timings):
+        self.timings = timings
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings['wall'] += time.perf_counter() - self.wall
+        self.timings['cpu'] += time.process_time() - self.cpu
+        self.timings['calls'] += 1
+        return False
+
+
+def stage(name):
+    """
+    Context manager adding the time of its block to the stage *name*.
+    """
+    record = getattr(local, 'record', None)
+    if record is None:
+        return nullStage
+    timings = record['stages'].get(name)
+    if timings is None:
+        timings = record['stages'][name] = {'wall': 0.0, 'cpu': 0.0, 'calls': 0}
+    return Stage(timings)
+
+
+def count(name, n=1):
+    record = getattr(local, 'record', None)
+    if record is not None:
+        record['counts'][name] = record['counts'].get(name, 0) + n
+
+
+def annotate(**info):
+    """
+    Adds *info* to the record of the running conversion.
+    """
+    record = getattr(local, 'record', None)
+    if record is not None:
+        record.update(info)
+
+
+def countTree(tree, tokens=None):
+    """
+    Counts the tokens and structures of a parse.
+    """
+    if getattr(local, 'record', None) is None:
+        return
+    if tokens is not None:
+        count('tokens', len(tokens))
+    for structure in tree:
+        if isinstance(structure, Chord):
+            count('chords')
+            count('notes', len(structure))
+        elif isinstance(structure, Rest):
+            count('rests')
+        elif isinstance(structure, RepeatSectionStart):
+            count('repeat endings')
+
+
+class Conversion(object):
+    """
+    Records the block as one conversion if there are listeners and no
+    conversion is running on this thread yet.
+    """
+
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+        self.record = None
+
+    def __enter__(self):
+        if listeners and getattr(local, 'record', None) is None:
+            self.record = dict(self.info, conversion=self.name, stages={}, counts={}, error=None)
+            local.record = self.record
+            self.wall = time.perf_counter()
+            self.cpu = time.process_time()
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record = self.record
+        if record is not None:
+            local.record = None
+            record['wall'] = time.perf_counter() - self.wall
+            record['cpu'] = time.process_time() - self.cpu
+            if exc_type is not None:
+                record['error'] = exc_type.__name__
+            for listener in list(listeners):
+                listener(record)
+        return False
+
+
+def instrumented(name, stageName=None):
+    """
+    Decorator recording each call as a conversion *name* (see Conversion),
+    timed as the stage *stageName* if given.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not listeners:
+                return function(*args, **kwargs)
+            with Conversion(name), stage(stageName) if stageName else nullStage:
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Recorder(object):
+    """
+    Collects the records of the conversions run in a with block.
+    """
+
+    def __enter__(self):
+        self.records = []
+        addListener(self.records.append)
+        return self.records
+
+    def __exit__(self, *exc):
+        removeListener(self.records.append)
+        return False
@@ -0,0 +1,200 @@
+import os
+import hashlib
+import tempfile
+
+from .._version import __version__
+from ..language.syntax import getTextAndRTFBoldRegion, tokenizers, default_tokenizer
+from ..keyboard_layout import inputTranslate, getLayout
+
+cacheDirVariable = 'CAVATINA_CACHE_DIR'
+cacheSizeVariable = 'CAVATINA_CACHE_SIZE'  # in megabytes
+defaultMaxBytes = 512 * 1024 * 1024
+evictionTarget = 0.9  # fraction of maxBytes left after an eviction
+
+
+def tokenDigest(content, inputLanguage=None):
+    """
+    Hash of the normalized token stream of a Cavatina text or RTF document:
+    the tokens in US layout and, per token, whether it is bold. RTF formatting
+    other than bold weight does not change the digest.
+    """
+    rawText, boldRegion = getTextAndRTFBoldRegion(content)
+    usText = inputTranslate(rawText, langFrom=inputLanguage)
+    return digestTokens(tokenizers[default_tokenizer](usText), boldRegion)
+
+
+def digestTokens(tokens, boldRegion):
+    """
+    tokenDigest of an already tokenized document.
+    """
+    digest = hashlib.sha256()
+    pos = 0
+    for token in tokens:
+        data = token.encode('utf-8')
+        digest.update(b'%d%s%s' % (len(data), b'b' if pos in boldRegion else b':', data))
+        pos += len(token)
+    return digest.hexdigest()
+
+
+class ConversionCache(object):
+    """
+    Content-addressed store of exported files (MusicXML, MIDI, ...) on disk.
+    Entries are written atomically, so several processes can share a
+    directory, and the least recently used entries are evicted once the
+    directory grows beyond *maxBytes*. The directory is only scanned when
+    the size known to this instance, i.e. the size at the last scan plus
+    what it wrote since, exceeds *maxBytes*; eviction then goes down to
+    evictionTarget of it, so that a full cache is not scanned on every put.
+    """
+
+    def __init__(self, directory, maxBytes=defaultMaxBytes):
+        self.directory = os.path.abspath(directory)
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.size = None  # estimated directory size, None before the first scan
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @classmethod
+    def fromEnvironment(cls):
+        """
+        The cache configured by $CAVATINA_CACHE_DIR (and $CAVATINA_CACHE_SIZE in
+        megabytes), or None if caching is not enabled.
+        """
+        directory = os.environ.get(cacheDirVariable)
+        if not directory:
+            return None
+        size = os.environ.get(cacheSizeVariable)
+        return cls(directory, int(float(size) * 1024 * 1024) if size else defaultMaxBytes)
+
+    def key(self, content, outputFormat, inputLanguage=None, **options):
+        """
+        options: any further settings that change the output, e.g. the
+                 metadata arguments of translator.writeStream
+        """
+        inputLanguage = inputLanguage or getLayout()
+        return self.digestKey(tokenDigest(content, inputLanguage), outputFormat, inputLanguage, **options)
+
+    def digestKey(self, documentDigest, outputFormat, inputLanguage, **options):
+        """
+        Same as key, for a document whose tokenDigest is already known.
+        """
+        digest = hashlib.sha256()
+        digest.update(documentDigest.encode('ascii'))
+        digest.update(repr((__version__, outputFormat, inputLanguage, sorted(options.items()))).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns the cached bytes or None.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)  # mark as recently used
+        except OSError:
+            pass  # evicted by another process in the meantime
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        subdir = os.path.dirname(self.path(key))
+        if not os.path.isdir(subdir):
+            try:
+                os.makedirs(subdir)
+            except OSError:
+                pass  # created by another process
+        fd, tmppath = tempfile.mkstemp(dir=subdir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmppath, self.path(key))
+        except BaseException:
+            os.remove(tmppath)
+            raise
+        self.writes += 1
+        if self.size is not None:
+            self.size += len(data)
+        if self.size is None or self.size > self.maxBytes:
+            self.evict()
+
+    def fetch(self, key, wrtpath):
+        """
+        Writes the cached output to *wrtpath*. Returns False on a miss.
+        """
+        data = self.get(key)
+        if data is None:
+            return False
+        with open(wrtpath, 'wb') as f:
+            f.write(data)
+        return True
+
+    def store(self, key, wrtpath):
+        with open(wrtpath, 'rb') as f:
+            self.put(key, f.read())
+
+    def entries(self):
+        for subdir in os.listdir(self.directory):
+            subpath = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subpath):
+                continue
+            for name in os.listdir(subpath):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(subpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def evict(self):
+        entries = list(self.entries())
+        total = sum(size for mtime, size, path in entries)
+        if total > self.maxBytes:
+            for mtime, size, path in sorted(entries):
+                if total <= self.maxBytes * evictionTarget:
+                    break
+                try:
+                    os.remove(path)
+                    self.evictions += 1
+                except OSError:
+                    pass  # already evicted by another process
+                total -= size
+        self.size = total
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'evictions': self.evictions
+        }
+
+
+def convertCached(cache, content, outputFormat, wrtpath, convert, inputLanguage=None, **options):
+    """
+    Writes the conversion of *content* to *wrtpath*, from the cache if possible.
+    convert: callable that writes the output file to *wrtpath* on a cache miss
+    Returns True on a cache hit.
+    """
+    if cache is None:
+        convert()
+        return False
+    key = cache.key(content, outputFormat, inputLanguage, **options)
+    if cache.fetch(key, wrtpath):
+        return True
+    convert()
+    cache.store(key, wrtpath)
+    return False
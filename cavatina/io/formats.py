@@ -0,0 +1,64 @@
+"""
+Output formats and the native (music21-free) writers. Nothing here imports
+music21 unless a format unknown to this module has to be looked up.
+"""
+import os
+
+from .writeMusicXML import writeMusicXML
+from .writeMIDI import writeMIDI
+from ..instrumentation import instrumented, annotate
+
+formatAliases = {  # as music21.common.findFormat
+    'musicxml': ('musicxml', '.musicxml'),
+    'xml': ('musicxml', '.musicxml'),
+    'mx': ('musicxml', '.musicxml'),
+    'midi': ('midi', '.mid'),
+    'mid': ('midi', '.mid'),
+    'lilypond': ('lilypond', '.ly'),
+    'lily': ('lilypond', '.ly'),
+    'text': ('text', '.txt'),
+    'txt': ('text', '.txt')
+}
+
+nativeWriters = {  # format : function(tree, wrtpath, **metadata) of the native backend
+    'musicxml': writeMusicXML,
+    'midi': writeMIDI
+}
+
+
+def findFormat(format):
+    """
+    (format, file extension) of a format name, e.g. ('midi', '.mid') for 'mid'
+    """
+    try:
+        return formatAliases[format.lower().lstrip('.')]
+    except KeyError:
+        from music21.common import findFormat as m21findFormat
+        return m21findFormat(format)
+
+
+def outputPath(format, wrtpath=None):
+    """
+    The file path translator.writeStream writes to (see translator.writeStream).
+    """
+    fmt, ext = findFormat(format)
+
+    if not wrtpath:
+        wrtpath = os.path.join(os.getcwd(), 'untitled' + ext)
+    if os.path.isdir(wrtpath):
+        wrtpath = os.path.join(wrtpath, 'untitled' + ext)
+    return wrtpath
+
+
+@instrumented('writeNative', 'export')
+def writeNative(tree, format, wrtpath, **metadata):
+    """
+    Writes the structures of *tree* with the native writer of *format*.
+    metadata: scoreTitle, scoreComposer, scoreTempo, scoreInstruments,
+              preserveStemDirection
+    """
+    fmt = findFormat(format)[0]
+    if fmt not in nativeWriters:
+        raise ValueError("The native backend cannot write the format '{}'".format(format))
+    annotate(format=fmt, backend='native')
+    nativeWriters[fmt](tree, wrtpath, **metadata)
@@ -0,0 +1,168 @@
+import re
+
+cavatinaFontName = 'Cavatina'
+
+# One alternative per RTF token kind. Text runs are matched in bulk so the
+# lexer does not loop in Python for every plain character.
+rtfToken = re.compile(r"""
+    (?P<control>\\(?P<word>[a-zA-Z]+)(?P<param>-?\d+)?[ ]?)  # e.g. \b0 \f1 \par
+  | \\'(?P<hex>[0-9a-fA-F]{2})                  # 8-bit escape, e.g. \'f6
+  | \\(?P<symbol>[^a-zA-Z'])                    # control symbol, e.g. \\ \{ \<newline>
+  | (?P<group>[{}])
+  | (?P<text>[^\\{}\r\n]+)
+  | [\r\n]+                                     # raw line breaks carry no meaning
+""", re.X | re.S)
+
+# Groups whose content is not part of the document text.
+ignoredDestinations = frozenset([
+    'colortbl', 'expandedcolortbl', 'stylesheet', 'info', 'pict', 'object',
+    'header', 'footer', 'headerl', 'headerr', 'footerl', 'footerr',
+    'listtable', 'listoverridetable', 'revtbl', 'rsidtbl', 'generator',
+    'filetbl', 'themedata', 'colorschememapping', 'latentstyles',
+    'datastore', 'xmlnstbl', 'fldinst'
+])
+
+paragraphWords = frozenset(['par', 'line', 'sect', 'page'])
+escapedSymbols = {'\\': '\\', '{': '{', '}': '}', '\n': '\n', '\r': '\n', '~': ' '}
+
+
+def isRTF(s):
+    return s.lstrip()[:5] == '{\\rtf'
+
+
+def lexRTF(rtf):
+    """
+    Single pass over a RTF document. Returns a tuple (text, boldRanges) where
+    text is the content written with the Cavatina font and boldRanges is a
+    sorted list of disjoint (start, end) index pairs over text.
+    """
+    out = []  # text chunks, joined once at the end
+    boldRanges = []
+    pos = 0
+
+    codepage = 'cp1252'
+    fonts = {}  # font number : font name
+    cavatinaFont = None
+    fontDef = None  # font number being defined inside the font table
+
+    # character state per group: [font, bold, unicodeSkip]
+    state = [None, False, 1]
+    stack = []
+    skipDepth = 0  # > 0 while inside an ignored destination group
+    inFontTable = 0
+    groupStart = False  # next token is the first one of a group
+    pendingSkip = 0  # fallback characters still to drop after a \uN
+
+    for m in rtfToken.finditer(rtf):
+        kind = m.lastgroup
+        firstInGroup = groupStart
+        groupStart = False
+
+        if kind == 'group':
+            if m.group('group') == '{':
+                stack.append(state)
+                state = list(state)
+                groupStart = True
+                if skipDepth:
+                    skipDepth += 1
+                elif inFontTable:
+                    inFontTable += 1
+            else:
+                if stack:
+                    state = stack.pop()
+                if skipDepth:
+                    skipDepth -= 1
+                elif inFontTable:
+                    inFontTable -= 1
+            pendingSkip = 0
+            continue
+
+        if skipDepth:
+            continue
+
+        chunk = None
+
+        if kind == 'control':
+            word = m.group('word')
+            param = m.group('param')
+
+            if firstInGroup and word in ignoredDestinations:
+                skipDepth = 1
+            elif word == 'fonttbl':
+                inFontTable = 1
+            elif inFontTable:
+                if word == 'f' and param is not None:
+                    fontDef = int(param)
+                    fonts[fontDef] = ''
+            elif word == 'f':
+                state[0] = int(param or 0)
+            elif word == 'b':
+                state[1] = param is None or param != '0'
+            elif word == 'plain':
+                state[1] = False
+            elif word == 'uc':
+                state[2] = int(param or 0)
+            elif word == 'u' and param is not None:
+                chunk = chr(int(param) % 65536)
+                pendingSkip = state[2]
+            elif word in paragraphWords:
+                chunk = '\n'
+            elif word == 'ansicpg' and param is not None:
+                codepage = 'cp' + param
+
+            if chunk is None:
+                continue
+
+        elif kind == 'symbol':
+            symbol = m.group('symbol')
+            if symbol == '*' and firstInGroup:
+                skipDepth = 1
+                continue
+            chunk = escapedSymbols.get(symbol)
+            if chunk is None:
+                continue
+
+        elif kind == 'hex':
+            if pendingSkip:
+                pendingSkip -= 1
+                continue
+            chunk = bytes([int(m.group('hex'), 16)]).decode(codepage, 'replace')
+
+        elif kind == 'text':
+            chunk = m.group('text')
+            if pendingSkip:
+                dropped = min(pendingSkip, len(chunk))
+                pendingSkip -= dropped
+                chunk = chunk[dropped:]
+            if inFontTable:
+                if fontDef is not None:
+                    fonts[fontDef] += chunk
+                    if ';' in fonts[fontDef]:
+                        fonts[fontDef] = fonts[fontDef].split(';')[0].strip()
+                        if cavatinaFont is None and fonts[fontDef].startswith(cavatinaFontName):
+                            cavatinaFont = fontDef
+                        fontDef = None
+                continue
+
+        else:  # raw line breaks
+            continue
+
+        if not chunk or inFontTable:
+            continue
+        if cavatinaFont is not None and state[0] != cavatinaFont:
+            continue
+
+        out.append(chunk)
+        end = pos + len(chunk)
+        if state[1]:
+            if boldRanges and boldRanges[-1][1] == pos:
+                boldRanges[-1] = (boldRanges[-1][0], end)
+            else:
+                boldRanges.append((pos, end))
+        pos = end
+
+    text = ''.join(out).rstrip('\n')
+    if len(text) < pos:
+        boldRanges = [(start, min(end, len(text)))
+                      for start, end in boldRanges if start < len(text)]
+    return text, boldRanges
@@ -0,0 +1,558 @@
+"""
+Measure, part and voice layout of a Cavatina tree for the native writers
+(io.writeMusicXML, io.writeMIDI). The layout follows
+translator.translateToMusic21, without building a music21 score: only the
+last two measures of each part are kept, since a repeat ending can still
+close on the previous measure.
+"""
+from ..language.symbols import accent_mark
+from ..instrumentation import count, enabled
+from ..language.structures import Chord, Rest, KeySignature, TimeSignature, MeasureEnd, SectionEnd, End, \
+    Dynamic, GradualDynamic, RepeatFrom, RepeatTo, RepeatSectionStart, RepeatSectionEnd, Coda, Segno, FromTo, \
+    OctavationStart, OctavationEnd, GrandStaff, SystemicBarline, Newline
+
+divisions = 8  # per quarter note, the shortest Cavatina value is a dotted 16th in bold
+
+alters = {'-': -1, '=': 1, '--': -2, '==': 2, '-=': 0, '=-': 0}
+accidentalNames = {'-': 'flat', '=': 'sharp', '--': 'flat-flat', '==': 'double-sharp', '-=': 'natural', '=-': 'natural'}
+articulationNames = {'\'': 'staccato', '\"': 'tenuto', '\'\'': 'staccatissimo'}
+ornamentNames = {
+    '[': 'mordent',
+    '{': 'turn',
+    '[`': 'inverted-mordent',
+    '{`': 'inverted-turn',
+    '[[': 'trill-mark',
+    '[[[': 'trill-mark',
+    '[[[[': 'trill-mark',
+    '[[[[[': 'trill-mark',
+    '[[[[[[': 'trill-mark'
+}
+repeatExpressions = {  # FromTo.get_m21parameters() : (words, sound attribute)
+    ('D.C.', None): ('D.C.', 'dacapo'),
+    ('D.C.', 'al Coda'): ('D.C. al Coda', 'dacapo'),
+    ('D.C.', 'al Fine'): ('D.C. al Fine', 'dacapo'),
+    ('D.S.', None): ('D.S.', 'dalsegno'),
+    ('D.S.', 'al Coda'): ('D.S. al Coda', 'dalsegno'),
+    ('D.S.', 'al Fine'): ('D.S. al Fine', 'dalsegno')
+}
+
+
+def duration(interval):
+    """
+    Duration of a TimeInterval in divisions.
+    """
+    ticks, remainder = divmod(interval.length * 4 * divisions, interval.denominator)
+    if remainder:
+        raise ValueError("Duration {}/{} is shorter than the divisions of a quarter note".format(
+            interval.length, interval.denominator))
+    return ticks
+
+
+
+
+class NoteData(object):
+    def __init__(self, nobj, preserveStemDirection=False):
+        self.step = nobj.name
+        self.octave = nobj.octave
+        accidental = next((d for d in nobj.note_diacritics if d in alters), None)
+        self.alter = alters[accidental] if accidental else 0
+        self.accidental = accidentalNames[accidental] if accidental and not nobj.keyAccidental else None
+        self.tieStart = nobj.is_tied()
+        self.tieStop = False
+        self.stem = nobj.stem_direction if preserveStemDirection else None
+
+        # same selection as Note.get_m21articulations / get_m21expressions
+        self.articulations = [articulationNames[d] for d in nobj.note_diacritics if d in articulationNames][:1]
+        if accent_mark in nobj.note_diacritics:
+            self.articulations.append('accent')
+        self.ornaments = [ornamentNames[d] for d in nobj.note_diacritics if d in ornamentNames][:1]
+        self.fermata = '\"\"' in nobj.note_diacritics
+
+    def pitch(self):
+        return self.step, self.alter, self.octave
+
+
+class Event(object):
+    """
+    Anything placed at an offset of a measure. Directions sort before notes at
+    the same offset.
+    """
+
+    def __init__(self, kind, offset, length=0, voice=1, data=None):
+        self.kind = kind  # 'chord', 'rest' or 'direction'
+        self.offset = offset
+        self.length = length
+        self.voice = voice
+        self.data = data
+        self.order = 0 if kind == 'direction' else 1
+        self.beam = None
+        self.arpeggio = False
+        self.isChord = False  # music21 chord.Chord, as opposed to a single note.Note
+
+    def sortKey(self):
+        return self.offset, self.order
+
+
+class Measure(object):
+    def __init__(self, number):
+        self.number = number
+        self.size = 0  # number of elements the music21 measure would contain
+        self.events = []
+        self.highestTime = 0
+        self.last = None  # last event in sort order
+        self.lastChord = None  # last chord of the first voice, for beams
+        self.clef = None
+        self.key = None
+        self.time = None
+        self.leftRepeat = False
+        self.rightRepeat = False
+        self.barStyle = None
+        self.endingStart = None
+        self.endingStop = None
+
+    def __len__(self):
+        return self.size
+
+    def add(self, event):
+        self.events.append(event)
+        self.size += 1
+        self.highestTime = max(self.highestTime, event.offset + event.length)
+        if self.last is None or event.sortKey() >= self.last.sortKey():
+            self.last = event
+        return event
+
+    def append(self, kind, length=0, data=None):
+        return self.add(Event(kind, self.highestTime, length, data=data))
+
+    def direction(self, offset, data, order=0):
+        event = Event('direction', offset, data=data)
+        event.order = order
+        self.events.append(event)
+        return event
+
+    def lastIsLeftRepeat(self):
+        return self.leftRepeat and not self.events and not self.rightRepeat
+
+
+class Ending(object):
+    """
+    Repeat ending (volta) from measure *number* of *part* to a later measure.
+    """
+
+    def __init__(self, part, number, endingNo):
+        self.part = part
+        self.number = number
+        self.endingNo = endingNo
+        self.measure = None  # first measure, once it exists
+
+    def start(self, measure):
+        self.measure = measure
+        measure.endingStart = self.endingNo
+
+
+class Part(object):
+    def __init__(self, walker, index):
+        self.walker = walker
+        self.index = index
+        self.id = 'P{}'.format(index + 1)
+        self.measures = []  # the last two measures, older ones are already flushed
+        self.pendingRemoval = None  # measure dropped if still empty when the part goes on
+        self.lastKeySign = None
+        self.lastClef = None
+        self.lastTimeSign = None
+        self.ties = {}  # pitch : NoteData of the previous chord with a tie start
+        self.wedge = None
+        self.flushed = 0  # number of measures written
+
+    def resolveRemoval(self):
+        m = self.pendingRemoval
+        if m is not None:
+            self.pendingRemoval = None
+            if len(m) == 0 and m in self.measures:
+                self.measures.remove(m)
+
+    def appendMeasure(self, measure):
+        self.resolveRemoval()
+        self.measures.append(measure)
+        while len(self.measures) > 2:
+            self.flush(self.measures.pop(0))
+
+    def lastNumber(self):
+        self.resolveRemoval()
+        return self.measures[-1].number if self.measures else -1
+
+    def flush(self, measure):
+        self.walker.flushMeasure(self, measure)
+        self.flushed += 1
+
+    def close(self):
+        self.resolveRemoval()
+        for measure in self.measures:
+            self.flush(measure)
+        self.measures = []
+
+
+class ScoreWalker(object):
+    """
+    Consumes Cavatina structures one at a time (see add) and lays them out
+    in parts and measures like translator.translateToMusic21. Subclasses
+    write the measures handed to flushMeasure, in order per part, and the
+    file in finish.
+    """
+
+    def __init__(self, scoreInstruments=None, preserveStemDirection=False):
+        self.scoreInstruments = scoreInstruments
+        self.preserveStemDirection = preserveStemDirection
+
+        self.parts = []
+        self.staffGroups = []  # [symbol, [part index, ...]]
+        self.part = self.newPart()
+        self.measure = Measure(0)
+        self.part.appendMeasure(self.measure)
+        self.counter = 0  # measure numbers are not set automatically
+        self.repeatEnds = []  # open Endings
+        self.octavationSwitch = False
+        self.ottavaSize = None  # 8 or 15 while a spanning octavation is open
+        self.ottavaStarted = False  # its first note has been written
+        self.catchPartitioning = False  # watch-state triggered by a Newline
+
+    def newPart(self):
+        part = Part(self, len(self.parts))
+        self.parts.append(part)
+        return part
+
+    def insertNewMeasure(self):
+        self.counter += 1
+        self.measure = Measure(self.counter)
+        self.part.appendMeasure(self.measure)
+        for ending in self.repeatEnds:
+            if ending.measure is None and ending.part is self.part and ending.number == self.counter:
+                ending.start(self.measure)
+
+    def closePreviousMeasure(self):
+        # a closing barline that opens a line going on from an empty measure
+        # ends the measure before it, as at the end of the previous line
+        measure = self.measure
+        previous = self.previousMeasure()
+        if self.part.pendingRemoval is measure and len(measure) == 0 and measure.endingStart is None \
+                and previous is not None:
+            self.part.resolveRemoval()
+            self.measure = previous
+            self.counter = previous.number
+
+    def returnToFirstPart(self):
+        self.part = self.parts[0]
+        self.counter = self.part.lastNumber()
+        self.insertNewMeasure()
+        self.catchPartitioning = False
+
+    def write(self, tree):
+        for structure in tree:
+            self.add(structure)
+        self.close()
+
+    # -- helpers
+
+    def closeEnding(self, endMeasure):
+        ending = self.repeatEnds.pop()
+        if ending.measure is None or endMeasure is None or endMeasure.number < ending.number:
+            if ending.measure is not None:  # empty ending
+                ending.measure.endingStart = None
+            return
+        endMeasure.endingStop = ending.endingNo
+
+    def startEnding(self, number, endingNo):
+        ending = Ending(self.part, number, endingNo)
+        if number == self.measure.number:
+            ending.start(self.measure)
+        self.repeatEnds.append(ending)
+
+    def stopOttava(self):
+        if self.ottavaStarted:
+            stop = (('type', 'stop'), ('size', self.ottavaSize))
+            self.measure.direction(self.measure.highestTime, ([('octave-shift', None, stop)], None))
+        self.ottavaStarted = False
+        self.octavationSwitch = False
+
+    def stopWedge(self, offset):
+        if self.part.wedge:
+            self.measure.direction(offset, ([('wedge', None, (('type', 'stop'),))], None))
+            self.part.wedge = None
+
+    # -- structures, in the same order as translator.translateToMusic21
+
+    def add(self, structure):
+        measure = self.measure
+        part = self.part
+
+        # (time structures)
+        if isinstance(structure, Chord):
+            # trim chord into chord voices of equal length
+            voices = [[structure[0]]]
+            for nobj in structure[1:]:
+                if nobj.get_quarterLength() != voices[-1][-1].get_quarterLength():
+                    voices.append([nobj])
+                else:
+                    voices[-1].append(nobj)
+
+            ties, part.ties = part.ties, {}
+            offset = measure.highestTime
+            events = []
+            for v, nobjs in enumerate(voices):
+                notes = [NoteData(nobj, self.preserveStemDirection) for nobj in nobjs]
+                if self.octavationSwitch:
+                    for n in notes:
+                        n.octave += 1
+                if len(notes) > 1:  # first-note and last-note diacritics become chord diacritics
+                    first, last = notes[0], notes[-1]
+                    first.articulations = first.articulations + [a for a in last.articulations if a not in first.articulations]
+                    first.ornaments = first.ornaments + [o for o in last.ornaments if o not in first.ornaments]
+                    first.fermata = first.fermata or last.fermata
+                    last.articulations, last.ornaments, last.fermata = [], [], False
+                for n in notes:
+                    if n.pitch() in ties:
+                        n.tieStop = True
+                    if n.tieStart:
+                        part.ties[n.pitch()] = n
+                event = Event('chord', offset, duration(nobjs[0]), voice=v + 1, data=notes)
+                event.isChord = len(structure) > 1
+                event.arpeggio = structure.arpeggio
+                events.append(measure.add(event))
+
+            # Beams
+            previous = measure.lastChord
+            if structure.beamToPrevious and previous is not None:
+                previous.beam = 'continue' if previous.beam == 'end' else 'begin'
+                events[0].beam = 'end'
+            measure.lastChord = events[0]
+
+            # Ottava
+            if self.octavationSwitch and not self.ottavaStarted:
+                measure.direction(offset, ([('octave-shift', None, (('type', 'down'), ('size', self.ottavaSize)))], None))
+                self.ottavaStarted = True
+            return
+
+        if isinstance(structure, Rest):
+            measure.append('rest', duration(structure))
+            return
+        # (end time structures)
+
+        # (signatures)
+        if isinstance(structure, KeySignature):
+            if self.catchPartitioning:
+                self.returnToFirstPart()
+                measure, part = self.measure, self.part
+
+            newClef = structure.get_clef()
+            newKeySign = structure.getm21signature()
+            if newKeySign != part.lastKeySign or newClef != part.lastClef:
+                part.lastKeySign = newKeySign
+                part.lastClef = newClef
+                if measure.clef is None:
+                    measure.size += 1
+                measure.clef = newClef
+                measure.key = newKeySign
+                measure.size += 1
+            return
+
+        if isinstance(structure, TimeSignature):
+            ratioString = '{}/{}'.format(structure.numerator, structure.denominator)
+            if ratioString != part.lastTimeSign:
+                part.lastTimeSign = ratioString
+                symbol = {'c': 'common', 'cut': 'cut'}.get(structure.c)
+                measure.time = (structure.numerator, structure.denominator, symbol)
+                measure.size += 1
+            return
+        # (end signatures)
+
+        # (barlines)
+        if isinstance(structure, MeasureEnd):
+            if self.catchPartitioning and not isinstance(structure, SystemicBarline):
+                self.returnToFirstPart()
+                measure, part = self.measure, self.part
+            elif len(measure) > 0:
+                self.insertNewMeasure()
+                measure = self.measure
+
+        if isinstance(structure, SectionEnd):
+            self.closePreviousMeasure()
+            measure = self.measure
+            measure.barStyle = 'light-light'
+            measure.size += 1
+            self.insertNewMeasure()
+            return
+
+        if isinstance(structure, End):
+            self.closePreviousMeasure()
+            measure = self.measure
+            if self.repeatEnds:  # close last repeat section
+                self.closeEnding(measure)
+            measure.barStyle = 'light-heavy'
+            measure.size += 1
+            self.insertNewMeasure()
+            return
+        # (end barlines)
+
+        # (dynamics)
+        if isinstance(structure, Dynamic):
+            last = measure.last
+            offset = last.offset if last and last.kind == 'chord' else measure.highestTime
+            self.stopWedge(offset)
+            measure.direction(offset, ([('dynamics', structure.get_m21dynamic(), ())], None))
+            measure.size += 1
+            return
+
+        if isinstance(structure, GradualDynamic):
+            last = measure.last
+            offset = last.offset if last and last.kind == 'chord' and last.isChord else measure.highestTime
+            self.stopWedge(offset)
+            wedge = 'crescendo' if structure.get_name() == 'crescendo' else 'diminuendo'
+            measure.direction(offset, ([('wedge', None, (('type', wedge),))], None))
+            measure.size += 1
+            part.wedge = wedge
+            return
+        # (end dynamics)
+
+        # (repeat structures)
+        if isinstance(structure, RepeatFrom):
+            if len(measure) > 0 and not measure.lastIsLeftRepeat():
+                self.insertNewMeasure()
+                measure = self.measure
+            if not measure.leftRepeat:
+                measure.size += 1
+            measure.leftRepeat = True
+            return
+
+        if isinstance(structure, RepeatTo):
+            self.closePreviousMeasure()
+            measure = self.measure
+            if self.repeatEnds:  # close last repeat section
+                self.closeEnding(measure)
+            if not measure.rightRepeat:
+                measure.size += 1
+            measure.rightRepeat = True
+            self.insertNewMeasure()
+            return
+
+        if isinstance(structure, RepeatSectionStart):
+            if self.repeatEnds:  # close last repeat section
+                self.closeEnding(measure if len(measure) > 0 else self.previousMeasure())
+            endingNo = structure.get_m21no()
+            if len(measure) == 0:
+                self.startEnding(measure.number, endingNo)
+            else:
+                self.startEnding(measure.number + 1, endingNo)
+            return
+
+        if isinstance(structure, RepeatSectionEnd):
+            if self.repeatEnds:
+                self.closeEnding(measure if len(measure) > 0 else self.previousMeasure())
+            return
+
+        if isinstance(structure, Coda):
+            measure.append('direction', data=([('coda', None, ())], None))
+            return
+
+        if isinstance(structure, Segno):
+            measure.append('direction', data=([('segno', None, ())], None))
+            return
+
+        if isinstance(structure, FromTo):
+            words, sound = repeatExpressions.get(tuple(structure.get_m21parameters()), (None, None))
+            if words:
+                measure.append('direction', data=([('words', words, ())], ((sound, 'yes'),)))
+            return
+        # (end repeat structures)
+
+        # (ottava)
+        if isinstance(structure, OctavationStart):
+            otp = structure.octaveTranspositions
+            if otp == 0 and len(measure) > 0:  # single octavation
+                last = measure.last
+                if last is not None and last.kind == 'chord':
+                    for n in last.data:
+                        n.octave += 1
+                    shift, stop = (('type', 'down'), ('size', 8)), (('type', 'stop'), ('size', 8))
+                    measure.direction(last.offset, ([('octave-shift', None, shift)], None))
+                    measure.direction(last.offset + last.length, ([('octave-shift', None, stop)], None))
+                measure.size += 1
+            elif otp in (1, 2):  # spanning octavation
+                self.stopOttava()
+                self.ottavaSize = 8 if otp == 1 else 15
+                self.octavationSwitch = True
+            return
+
+        if isinstance(structure, OctavationEnd):
+            self.stopOttava()
+            return
+        # (end ottava)
+
+        # (grand staff)
+        if isinstance(structure, GrandStaff) or isinstance(structure, SystemicBarline):
+            if self.catchPartitioning:
+                if part is self.parts[-1]:  # part is last part
+                    # Create new part and re-initialize
+                    self.part = self.newPart()
+                    self.counter = -1
+                    self.insertNewMeasure()
+                    p1, p2 = len(self.parts) - 2, len(self.parts) - 1
+
+                    if isinstance(structure, GrandStaff):
+                        self.staffGroups.append(['brace', [p1, p2]])
+
+                    if isinstance(structure, SystemicBarline):
+                        if not self.staffGroups:
+                            self.staffGroups.append(['line', [p1, p2]])
+                        else:
+                            self.staffGroups[0][1].append(p2)
+
+                else:  # next parts already exist
+                    self.part = self.parts[self.parts.index(part) + 1]
+                    self.counter = self.part.lastNumber()
+                    self.insertNewMeasure()
+
+                self.catchPartitioning = False
+                return
+        # (end grand staff)
+
+        # New line
+        if isinstance(structure, Newline):
+            if len(measure) == 0:
+                part.pendingRemoval = measure
+            self.catchPartitioning = True  # trigger watch-state
+            return
+
+    def instrumentName(self, i):
+        """
+        Instrument of the i-th part: one instrument applies to all parts.
+        """
+        if not self.scoreInstruments:
+            return None
+        if len(self.scoreInstruments) == 1:
+            return self.scoreInstruments[0]
+        return self.scoreInstruments[i] if i < len(self.scoreInstruments) else None
+
+    def previousMeasure(self):
+        measures = [m for m in self.part.measures if m is not self.measure]
+        return measures[-1] if measures else None
+
+    def close(self):
+        self.stopOttava()
+        for part in self.parts:
+            if part.wedge and part.measures:
+                last = part.measures[-1]
+                last.direction(last.highestTime, ([('wedge', None, (('type', 'stop'),))], None))
+            # Clean-up
+            if part.measures and len(part.measures[-1]) == 0:
+                part.pendingRemoval = part.measures[-1]
+            part.close()
+        self.finish()
+        if enabled():
+            count('parts', len(self.parts))
+            count('measures', sum(part.flushed for part in self.parts))
+
+    def flushMeasure(self, part, measure):
+        raise NotImplementedError
+
+    def finish(self):
+        raise NotImplementedError
@@ -1,25 +1,28 @@
 from os.path import dirname, abspath, join
 
-from ..language.syntax import parse
-from .. import translator
+from ..pipeline import Pipeline
+from .cache import ConversionCache
+from .formats import outputPath
 
-def writeFiles(filename, outfilename, filedir=None, outputFormat='text'):
+def writeFiles(filename, outfilename, filedir=None, outputFormat='text', cache=None):
     """
     Input file format may be .txt or .rtf
+    outputFormat: format of the score written next to the text dump (see
+                  translator.writeStream), or None to only write the text dump
+    cache: ConversionCache, by default the one configured in the environment
     """
     if filedir:
         filename = join(filedir, filename)
         outfilename = join(filedir, outfilename)
 
-    with open(outfilename, "wt") as fout:
-        with open(filename, "rt") as fin:
-            tree = parse(fin.read())
-            fout.write( '\n'.join([str(n) for n in tree]) )
+    pipeline = Pipeline.fromFile(filename)
+    pipeline.writeText(outfilename)
+    if outputFormat is None:
+        return
 
-    with open(filename, "rt") as fin:
-        tree = parse(fin.read())
-        score = translator.translateToMusic21(tree)
-        translator.writeStream(score, format=outputFormat, wrtpath=filedir)
+    if cache is None:
+        cache = ConversionCache.fromEnvironment()
+    pipeline.writeStream(outputFormat, outputPath(outputFormat, filedir), cache)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,167 @@
+"""
+Native Standard MIDI File backend: writes a type-1 MIDI file straight from
+the Cavatina structures, without building a music21 score (see
+io.scoreWalker). Track 0 holds the tempo, every part gets its own track.
+Repeats, endings and jumps (da capo, segno) are written as notated and
+played once; music21's MIDI export plays them out instead.
+"""
+import struct
+
+from .scoreWalker import ScoreWalker, divisions
+
+ticksPerQuarter = 480
+ticksPerDivision = ticksPerQuarter // divisions
+defaultTempo = 120
+defaultVelocity = 90
+
+dynamicVelocities = {
+    'ppp': 20,
+    'pp': 32,
+    'p': 45,
+    'mp': 57,
+    'mf': 70,
+    'f': 89,
+    'ff': 102,
+    'fff': 114,
+    'sf': 108,
+    'fp': 89
+}
+
+stepSemitones = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+
+def midiPitch(n):
+    """
+    MIDI key number of a NoteData (middle C is 60).
+    """
+    return 12 * (n.octave + 1) + stepSemitones[n.step] + n.alter
+
+
+def varLen(value):
+    """
+    Variable-length quantity encoding of a delta time.
+    """
+    data = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        data.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(data)
+
+
+def metaEvent(kind, data):
+    return b'\xff' + bytes([kind]) + varLen(len(data)) + data
+
+
+def trackChunk(events):
+    """
+    events: list of (tick, order, message bytes), in any order
+    """
+    data = bytearray()
+    tick = 0
+    for t, order, message in sorted(events, key=lambda e: (e[0], e[1])):
+        data += varLen(t - tick)
+        data += message
+        tick = t
+    data += b'\x00' + metaEvent(0x2F, b'')  # end of track
+    return b'MTrk' + struct.pack('>I', len(data)) + bytes(data)
+
+
+class MIDIWriter(ScoreWalker):
+    """
+    Consumes Cavatina structures one at a time (see add) and writes the
+    MIDI file to the binary file object *f* with close.
+    """
+
+    def __init__(self,
+                 f,
+                 scoreTitle=None,
+                 scoreComposer=None,
+                 scoreTempo=None,
+                 scoreInstruments=None,
+                 preserveStemDirection=False):
+        self.f = f
+        self.scoreTitle = scoreTitle or "Untitled"
+        self.scoreTempo = scoreTempo or defaultTempo
+        super(MIDIWriter, self).__init__(scoreInstruments, preserveStemDirection)
+
+    def newPart(self):
+        part = super(MIDIWriter, self).newPart()
+        part.tick = 0  # start of the next flushed measure
+        part.velocity = defaultVelocity
+        part.notes = []  # [start, end, key, velocity]
+        part.meta = []  # (tick, order, message)
+        part.tied = {}  # key : note continued by the next tied note
+        return part
+
+    def flushMeasure(self, part, measure):
+        start = part.tick
+        if measure.key is not None:
+            part.meta.append((start, 0, metaEvent(0x59, struct.pack('>bB', measure.key, 0))))
+        if measure.time:
+            numerator, denominator = int(measure.time[0]), int(measure.time[1])
+            if numerator > 0 and denominator > 0 and denominator & (denominator - 1) == 0:
+                part.meta.append((start, 0, metaEvent(0x58, bytes(
+                    [numerator, denominator.bit_length() - 1, 24, 8]))))
+
+        for event in sorted(measure.events, key=lambda e: e.sortKey()):
+            if event.kind == 'direction':
+                tag, text, attrs = event.data[0][0]
+                if tag == 'dynamics' and text in dynamicVelocities:
+                    part.velocity = dynamicVelocities[text]
+                continue
+            if event.kind != 'chord':
+                continue
+
+            onset = start + event.offset * ticksPerDivision
+            end = onset + event.length * ticksPerDivision
+            for n in event.data:
+                key = midiPitch(n)
+                if n.tieStop and key in part.tied:
+                    note = part.tied.pop(key)
+                    note[1] = end
+                else:
+                    note = [onset, end, key, part.velocity]
+                    part.notes.append(note)
+                if n.tieStart:
+                    part.tied[key] = note
+
+        part.tick += measure.highestTime * ticksPerDivision
+
+    def channel(self, part):
+        channel = part.index % 15  # parts cycle through the 15 melodic channels
+        return channel + 1 if channel >= 9 else channel  # channel 10 is percussion
+
+    def finish(self):
+        tracks = []
+
+        conductor = [(0, 0, metaEvent(0x03, self.scoreTitle.encode('utf-8'))),
+                     (0, 0, metaEvent(0x51, struct.pack('>I', int(round(60000000 / self.scoreTempo)))[1:]))]
+        tracks.append(trackChunk(conductor))
+
+        for part in self.parts:
+            channel = self.channel(part)
+            events = list(part.meta)
+            name = self.instrumentName(part.index)
+            if name:
+                events.append((0, 0, metaEvent(0x03, name.encode('utf-8'))))
+            for onset, end, key, velocity in part.notes:
+                if 0 <= key < 128:
+                    events.append((onset, 2, bytes([0x90 | channel, key, velocity])))
+                    events.append((end, 1, bytes([0x80 | channel, key, 0])))  # note-offs first
+            tracks.append(trackChunk(events))
+
+        self.f.write(b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), ticksPerQuarter))
+        for track in tracks:
+            self.f.write(track)
+
+
+def writeMIDI(tree, wrtpath, **options):
+    """
+    Writes the structures of *tree* (any iterable, e.g. syntax.parse_iter) as
+    a Standard MIDI File to *wrtpath*.
+    options: scoreTitle, scoreComposer, scoreTempo, scoreInstruments,
+             preserveStemDirection
+    """
+    with open(wrtpath, 'wb') as f:
+        MIDIWriter(f, **options).write(tree)
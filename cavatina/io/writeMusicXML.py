@@ -0,0 +1,317 @@
+"""
+Native MusicXML backend: writes partwise MusicXML straight from the Cavatina
+structures, without building a music21 score (see io.scoreWalker). Measures
+are written to a temporary file per part as soon as they are complete, and
+the parts are joined once the part list is known, so memory stays bounded
+on arbitrarily long inputs.
+"""
+import shutil
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
+
+from .._version import __version__
+from .scoreWalker import ScoreWalker, divisions
+
+noteTypes = {  # duration in divisions : (type, dots)
+    1: ('32nd', 0),
+    2: ('16th', 0),
+    3: ('16th', 1),
+    4: ('eighth', 0),
+    6: ('eighth', 1),
+    8: ('quarter', 0),
+    12: ('quarter', 1),
+    16: ('half', 0),
+    24: ('half', 1),
+    32: ('whole', 0),
+    48: ('whole', 1),
+    64: ('breve', 0)
+}
+
+clefSigns = {'G': ('G', 2), 'F': ('F', 4), 'C': ('C', 3)}
+
+
+class XMLWriter(object):
+    """
+    Incremental, indenting XML writer.
+    """
+
+    def __init__(self, f, depth=0):
+        self.f = f
+        self.depth = depth
+
+    def _tag(self, tag, attrs):
+        if attrs:
+            return tag + ''.join(' {}={}'.format(k, quoteattr(str(v))) for k, v in attrs)
+        return tag
+
+    def start(self, tag, *attrs):
+        self.f.write('{}<{}>\n'.format('  ' * self.depth, self._tag(tag, attrs)))
+        self.depth += 1
+
+    def end(self, tag):
+        self.depth -= 1
+        self.f.write('{}</{}>\n'.format('  ' * self.depth, tag))
+
+    def element(self, tag, text=None, *attrs):
+        if text is None:
+            self.f.write('{}<{}/>\n'.format('  ' * self.depth, self._tag(tag, attrs)))
+        else:
+            self.f.write('{}<{}>{}</{}>\n'.format('  ' * self.depth, self._tag(tag, attrs), escape(str(text)), tag))
+
+
+def writeMeasure(xml, measure, first=False):
+    xml.start('measure', ('number', measure.number))
+
+    if first or measure.clef or measure.key is not None or measure.time:
+        xml.start('attributes')
+        if first:
+            xml.element('divisions', divisions)
+        if measure.key is not None:
+            xml.start('key')
+            xml.element('fifths', measure.key)
+            xml.end('key')
+        if measure.time:
+            numerator, denominator, symbol = measure.time
+            xml.start('time', *((('symbol', symbol),) if symbol else ()))
+            xml.element('beats', numerator)
+            xml.element('beat-type', denominator)
+            xml.end('time')
+        if measure.clef:
+            sign, line = clefSigns[measure.clef]
+            xml.start('clef')
+            xml.element('sign', sign)
+            xml.element('line', line)
+            xml.end('clef')
+        xml.end('attributes')
+
+    if measure.leftRepeat or measure.endingStart:
+        xml.start('barline', ('location', 'left'))
+        if measure.leftRepeat:
+            xml.element('bar-style', 'heavy-light')
+        if measure.endingStart:
+            xml.element('ending', None, ('number', measure.endingStart), ('type', 'start'))
+        if measure.leftRepeat:
+            xml.element('repeat', None, ('direction', 'forward'))
+        xml.end('barline')
+
+    position = 0
+    for voice in sorted(set(e.voice for e in measure.events)):
+        if position:
+            xml.start('backup')
+            xml.element('duration', position)
+            xml.end('backup')
+            position = 0
+        events = sorted((e for e in measure.events if e.voice == voice), key=lambda e: e.sortKey())
+        for event in events:
+            if event.offset > position:
+                xml.start('forward')
+                xml.element('duration', event.offset - position)
+                xml.end('forward')
+                position = event.offset
+            writeEvent(xml, event)
+            position += event.length
+
+    if measure.barStyle or measure.rightRepeat or measure.endingStop:
+        xml.start('barline', ('location', 'right'))
+        xml.element('bar-style', 'light-heavy' if measure.rightRepeat else measure.barStyle)
+        if measure.endingStop:
+            xml.element('ending', None, ('number', measure.endingStop),
+                        ('type', 'stop' if measure.rightRepeat else 'discontinue'))
+        if measure.rightRepeat:
+            xml.element('repeat', None, ('direction', 'backward'))
+        xml.end('barline')
+
+    xml.end('measure')
+
+
+def writeEvent(xml, event):
+    if event.kind == 'direction':
+        directionTypes, sound = event.data
+        xml.start('direction', ('placement', 'below' if directionTypes[0][0] in ('dynamics', 'wedge') else 'above'))
+        for tag, text, attrs in directionTypes:
+            xml.start('direction-type')
+            if tag == 'dynamics':
+                xml.start('dynamics')
+                xml.element(text)
+                xml.end('dynamics')
+            elif tag == 'metronome':
+                xml.start('metronome')
+                xml.element('beat-unit', 'quarter')
+                xml.element('per-minute', text)
+                xml.end('metronome')
+            else:
+                xml.element(tag, text, *attrs)
+            xml.end('direction-type')
+        if sound:
+            xml.element('sound', None, *sound)
+        xml.end('direction')
+        return
+
+    noteType = noteTypes.get(event.length)
+    if event.kind == 'rest':
+        xml.start('note')
+        xml.element('rest')
+        xml.element('duration', event.length)
+        xml.element('voice', event.voice)
+        if noteType:
+            xml.element('type', noteType[0])
+            for _ in range(noteType[1]):
+                xml.element('dot')
+        xml.end('note')
+        return
+
+    notes = event.data
+    for i, n in enumerate(notes):
+        xml.start('note')
+        if i > 0:
+            xml.element('chord')
+        xml.start('pitch')
+        xml.element('step', n.step)
+        if n.alter:
+            xml.element('alter', n.alter)
+        xml.element('octave', n.octave)
+        xml.end('pitch')
+        xml.element('duration', event.length)
+        if n.tieStop:
+            xml.element('tie', None, ('type', 'stop'))
+        if n.tieStart:
+            xml.element('tie', None, ('type', 'start'))
+        xml.element('voice', event.voice)
+        if noteType:
+            xml.element('type', noteType[0])
+            for _ in range(noteType[1]):
+                xml.element('dot')
+        if n.accidental:
+            xml.element('accidental', n.accidental)
+        if n.stem:
+            xml.element('stem', n.stem)
+        if i == 0 and event.beam:
+            xml.element('beam', event.beam, ('number', 1))
+
+        arpeggio = event.arpeggio
+        if n.tieStart or n.tieStop or n.articulations or n.ornaments or n.fermata or arpeggio:
+            xml.start('notations')
+            if n.tieStop:
+                xml.element('tied', None, ('type', 'stop'))
+            if n.tieStart:
+                xml.element('tied', None, ('type', 'start'))
+            if n.articulations:
+                xml.start('articulations')
+                for a in n.articulations:
+                    xml.element(a)
+                xml.end('articulations')
+            if n.ornaments:
+                xml.start('ornaments')
+                for o in n.ornaments:
+                    xml.element(o)
+                xml.end('ornaments')
+            if n.fermata:
+                xml.element('fermata')
+            if arpeggio:
+                xml.element('arpeggiate')
+            xml.end('notations')
+        xml.end('note')
+
+
+class MusicXMLWriter(ScoreWalker):
+    """
+    Consumes Cavatina structures one at a time (see add) and writes the
+    score to the file object *f* with close.
+    """
+
+    def __init__(self,
+                 f,
+                 scoreTitle=None,
+                 scoreComposer=None,
+                 scoreTempo=None,
+                 scoreInstruments=None,
+                 preserveStemDirection=False):
+        self.f = f
+        self.scoreTitle = scoreTitle or "Untitled"
+        self.scoreComposer = scoreComposer or "Unknown Composer"
+        self.scoreTempo = scoreTempo
+        super(MusicXMLWriter, self).__init__(scoreInstruments, preserveStemDirection)
+
+        if self.scoreTempo:
+            self.measure.direction(0, ([('metronome', self.scoreTempo, ())], (('tempo', self.scoreTempo),)), order=-1)
+
+    def newPart(self):
+        part = super(MusicXMLWriter, self).newPart()
+        part.spool = None  # opened with the first measure, see flushMeasure
+        part.written = 0
+        return part
+
+    def write(self, tree):
+        try:
+            super(MusicXMLWriter, self).write(tree)
+        finally:  # the spools are left open if tree raises before finish
+            for part in self.parts:
+                if part.spool is not None:
+                    part.spool.close()
+
+    def flushMeasure(self, part, measure):
+        if part.spool is None:
+            part.spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+            part.xml = XMLWriter(part.spool, 2)
+        writeMeasure(part.xml, measure, first=part.written == 0)
+        part.written += 1
+
+    def finish(self):
+        xml = XMLWriter(self.f)
+        self.f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.f.write('<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.1 Partwise//EN" '
+                     '"http://www.musicxml.org/dtds/partwise.dtd">\n')
+        xml.start('score-partwise', ('version', '3.1'))
+        xml.start('work')
+        xml.element('work-title', self.scoreTitle)
+        xml.end('work')
+        xml.start('identification')
+        xml.element('creator', self.scoreComposer, ('type', 'composer'))
+        xml.start('encoding')
+        xml.element('software', 'Cavatina converter ' + __version__)
+        xml.end('encoding')
+        xml.end('identification')
+        self.writePartList(xml)
+        for part in self.parts:
+            xml.start('part', ('id', part.id))
+            if part.spool is not None:
+                part.spool.seek(0)
+                shutil.copyfileobj(part.spool, self.f)
+                part.spool.close()
+            xml.end('part')
+        xml.end('score-partwise')
+
+    def writePartList(self, xml):
+        xml.start('part-list')
+        for i, part in enumerate(self.parts):
+            for n, (symbol, members) in enumerate(self.staffGroups):
+                if min(members) == i:
+                    xml.start('part-group', ('type', 'start'), ('number', n + 1))
+                    xml.element('group-symbol', symbol)
+                    xml.element('group-barline', 'yes')
+                    xml.end('part-group')
+
+            xml.start('score-part', ('id', part.id))
+            name = self.instrumentName(i)
+            xml.element('part-name', name or '')
+            if name:
+                xml.start('score-instrument', ('id', part.id + '-I1'))
+                xml.element('instrument-name', name)
+                xml.end('score-instrument')
+            xml.end('score-part')
+
+            for n, (symbol, members) in enumerate(self.staffGroups):
+                if max(members) == i:
+                    xml.element('part-group', None, ('type', 'stop'), ('number', n + 1))
+        xml.end('part-list')
+
+
+def writeMusicXML(tree, wrtpath, **options):
+    """
+    Writes the structures of *tree* (any iterable, e.g. syntax.parse_iter) as
+    MusicXML to *wrtpath*.
+    options: scoreTitle, scoreComposer, scoreTempo, scoreInstruments,
+             preserveStemDirection
+    """
+    with open(wrtpath, 'wt', encoding='utf-8') as f:
+        MusicXMLWriter(f, **options).write(tree)
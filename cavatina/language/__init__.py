@@ -1 +1 @@
-__all__ = ['symbols', 'semantics', 'structures', 'syntax']
\ No newline at end of file
+__all__ = ['symbols', 'semantics', 'structures', 'tokenizer', 'syntax', 'document']
\ No newline at end of file
@@ -0,0 +1,164 @@
+from .syntax import ParseState, BoldRegion, getTextAndRTFBoldRegion, parse_tokens, tokenizers, default_tokenizer
+from ..keyboard_layout import inputTranslate, getLayout
+
+
+class Segment(object):
+    """
+    One or more complete lines of a document. A segment always ends with a
+    standalone newline token (or at the end of the document), so the tokens
+    of a segment do not depend on the text around it.
+    """
+
+    def __init__(self, raw, text, tokens):
+        self.raw = raw  # input text, before keyboard layout translation
+        self.text = text
+        self.tokens = tokens
+        self.tokenLength = sum(len(t) for t in tokens)  # advance of the parser's global position
+        self.key_in = None  # key signature before / after the segment
+        self.key_out = None
+        self.boldFlags = None
+        self.structures = []
+
+    def is_closed(self):
+        return self.tokens[-1] == '\n'
+
+
+def same_key(k1, k2):
+    return k1.get_clef() == k2.get_clef() and k1.getm21signature() == k2.getm21signature()
+
+
+class Document(object):
+    """
+    Keeps the tokens and structures of a Cavatina text per line so that, after
+    an edit, only the changed lines (and the following lines whose key
+    signature context changed) are tokenized and parsed again.
+    """
+
+    def __init__(self, content='', inputLanguage=None, tokenizer=None):
+        self.inputLanguage = inputLanguage or getLayout()
+        self.tokenizer = tokenizer
+        self.segments = []
+        self.raw = ''
+        self.boldRegion = BoldRegion()
+        self.update(content)
+
+    def update(self, content):
+        """
+        Replaces the whole content (plain text or RTF) and re-parses what changed.
+        """
+        rawText, boldRegion = getTextAndRTFBoldRegion(content)
+        self.set_text(rawText, boldRegion)
+
+    def edit(self, start, end, replacement):
+        """
+        Replaces raw[start:end] with *replacement* (plain text documents).
+        """
+        self.set_text(self.raw[:start] + replacement + self.raw[end:], self.boldRegion)
+
+    def set_text(self, raw, boldRegion=None):
+        boldRegion = boldRegion if boldRegion is not None else BoldRegion()
+        old = self.segments
+
+        # unchanged segments at the start...
+        head = 0
+        pos = 0
+        while (head < len(old) and
+               (old[head].is_closed() or pos + len(old[head].raw) == len(raw)) and
+               raw.startswith(old[head].raw, pos)):
+            pos += len(old[head].raw)
+            head += 1
+
+        # ...and at the end
+        tail = len(old)
+        end = len(raw)
+        while (tail > head and
+               end - len(old[tail - 1].raw) >= pos and
+               raw.endswith(old[tail - 1].raw, 0, end)):
+            end -= len(old[tail - 1].raw)
+            tail -= 1
+
+        changed = self.split(raw[pos:end])
+        # a changed last line that merged its newline into a token swallows the next segment
+        while changed and not changed[-1].is_closed() and tail < len(old):
+            merged = changed.pop().raw + old[tail].raw
+            end += len(old[tail].raw)
+            tail += 1
+            changed.extend(self.split(merged))
+
+        # bold lookups depend on global token positions, which any edit can shift
+        checkAll = len(boldRegion) > 0 or len(self.boldRegion) > 0
+        self.segments = old[:head] + changed + old[tail:]
+        self.raw = raw
+        self.boldRegion = boldRegion
+        self.reparse(head, head + len(changed), checkAll)
+
+    def split(self, raw):
+        segments = []
+        pending = ''
+        lines = raw.split('\n')
+        for i, line in enumerate(lines):
+            pending += line + ('\n' if i < len(lines) - 1 else '')
+            if not pending:
+                continue
+            text = inputTranslate(pending, langFrom=self.inputLanguage)
+            tokens = list(tokenizers[self.tokenizer or default_tokenizer](text))
+            if tokens[-1] == '\n' or i == len(lines) - 1:
+                segments.append(Segment(pending, text, tokens))
+                pending = ''
+        return segments
+
+    def reparse(self, start, stop, checkAll=False):
+        """
+        Parses segments[start:stop] and the other segments whose context changed.
+        Unless *checkAll*, segments before *start* are known to be unchanged.
+        """
+        offset = 0  # global position of the segment's first token, needed for bold lookups
+
+        for i in range(0 if checkAll else start, len(self.segments)):
+            segment = self.segments[i]
+            if i > 0:
+                state = ParseState(self.segments[i - 1].key_out, offset - 1, '\n')
+            else:
+                state = ParseState()
+            boldFlags = self.bold_flags(segment, offset)
+
+            if not (start <= i < stop) and segment.key_in is not None and (
+                same_key(segment.key_in, state.key_signature) and
+                segment.boldFlags == boldFlags
+            ):
+                if i >= stop and not checkAll:
+                    break  # the rest of the document is parsed in the same context
+            else:
+                key_in = state.key_signature
+                segment.key_in = None  # parsed again on the next update if this fails
+                segment.structures = list(parse_tokens(
+                    segment.tokens, state, self.boldRegion,
+                    lambda: (segment.tokens, segment.raw)))
+                segment.key_in = key_in
+                segment.key_out = state.key_signature
+                segment.boldFlags = boldFlags
+            offset += segment.tokenLength
+
+    def bold_flags(self, segment, offset):
+        if not len(self.boldRegion):
+            return None
+        flags = []
+        for token in segment.tokens:
+            flags.append(offset in self.boldRegion)
+            offset += len(token)
+        return tuple(flags)
+
+    def tokens(self):
+        return [t for segment in self.segments for t in segment.tokens]
+
+    def tree(self):
+        return [s for segment in self.segments for s in segment.structures]
+
+    def spans(self):
+        """
+        Yields (start, end, structures) of every segment, positions in *raw*.
+        """
+        pos = 0
+        for segment in self.segments:
+            yield pos, pos + len(segment.raw), segment.structures
+            pos += len(segment.raw)
@@ -6,6 +6,71 @@ from .semantics import *
 class InvalidSymbolError(Exception):
     pass
 
+accidentals_m21 = {
+    '-' : 'flat',
+    '=' : 'sharp',
+    '--' : 'double-flat',
+    '==' : 'double-sharp',
+    '-=' : 'natural',
+    '=-' : 'natural'
+}
+
+# music21 class names, resolved by get_m21class (music21 is only imported on first use)
+articulations_m21 = {
+    '\'' : 'Staccato',
+    '\"' : 'Tenuto',
+    '\'\'' : 'Staccatissimo',
+}
+
+expressions_m21 = {
+    '[' : 'Mordent',
+    '{' : 'Turn',
+    '[`' : 'InvertedMordent',
+    '{`' : 'InvertedTurn',
+    '[[' : 'Trill',
+    '[[[' : 'Trill', # TODO: expressions.TrillExtension(<note.Note list>)
+    '[[[[' : 'Trill', # span = 2 notes
+    '[[[[[' : 'Trill', # span = 3 notes
+    '[[[[[[' : 'Trill' # span = 4 notes
+}
+
+clefs_m21 = {
+    'G' : 'TrebleClef',
+    'F' : 'BassClef',
+    'C' : 'AltoClef'
+}
+
+m21_classes = {} # (module, class name) : class
+
+def get_m21class(module, name):
+    try:
+        return m21_classes[module, name]
+    except KeyError:
+        import importlib
+        cls = getattr(importlib.import_module('music21.' + module), name)
+        m21_classes[module, name] = cls
+        return cls
+
+flyweights = {} # (class, constructor arguments) : shared instance
+
+class Flyweight(object):
+    """
+    Base of the immutable structures: constructing one with the same arguments
+    as an earlier one returns the earlier, shared instance.
+    """
+    __slots__ = ('_args',)
+    
+    def __new__(cls, *args):
+        try:
+            return flyweights[cls, args]
+        except KeyError:
+            instance = flyweights[cls, args] = super(Flyweight, cls).__new__(cls)
+            instance._args = args
+            return instance
+    
+    def __getnewargs__(self): # copies and pickles are interned as well
+        return self._args
+
 def MatchIndex(regexpr,array):
     for i in range(len(array)): # returns index of the first entry which matches regexpr, or *None* if it wasn't matched
         if re.match(regexpr,array[i]):
@@ -13,6 +78,8 @@ def MatchIndex(regexpr,array):
     return None
 
 class TimeInterval(object):
+    __slots__ = ('length_exponent', 'denominator', 'length')
+    
     def __init__(self, length_exponent=0, denominator=8):
         self.length_exponent = length_exponent
         self.denominator = denominator
@@ -36,6 +103,8 @@ class TimeInterval(object):
         return (float(self.length) / self.denominator) * 4
 
 class Note(TimeInterval):
+    __slots__ = ('pitch', 'stem_direction', 'key_signature', 'name', 'octave', 'note_diacritics', 'keyAccidental')
+    
     def __init__(self, pitch, key_signature, length_exponent=0, denominator=8):
         self.pitch = pitch
         self.stem_direction = 'up' if note_range[self.pitch] in 'zxcvbnmasdfghZXCVBNMASDFGH' else 'down'
@@ -143,54 +212,19 @@ class Note(TimeInterval):
         return self.name + str(self.octave)
         
     def get_m21accidental(self):
-        accidentals_m21 = {
-            '-' : 'flat',
-            '=' : 'sharp',
-            '--' : 'double-flat',
-            '==' : 'double-sharp',
-            '-=' : 'natural',
-            '=-' : 'natural'
-        }
-        
         return next((accidentals_m21[x] for x in self.note_diacritics if x in accidentals_m21), None)
     
     def get_m21articulations(self):
-        from music21 import articulations as m21articulations
-        articulations_m21 = {
-            '\'' : m21articulations.Staccato,
-            '\"' : m21articulations.Tenuto,
-            '\'\'' : m21articulations.Staccatissimo,
-        }
-        
-        try:
-            artic = [next((articulations_m21[x] for x in self.note_diacritics if x in articulations_m21))]
-        except StopIteration:
-            artic = []
+        artic = [get_m21class('articulations', articulations_m21[x]) for x in self.note_diacritics if x in articulations_m21][:1]
         if accent_mark in self.note_diacritics:
-            artic.append(m21articulations.Accent)
+            artic.append(get_m21class('articulations', 'Accent'))
             
         return artic # a list of abstract music21.articulations classes
     
     def get_m21expressions(self):
-        from music21 import expressions as m21expressions
-        expressions_m21 = {
-            '[' : m21expressions.Mordent,
-            '{' : m21expressions.Turn,
-            '[`' : m21expressions.InvertedMordent,
-            '{`' : m21expressions.InvertedTurn,
-            '[[' : m21expressions.Trill,
-            '[[[' : m21expressions.Trill, # TODO: expressions.TrillExtension(<note.Note list>)
-            '[[[[' : m21expressions.Trill, # span = 2 notes
-            '[[[[[' : m21expressions.Trill, # span = 3 notes
-            '[[[[[[' : m21expressions.Trill # span = 4 notes
-        }
-        
-        try:
-            expr = [next((expressions_m21[x] for x in self.note_diacritics if x in expressions_m21))]
-        except StopIteration:
-            expr = []
+        expr = [get_m21class('expressions', expressions_m21[x]) for x in self.note_diacritics if x in expressions_m21][:1]
         if '\"\"' in self.note_diacritics:
-            expr.append(m21expressions.Fermata)
+            expr.append(get_m21class('expressions', 'Fermata'))
             
         return expr
         
@@ -198,6 +232,8 @@ class Note(TimeInterval):
         return tie in self.note_diacritics
 
 class Chord(object):
+    __slots__ = ('notes', 'arpeggio', 'beamToPrevious')
+    
     def __init__(self, notes, beamed=False): # a list of Note objects
         self.notes = notes
         self.arpeggio = False
@@ -223,56 +259,74 @@ class Chord(object):
             return "chord ({})".format(notes)
 
 class Rest(TimeInterval):
+    __slots__ = ()
+    
     def __str__(self):
         return "(rest [{}/{}])".format(self.length, self.denominator)
 
-class Splitter(object):
+class Splitter(Flyweight):
+    __slots__ = ('length',)
+    
     def __init__(self, length):
         self.length = length
 
     def __str__(self):
         return "space ({}/4)".format(self.length)
 
-class MeasureEnd(object):
+class MeasureEnd(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return "(measure end)"
 
-class SectionEnd(object):
+class SectionEnd(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return "(section end)"
 
-class End(object):
+class End(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return "(end)"
         
 class SystemicBarline(MeasureEnd):
-    pass
+    __slots__ = ()
 
 class DoubleSystemicBarline(SectionEnd):
-    pass
+    __slots__ = ()
     
 class BoldSystemicBarline(End):
-    pass
+    __slots__ = ()
 
-class GrandStaff(object):
+class GrandStaff(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return "(grand staff)"
 
-class RepeatFrom(object):
+class RepeatFrom(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return "||:"
 
-class RepeatTo(object):
+class RepeatTo(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return ":||"
 
 class LongRepeatFrom(RepeatFrom):
-    pass
+    __slots__ = ()
 
 class LongRepeatTo(RepeatTo):
-    pass
+    __slots__ = ()
 
-class RepeatSectionStart(object):
+class RepeatSectionStart(Flyweight):
+    __slots__ = ('n',)
+    
     def __init__(self, n):
         self.n = n # string
     
@@ -282,11 +336,15 @@ class RepeatSectionStart(object):
     def get_m21no(self):
         return self.n
 
-class RepeatSectionEnd(object):
+class RepeatSectionEnd(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return "(repeat section end)"
         
-class KeySignature(object):
+class KeySignature(Flyweight):
+    __slots__ = ('clef', 'signature', 'sharps_or_flats', 'amount', 'signature_notes')
+    
     def __init__(self, clef, signature=0): # signature: an integer in the interval [-7,7]
         self.clef = clef
         self.signature = signature
@@ -315,19 +373,14 @@ class KeySignature(object):
         return "(clef {}, {} {})".format(self.clef, self.amount, self.sharps_or_flats)
     
     def get_m21clef(self):
-        from music21 import clef as m21clef
-        m21clefs = {
-            'G' : m21clef.TrebleClef,
-            'F' : m21clef.BassClef,
-            'C' : m21clef.AltoClef
-        }
-        
-        return m21clefs[self.clef]
+        return get_m21class('clef', clefs_m21[self.clef])
     
     def getm21signature(self):
         return self.signature
 
-class TimeSignature(object):
+class TimeSignature(Flyweight):
+    __slots__ = ('numerator', 'denominator', 'c')
+    
     def __init__(self, numerator, denominator=None):
         self.numerator = numerator
         self.denominator = denominator
@@ -351,7 +404,9 @@ class TimeSignature(object):
         else: # MusicXML does not yet support symbolized times, but it's been implemented
             return self.c
 
-class Dynamic(object):
+class Dynamic(Flyweight):
+    __slots__ = ('dynamic',)
+    
     def __init__(self, dynamic):
         self.dynamic = dynamic
 
@@ -361,7 +416,9 @@ class Dynamic(object):
     def get_m21dynamic(self):
         return self.dynamic
 
-class GradualDynamic(object):
+class GradualDynamic(Flyweight):
+    __slots__ = ('gdynamic',)
+    
     def __init__(self, gdynamic):
         self.gdynamic = gdynamic
 
@@ -371,7 +428,9 @@ class GradualDynamic(object):
     def get_name(self):
         return self.gdynamic
 
-class OctavationStart(object):
+class OctavationStart(Flyweight):
+    __slots__ = ('octaveTranspositions',)
+    
     def __init__(self, octaveTranspositions=1):
         self.octaveTranspositions = octaveTranspositions # for future integration of 'quindicesima'
         
@@ -381,19 +440,27 @@ class OctavationStart(object):
         else:
             return "(8va[{}x])---".format(self.octaveTranspositions) + "{"
 
-class OctavationEnd(object):
+class OctavationEnd(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return "}(8va)"
 
-class Segno(object):
+class Segno(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return "(segno)"
 
-class Coda(object):
+class Coda(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return "(coda)"
 
-class FromTo(object):
+class FromTo(Flyweight):
+    __slots__ = ('varfrom', 'varto')
+    
     def __init__(self, varfrom, varto=None):
         self.varfrom = varfrom
         self.varto = varto
@@ -404,18 +471,57 @@ class FromTo(object):
     def get_m21parameters(self):
         return [self.varfrom, self.varto]
 
-class PedalDown(object):
+class PedalDown(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return '(pedal down)'
 
-class PedalUp(object):
+class PedalUp(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return '(pedal up)'
 
-class Newline(object):
+class Newline(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return '(newline)'
 
-class ErrorSign(object):
+class ErrorSign(Flyweight):
+    __slots__ = ()
+    
     def __str__(self):
         return '(error symbol)'
+
+def _token_structures():
+    from functools import partial
+    table = {
+        punctuation['barline'] : MeasureEnd,
+        punctuation['double_barline'] : SectionEnd,
+        punctuation['bold_double_barline'] : End,
+        punctuation['repeat_from'] : RepeatFrom,
+        punctuation['repeat_to'] : RepeatTo,
+        punctuation['long']['systemic_barline'] : SystemicBarline,
+        punctuation['long']['grand_staff'] : GrandStaff,
+        punctuation['long']['bold_systemic_barline'] : BoldSystemicBarline,
+        punctuation['long']['long_repeat_from'] : LongRepeatFrom,
+        punctuation['long']['long_repeat_to'] : LongRepeatTo,
+        navigation['coda'] : Coda,
+        navigation['segno'] : Segno,
+        pedal['down'] : PedalDown,
+        pedal['up'] : PedalUp,
+        '..' : ErrorSign # internally used to create beams between eighth notes
+    }
+    for token in punctuation['splitters']:
+        table[token] = partial(Splitter, splitter_length[token])
+    for token in punctuation['long']['double_systemic_barline']:
+        table[token] = DoubleSystemicBarline
+    for token, n in repetition.items():
+        table[token] = RepeatSectionEnd if n == 'end' else partial(RepeatSectionStart, n)
+    for token, n in octavation.items():
+        table[token] = partial(OctavationStart, n) if type(n) is int else OctavationEnd
+    return table
+
+token_structures = _token_structures() # context-free tokens : structure constructor
@@ -114,3 +114,18 @@ pedal = {
     'down' : 'p',
     'up' : 'pp'
 }
+
+# -- lookup tables, built once at import
+
+pitch_index = dict((symbol, i) for i, symbol in reversed(list(enumerate(note_range))))
+
+symbol_classes = {} # classification of single symbols inside a note or chord token
+symbol_classes.update((s, 'ignored') for s in simple_punctuation + [punctuation['special_splitter']] if len(s) == 1)
+symbol_classes.update((s, 'diacritic') for s in accidentals_symbols + articulations_symbols + ornaments_symbols + [accent_mark, tie])
+symbol_classes.update({
+    operators['prolonger'] : 'prolonger',
+    operators['inverter'] : 'inverter',
+    note_dot : 'dot',
+    '.' : 'beam'
+})
+symbol_classes.update((s, 'note') for s in note_range)
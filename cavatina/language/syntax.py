@@ -1,9 +1,13 @@
 
 import re
+from bisect import bisect_right
 from .symbols import *
 from .semantics import *
 from .structures import *
+from .tokenizer import iter_tokens
 from ..keyboard_layout import inputTranslate
+from ..io.readRTF import isRTF, lexRTF
+from ..instrumentation import instrumented, stage, countTree
 
 def get_stringPosition(index, stack, expr):
     if len(stack[index]) > 1:
@@ -34,11 +38,10 @@ class SyntaxException(SyntaxError):  # shows error position
 
 
 def get_pitch(symbol):
-    for i in range(len(note_range)):
-        if note_range[i] == symbol:
-            return i
-
-    raise InvalidSymbolError
+    try:
+        return pitch_index[symbol]
+    except KeyError:
+        raise InvalidSymbolError
 
 
 def get_splitter_length(symbol):
@@ -55,93 +58,52 @@ def find_all(s, sub):
         start += len(sub)
 
 
-def generateBoldIndexSet(boldRanges):
-    boldSet = []
-    for start, end in boldRanges:
-        boldSet.extend(range(start, end))
-    return boldSet
+class BoldRegion(object):
+    """
+    Bold characters of a text as sorted, disjoint (start, end) ranges.
+    Membership tests are amortized O(1) when positions are queried in
+    increasing order, as the parser does; other lookups fall back to bisection.
+    """
 
+    def __init__(self, boldRanges=()):
+        self.ranges = [(start, end) for start, end in sorted(boldRanges) if start < end]
+        self.ends = [end for start, end in self.ranges]
+        self.cursor = 0  # index of the first range ending after the last query
+        self.lastPos = 0
+
+    def __contains__(self, pos):
+        ranges = self.ranges
+        i = self.cursor
+        if pos >= self.lastPos:
+            while i < len(ranges) and ranges[i][1] <= pos:
+                i += 1
+        else:
+            i = bisect_right(self.ends, pos)
+        self.cursor = i
+        self.lastPos = pos
+        return i < len(ranges) and ranges[i][0] <= pos
 
-def extractCavatinaString(s, fontNumber):
-    # e.g.: r'\\f0(?:(?!\\f0).)*'
-    rexp = r'\\f' + fontNumber + r'(?:(?!\\f\d).)*'
-    cs = ''
-    for m in re.finditer(rexp, s, re.S):
-        cs += m.group()
-    return cs.rstrip('\n')
+    def __len__(self):
+        return sum(end - start for start, end in self.ranges)
 
 
 def getTextAndRTFBoldRegion(rtf):
     """
-    Lazy parsing of a RTF file, only extracting 'bold' formattings.
+    Parsing of a RTF file, only extracting the Cavatina text and its 'bold'
+    formattings. Plain text input is returned unchanged.
     """
-    fontTableIndex = rtf.find('\\fonttbl')
-    if fontTableIndex == -1:  # input is not in RTF format
-        return [rtf, []]
-
-    cut0 = rtf.find('Cavatina-Regular;', fontTableIndex) - 17
-    fontNumber = rtf[cut0]
-    assert fontNumber.isdigit()
-
-    # trim off metadata
-    cut1 = rtf.find(';}', fontTableIndex)
-    rtf = rtf[cut1:]
-    cut2 = rtf.find('\\f0')
-    rtf = rtf[cut2:]
-
-    rtf = re.sub(r'\\\'..', r'¿', rtf)
-    rtf = re.sub(r'\\\n', r'\n', rtf)
-
-    rtf = extractCavatinaString(rtf, fontNumber)
-
-    cut3 = rtf.find('\\cf0 ')
-    if '\\b' in rtf[:cut3]:  # leading '\b'
-        rtf = '\\b' + rtf[cut3 + 5:]
-    else:
-        rtf = rtf[cut3 + 5:]
-
-    # trim off aditional formatting
-    fmt = False
-    rtfFiltered = ''
-    for i in range(len(rtf)):
-        if not fmt:
-            # catch \\, ignoring the backslash escape sequence
-            if rtf[i] == '\\' and (rtf[i + 1] != '\\' and rtf[i - 1] != '\\'):
-                # all RTF style format strings start with a backslash
-                fmt = True
-            # \n \\ (non-\n character)
-            elif not (rtf[i] == '\n' and rtf[i + 1] == '\\' and rtf[i + 2] != '\n'):
-                # style format strings are preceded by a new line
-                rtfFiltered += rtf[i]
-        else:  # check for format string commands
-            if rtf[i] == 'b' and rtf[i - 1] == '\\':
-                if rtf[i + 1] == ' ' or rtf[i + 1] == '0':
-                    rtfFiltered += '\\b'
-                    fmt = False
-            elif rtf[i] == ' ':  # don't parse until after the format string
-                fmt = False
-    rtf = rtfFiltered[:-1]
-
-    rawMatches = [m.start() for m in re.finditer(r'\\b0?[ \\]', rtf)]
-    unpairedMatches = [x - (i * 3 + i / 2) for i, x in enumerate(rawMatches)]
-
-    txt = re.sub(r'\\b0? ', r'', rtf)
-
-    boldRanges = []
-    i = 0
-    while i * 2 <= len(unpairedMatches) - 1:
-        if i * 2 == len(unpairedMatches) - 1:
-            boldRanges.append((unpairedMatches[i * 2], len(txt)))
-        else:
-            boldRanges.append(
-                (unpairedMatches[i * 2], unpairedMatches[i * 2 + 1]))
-        i += 1
+    if not isRTF(rtf):  # input is not in RTF format
+        return [rtf, BoldRegion()]
 
-    boldIndexSet = generateBoldIndexSet(boldRanges)
-    return [txt, boldIndexSet]
+    txt, boldRanges = lexRTF(rtf)
+    return [txt, BoldRegion(boldRanges)]
 
 
-def tokenize(expr):
+def tokenize_reference(expr):
+    """
+    The original tokenizer, kept as the reference implementation of the
+    grouping rules (see tokenizer.tokenize_tables).
+    """
     if len(expr) <= 1:
         return [expr]
 
@@ -270,10 +232,14 @@ def tokenize(expr):
     return stack
 
 
-def parse(content, inputLanguage=None):
-    rawText, boldIndexSet = getTextAndRTFBoldRegion(content)
+def parse_reference(content, inputLanguage=None):
+    """
+    The original parser, kept as the reference implementation of the
+    grammar (see parse_tokens).
+    """
+    rawText, boldRegion = getTextAndRTFBoldRegion(content)
     usText = inputTranslate(rawText, langFrom=inputLanguage)
-    stack = tokenize(usText)
+    stack = tokenize_reference(usText)
     tree = []
     # this variable is the last defined key signature and affects all
     current_key_signature = KeySignature(clefs['+'])
@@ -437,7 +403,7 @@ def parse(content, inputLanguage=None):
             continue
 
         elif token[0] in rests:
-            if globalPos in boldIndexSet:
+            if globalPos in boldRegion:
                 # Bold weight ~ 1/16 unity
                 if token[:2] == ']]':  # implicit prolongation
                     tree.append(Rest(1, denominator=16))
@@ -476,7 +442,7 @@ def parse(content, inputLanguage=None):
             beamed = False
             try:
                 note_pitch = get_pitch(symbol)
-                if globalPos in boldIndexSet:
+                if globalPos in boldRegion:
                     # Bold weight ~ 1/16 unity
                     if note_pitch >= eighth_note_range:  # eighth notes
                         chord_notes.append(
@@ -526,3 +492,233 @@ def parse(content, inputLanguage=None):
             raise SyntaxException([tokenIndex, stack, ''])
 
     return tree
+
+
+tokenizers = {  # name : callable returning an iterable of tokens
+    'reference': tokenize_reference,
+    'tables': iter_tokens
+}
+default_tokenizer = 'tables'
+
+
+def tokenize(expr, engine=None):
+    """
+    engine: key of *tokenizers*, defaults to *default_tokenizer*
+    """
+    return list(tokenizers[engine or default_tokenizer](expr))
+
+
+@instrumented('parse')
+def parse(content, inputLanguage=None, tokenizer=None):
+    with stage('rtf'):
+        rawText, boldRegion = getTextAndRTFBoldRegion(content)
+    with stage('layout'):
+        usText = inputTranslate(rawText, langFrom=inputLanguage)
+    with stage('tokenize'):
+        tokens = tokenize(usText, tokenizer)
+    with stage('parse'):
+        tree = list(parse_tokens(tokens, ParseState(), boldRegion, lambda: (tokens, rawText)))
+    countTree(tree, tokens)
+    return tree
+
+
+class ParseState(object):
+    """
+    Parsing context carried from one token to the next, and so across
+    separately parsed pieces of a document.
+    """
+
+    def __init__(self, key_signature=None, globalPos=0, previousToken=None):
+        # the last defined key signature affects all succeeding note objects. If no
+        # key signature is yet defined when a note is entered, the G-clef without
+        # accidentals is assumed.
+        self.key_signature = key_signature or KeySignature(clefs['+'])
+        self.globalPos = globalPos  # position of the last parsed token
+        self.previousToken = previousToken  # None at the beginning of the input
+
+
+def parse_iter(content, inputLanguage=None, tokenizer=None):
+    """
+    Generator version of parse: structures are yielded as soon as no later
+    token can modify them anymore (e.g. an arpeggio applies to the previous
+    chord), so only the last recognized structure is held back.
+    """
+    rawText, boldRegion = getTextAndRTFBoldRegion(content)
+    usText = inputTranslate(rawText, langFrom=inputLanguage)
+    tokens = tokenizers[tokenizer or default_tokenizer](usText)
+    return parse_tokens(tokens, ParseState(), boldRegion,
+                        lambda: (tokenize(usText, tokenizer), rawText))
+
+
+def parse_tokens(tokens, state=None, boldRegion=None, source=None):
+    """
+    Yields the structures of an iterable of tokens (see parse_iter).
+    state: ParseState before the first token, updated while parsing
+    source: callable returning the token stack and the text for error messages,
+            by default *tokens* has to be a list
+    """
+    if state is None:
+        state = ParseState()
+    if boldRegion is None:
+        boldRegion = BoldRegion()
+    if source is None:
+        source = lambda: (tokens, ''.join(tokens))
+    tree = []  # structures not yet yielded
+    current_key_signature = state.key_signature
+
+    for tokenIndex, token in enumerate(tokens):
+        if token == '':
+            return
+
+        if len(tree) > 1:
+            last = tree.pop()
+            for structure in tree:
+                yield structure
+            tree = [last]
+
+        previousToken, state.previousToken = state.previousToken, token
+        if previousToken is not None:  # update globalPos
+            state.globalPos += len(previousToken)
+        bold = state.globalPos in boldRegion
+
+        if token == '\n':
+            if previousToken not in (None, '\n'):
+                tree.append(Newline())
+            continue
+
+        structure = token_structures.get(token)
+        if structure is not None:
+            tree.append(structure())
+            continue
+
+        if token[0] in key_symbols:
+            split_token = re.search(r'^([\+_]{1,2})([-|=]*)', token)
+            if (split_token and split_token.group(1) in clefs):
+                sign = 0 if not split_token.group(2) else (
+                    -1 if split_token.group(2)[0] == '-' else
+                    1)  # split_token.group(2)[0] == '='
+                new_key_signature = sign * len(split_token.group(2))
+                tree.append(
+                    KeySignature(clefs[split_token.group(1)], new_key_signature))
+                current_key_signature = KeySignature(
+                    clefs[split_token.group(1)], new_key_signature)
+                state.key_signature = current_key_signature
+                continue
+
+        elif token[0] == time_signature:
+            if len(token) <= 3:
+                if token[1] == 'c':
+                    tree.append(TimeSignature(common_time[token[1:]]))
+                else:
+                    tree.append(TimeSignature(token[1], token[2]))
+            elif (len(token) == 4 or len(token) == 5):
+                if re.search('^12', token[1:]):
+                    token_numerator = 12
+                else:
+                    token_numerator = token[1]
+                if re.search('16$', token):
+                    token_denominator = 16
+                else:
+                    token_denominator = token[-1]
+                tree.append(TimeSignature(token_numerator, token_denominator))
+            else:
+                tree.append(ErrorSign())
+            continue
+
+        elif token[0] in dynamics_symbols:
+            tree.append(Dynamic(dynamics[token]))
+            continue
+
+        elif token[0] in gradual_dynamics_symbols:
+            tree.append(GradualDynamic(gradual_dynamics[token]))
+            continue
+
+        elif token[0] in repeat_reference:
+            if len(token) > 1:
+                tree.append(FromTo(references[token[0]], references[token[1]]))
+            else:
+                tree.append(FromTo(references[token]))
+            continue
+
+        elif token == arpegio and tree and isinstance(tree[-1], Chord):
+            tree[-1].add_arpeggio()
+            continue
+
+        elif token == triplet:
+            # TODO: triplet
+            continue
+
+        elif token[0] in rests:
+            if bold:
+                # Bold weight ~ 1/16 unity
+                if token[:2] == ']]':  # implicit prolongation
+                    tree.append(Rest(1, denominator=16))
+                    token = token[2:]
+
+                for symbol in token:
+                    if symbol == ']':
+                        tree.append(Rest(0, denominator=16))
+                    elif symbol == '}':
+                        tree.append(Rest(1, denominator=16))
+                    elif symbol == note_dot:
+                        tree[-1].add_dot_length()
+                    elif symbol == operators['prolonger']:
+                        tree[-1].increase_length_exponent()
+            else:
+                # Regular weight ~ 1/8 unity
+                if token[:2] == ']]':  # implicit prolongation
+                    tree.append(Rest(1))
+                    token = token[2:]
+
+                for symbol in token:
+                    if symbol == ']':
+                        tree.append(Rest(0))
+                    elif symbol == '}':
+                        tree.append(Rest(1))
+                    elif symbol == note_dot:
+                        tree[-1].add_dot_length()
+                    elif symbol == operators['prolonger']:
+                        tree[-1].increase_length_exponent()
+
+            continue
+
+        chord_notes = []
+
+        for symbolIndex, symbol in enumerate(token):
+            beamed = False
+            symbol_class = symbol_classes.get(symbol)
+
+            if symbol_class == 'note':
+                note_pitch = pitch_index[symbol]
+                # quarter notes are twice as long as eighth notes (regular weight)
+                # or eighth notes twice as long as 16th notes (bold weight ~ 1/16 unity)
+                chord_notes.append(Note(
+                    note_pitch, current_key_signature,
+                    length_exponent=1 if note_pitch >= eighth_note_range else 0,
+                    denominator=16 if bold else 8))
+            elif symbol_class == 'prolonger' and len(chord_notes) > 0:
+                chord_notes[-1].increase_length_exponent()
+            elif symbol_class == 'dot' and len(chord_notes) > 0:
+                chord_notes[-1].add_dot_length()
+            elif symbol_class == 'beam':
+                beamed = True
+            elif symbol_class == 'diacritic' and len(chord_notes) > 0:
+                chord_notes[-1].add_diacritical_mark(symbol)
+            elif symbol_class == 'inverter' and len(chord_notes) > 0:
+                # for the case of inverted ornamentation
+                if token[symbolIndex - 1] in ornaments_symbols:
+                    chord_notes[-1].add_diacritical_mark(symbol)
+                else:  # stem inversion
+                    chord_notes[-1].invertStem()
+            elif symbol_class == 'ignored':  # beams and pseudo-spaces
+                pass
+            else:
+                raise SyntaxException([tokenIndex] + list(source()))
+
+        if len(chord_notes) > 0:
+            tree.append(Chord(chord_notes, beamed))
+        else:
+            raise SyntaxException([tokenIndex, source()[0], ''])
+
+    for structure in tree:
+        yield structure
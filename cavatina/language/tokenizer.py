@@ -0,0 +1,239 @@
+"""
+Table-driven tokenizer. Every grouping rule of the reference tokenizer
+(syntax.tokenize_reference) is registered under the characters that can
+trigger it, so each input character only evaluates the few rules that may
+apply to it. The resulting token stack is identical to the reference one.
+"""
+import re
+from .symbols import *
+from .semantics import *
+
+clef_symbols = frozenset(k[0] for k in clefs)
+note_symbols = frozenset(note_range)
+chord_symbols = frozenset(chord_set)
+dynamic_symbols = frozenset(dynamics_symbols)
+barline_tokens = frozenset([
+    punctuation['barline'],
+    punctuation['double_barline'],
+    punctuation['bold_double_barline']
+])
+long_barline_prefixes = frozenset(simple_punctuation + [punctuation['long']['systemic_barline']])
+
+double_prolongation = re.compile(r'''~[-='"<>\[{`]*~''')
+double_inversion = re.compile(r'''`[-='"<>\[{~]*`''')
+
+prolonger = operators['prolonger']
+inverter = operators['inverter']
+special_splitter = punctuation['special_splitter']
+
+
+def trailing(s, c):
+    """Number of trailing characters *c* in *s*."""
+    return len(s) - len(s.rstrip(c))
+
+
+def ends_with_rest(token, prolongations):
+    """True if *token* ends with ']' followed by at most *prolongations* '~'."""
+    t = trailing(token, prolonger)
+    return t <= prolongations and len(token) > t and token[-1 - t] == rests[0]
+
+
+def ends_with_long_rest(token, prolongations):
+    """True if *token* ends with '}' followed by at most *prolongations* '~'."""
+    t = trailing(token, prolonger)
+    return t <= prolongations and len(token) > t and token[-1 - t] == rests[1]
+
+
+# -- grouping rules: rule(previous, current, stack) -> bool
+
+def new_line(previous, current, stack):
+    return previous == '\\'
+
+
+def same_symbol(previous, current, stack):  # quarter space, double barline, crescendo, pedal up, beam errors, error sign
+    return previous == current
+
+
+def long_barline(previous, current, stack):
+    if current == '\\':
+        return previous in long_barline_prefixes
+    return previous == punctuation['long']['systemic_barline']
+
+
+def c_clef(previous, current, stack):
+    return previous == (key_symbols[1] if current == key_symbols[0] else key_symbols[0])
+
+
+def key_signature(previous, current, stack):
+    return (
+        previous[0] in clef_symbols and
+        previous.count('-') + previous.count('=') < 7 and
+        (previous[-1] in clef_symbols or previous[-1] == current)
+    )
+
+
+def time_signature_context(stack):
+    return len(stack) > 0 and (stack[-1][0] in clef_symbols or stack[-1] in barline_tokens)
+
+
+def time_signature_digit(previous, current, stack):
+    return (
+        (len(previous) <= 2 and previous[0] == time_signature) or
+        (len(previous) == 3 and previous[2] + current == '16') or
+        (previous == '~121' and current == '6')
+    ) and time_signature_context(stack)
+
+
+def time_signature_twelve(previous, current, stack):  # any character follows a numerator 12
+    return len(previous) == 3 and previous[1:3] == '12' and time_signature_context(stack)
+
+
+def common_time(previous, current, stack):
+    return previous == time_signature and time_signature_context(stack)
+
+
+def cut_time(previous, current, stack):
+    return previous[-1] == 'c' and time_signature_context(stack)
+
+
+def chord(previous, current, stack):
+    return previous[0] in chord_symbols
+
+
+def diacritic(previous, current, stack):
+    return previous[0] in note_symbols
+
+
+def note_prolongation(previous, current, stack):
+    return previous[0] in note_symbols and not double_prolongation.search(previous)
+
+
+def ornament_inversion(previous, current, stack):
+    return (
+        previous[0] in note_symbols and
+        len(previous) > 1 and previous[-1] in ornaments_symbols and previous[-2] != '['
+    )
+
+
+def stem_inversion(previous, current, stack):
+    return previous[0] in note_symbols and not double_inversion.search(previous)
+
+
+def mordent_or_trill(previous, current, stack):
+    if previous[0] not in note_symbols or '{' in previous:
+        return False
+    t = trailing(previous, '[')
+    return '[' not in previous or (1 <= t <= 5 and len(previous) > t)
+
+
+def turn(previous, current, stack):
+    return previous[0] in note_symbols and '[' not in previous and '{' not in previous
+
+
+def beam(previous, current, stack):
+    return previous[0] in note_symbols and '..' not in previous
+
+
+def dynamic(previous, current, stack):
+    return previous[0] in dynamic_symbols and (previous + current) in dynamics
+
+
+def repeat_section(previous, current, stack):
+    return previous[-1] == 'o'
+
+
+def repeat_reference_indication(previous, current, stack):
+    return previous in repeat_reference
+
+
+def octavation_mark(previous, current, stack):
+    return previous == 'O'
+
+
+def rest_prolongation(previous, current, stack):
+    return ends_with_rest(previous, 2) or ends_with_long_rest(previous, 1)
+
+
+def rest_dot(previous, current, stack):
+    return ends_with_rest(previous, 3) or ends_with_long_rest(previous, 2)
+
+
+def bold(previous, current, stack):
+    return previous == '\\'
+
+
+grouping_rules = [
+    # (triggering characters, rule), None triggers on every character
+    ('n', new_line),
+    (special_splitter + punctuation['barline'] + punctuation['bold_double_barline'] + 'lp' + rests[0], same_symbol),
+    ('\\' + punctuation['barline'], long_barline),
+    (''.join(key_symbols), c_clef),
+    (''.join(accidentals_symbols), key_signature),
+    (digits, time_signature_digit),
+    (None, time_signature_twelve),
+    ('c', common_time),
+    (prolonger, cut_time),
+    (chord_set, chord),
+    (''.join(all_diacritics), diacritic),
+    (prolonger, note_prolongation),
+    (inverter, ornament_inversion),
+    ('[', mordent_or_trill),
+    ('{', turn),
+    ('.', beam),
+    (inverter, stem_inversion),
+    (''.join(dynamics_symbols) + inverter, dynamic),
+    ('o' + inverter, repeat_section),
+    ('iI', repeat_reference_indication),
+    ('O' + inverter, octavation_mark),
+    (prolonger, rest_prolongation),
+    (note_dot, rest_dot),
+    ('b', bold),
+]
+
+default_rules = tuple(rule for characters, rule in grouping_rules if characters is None)
+rule_table = {}
+for characters, rule in grouping_rules:
+    for c in characters or '':
+        rule_table.setdefault(c, list(default_rules)).append(rule)
+rule_table = dict((c, tuple(rules)) for c, rules in rule_table.items())
+
+
+def iter_tokens(expr):
+    """
+    Yields the tokens of *expr* as soon as no later character can change them.
+    """
+    if len(expr) <= 1:
+        yield expr
+        return
+
+    # Closed tokens still visible to the grouping rules. Two are enough: a
+    # pseudo-space re-opens the last one, and the rules inspect the one before.
+    stack = []
+    previous = expr[0]
+
+    for current in expr[1:]:
+        if (  # pseudo-spaces
+            previous == special_splitter and
+            current in chord_symbols and
+            stack and stack[-1][0] in chord_symbols
+        ):
+            previous = stack.pop() + current  # omit pseudo-space
+            continue
+
+        for rule in rule_table.get(current, default_rules):
+            if rule(previous, current, stack):
+                previous += current
+                break
+        else:
+            if len(stack) == 2:
+                yield stack.pop(0)
+            stack.append(previous)
+            previous = current
+
+    stack.append(previous)
+    for token in stack:
+        yield token
+
+
+def tokenize_tables(expr):
+    return list(iter_tokens(expr))
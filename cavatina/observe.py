@@ -1,31 +1,31 @@
+"""
+Rewrites out/out.txt whenever out/in.txt changes (see io.write.writeFiles).
+For any other files, use watch.py.
+"""
 import time
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-
-import sys
-from os.path import dirname, abspath, join
-sys.path.append(dirname(abspath(__file__)))
+from os.path import join
 
 from .io.write import writeFiles
+from .watch import Watcher, printResult
 
 iodirname = "out"
 
-class ioFolderHandler(FileSystemEventHandler):
-    def on_modified(self, event):
-        idir = join(dirname(abspath(__file__)), iodirname)
-        if event.src_path == idir:
-            print("Change at " + time.strftime("%Y-%m-%d %H:%M:%S"))
-            writeFiles("in.txt", "out.txt", iodirname)
+
+def writeOut(job):
+    filepath = job[0]
+    try:
+        writeFiles("in.txt", "out.txt", iodirname)
+    except Exception as e:
+        return {'input': filepath, 'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+    return {'input': filepath, 'output': join(iodirname, "out.txt"), 'ok': True}
+
 
 if __name__ == "__main__":
-    event_handler = ioFolderHandler()
-    observer = Observer()
-    observer.schedule(event_handler, path=join('.', iodirname), recursive=False)
-    observer.start()
+    watcher = Watcher([join(iodirname, "in.txt")], convert=writeOut, onResult=printResult)
+    watcher.start()
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
\ No newline at end of file
+        watcher.stop()
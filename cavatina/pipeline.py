@@ -0,0 +1,166 @@
+import os
+
+from .language.syntax import ParseState, getTextAndRTFBoldRegion, parse_tokens, tokenize
+from .keyboard_layout import inputTranslate, getLayout
+from .io.cache import digestTokens
+from .io.formats import outputPath, writeNative
+from .instrumentation import instrumented, stage, annotate, countTree, enabled
+
+
+class Pipeline(object):
+    """
+    One conversion of a Cavatina text or RTF document. Every stage (text,
+    tokens, tree, music21 score) is computed when first needed and kept, so
+    any number of outputs can be written from a single read and parse.
+
+    keepTree: False if a single output is written: the structures are then
+              parsed while they are translated or written (see
+              syntax.parse_iter) instead of being kept as a list
+    processes: worker processes translating the score (see
+               translator.translateToMusic21), 1 to translate it here
+    metadata: keyword arguments of translator.setMetadata (scoreTitle,
+              scoreComposer, scoreTempo, scoreInstruments), applied once to
+              the score
+    """
+
+    def __init__(self, content, inputLanguage=None, tokenizer=None, preserveStemDirection=False, keepTree=True,
+                 processes=1, **metadata):
+        self.content = content
+        self.inputLanguage = inputLanguage or getLayout()
+        self.tokenizer = tokenizer
+        self.preserveStemDirection = preserveStemDirection
+        self.keepTree = keepTree
+        self.processes = processes
+        self.metadata = metadata
+        self._text = None
+        self._usText = None
+        self._tokens = None
+        self._digest = None
+        self._tree = None
+        self._score = None
+
+    @classmethod
+    def fromFile(cls, filename, **kwargs):
+        """
+        Input file format may be .txt or .rtf
+        """
+        with open(filename, "rt") as fin:
+            return cls(fin.read(), **kwargs)
+
+    # -- stages
+
+    @property
+    def text(self):
+        """
+        [rawText, boldRegion] of the content (see syntax.getTextAndRTFBoldRegion)
+        """
+        if self._text is None:
+            with stage('rtf'):
+                self._text = getTextAndRTFBoldRegion(self.content)
+        return self._text
+
+    @property
+    def usText(self):
+        if self._usText is None:
+            text = self.text[0]
+            with stage('layout'):
+                self._usText = inputTranslate(text, langFrom=self.inputLanguage)
+        return self._usText
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            usText = self.usText
+            with stage('tokenize'):
+                self._tokens = tokenize(usText, self.tokenizer)
+        return self._tokens
+
+    @property
+    def digest(self):
+        """
+        io.cache.tokenDigest of the content
+        """
+        if self._digest is None:
+            self._digest = digestTokens(self.tokens, self.text[1])
+        return self._digest
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            rawText, boldRegion = self.text
+            tokens = self.tokens
+            with stage('parse'):
+                self._tree = list(parse_tokens(tokens, ParseState(), boldRegion, lambda: (tokens, rawText)))
+            countTree(self._tree, tokens)
+        return self._tree
+
+    def structures(self):
+        """
+        The tree, or unless it is kept a generator parsing it again. A
+        recorded conversion keeps the tree, to time the parse and count it.
+        """
+        if self.keepTree or self._tree is not None or enabled():
+            return self.tree
+        rawText, boldRegion = self.text
+        tokens = self.tokens
+        return parse_tokens(tokens, ParseState(), boldRegion, lambda: (tokens, rawText))
+
+    @property
+    def score(self):
+        if self._score is None:
+            from . import translator
+            score = translator.translateToMusic21(self.structures(), self.preserveStemDirection, self.processes)
+            with stage('metadata'):
+                translator.setMetadata(score, **self.metadata)
+            self._score = score
+        return self._score
+
+    # -- sinks
+
+    def writeText(self, outfilename):
+        """
+        Writes the string representation of the tree, one structure per line.
+        """
+        with open(outfilename, "wt") as fout:
+            fout.write('\n'.join(str(n) for n in self.tree))
+
+    @instrumented('pipeline')
+    def writeStream(self, format='midi', wrtpath=None, cache=None, backend='music21'):
+        """
+        Writes the score in a given format (see translator.writeStream).
+        cache: io.cache.ConversionCache, if given the output is looked up
+               there first and the score is only built on a miss
+        backend: 'music21' or 'native', which writes from the tree without
+                 building the score
+        Returns the path of the written file.
+        """
+        if not wrtpath or os.path.isdir(wrtpath):
+            wrtpath = outputPath(format, wrtpath)
+        annotate(format=format, backend=backend)
+
+        if cache is not None:
+            options = dict(self.metadata)
+            if self.preserveStemDirection:
+                options['preserveStemDirection'] = True
+            if backend != 'music21':
+                options['backend'] = backend
+            key = cache.digestKey(self.digest, format, self.inputLanguage, **options)
+            hit = cache.fetch(key, wrtpath)
+            annotate(cache='hit' if hit else 'miss')
+            if hit:
+                return wrtpath
+
+        if backend == 'native':
+            writeNative(self.structures(), format, wrtpath, preserveStemDirection=self.preserveStemDirection,
+                        **self.metadata)
+        else:
+            from . import translator
+            translator.writeStream(self.score,
+                                   format=format,
+                                   wrtpath=wrtpath,
+                                   scoreTitle=self.metadata.get('scoreTitle'),
+                                   scoreComposer=self.metadata.get('scoreComposer'))
+
+        if cache is not None:
+            cache.store(key, wrtpath)
+        return wrtpath
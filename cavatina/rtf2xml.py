@@ -1,43 +1,56 @@
+import os
+
+fileext = {"musicxml" : ".xml", "xml" : ".xml", "midi" : ".midi", "mid" : ".midi"}
+
+
+def outputFilename(filepath, fmt="musicxml", outdir=None, reserved=()):
+    """
+    Path of the converted *filepath*: the input file name with the extension
+    of *fmt*, next to the input or in *outdir*. A number of at least two
+    digits is appended if that file already exists.
+    reserved: paths to treat as already existing
+    """
+    if not outdir:
+        outdir = os.path.dirname(os.path.abspath(filepath))
+    filename = os.path.splitext(os.path.basename(filepath))[0]
+
+    wrtpath = os.path.join(outdir, filename)
+    nakedpath = wrtpath
+    i = 0
+    while os.path.isfile(nakedpath + fileext[fmt]) or nakedpath + fileext[fmt] in reserved:
+        i += 1
+        nakedpath = wrtpath + ("%02d" % i)
+    return nakedpath + fileext[fmt]
+
+
 if __name__ == '__main__':
     import sys, os
 
     if len(sys.argv) >= 2:
-        from language.syntax import parse
-        import translator
+        # run as a script: make the cavatina package importable
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from cavatina.pipeline import Pipeline
+        from cavatina.io.cache import ConversionCache
 
         # input path
         filepath = sys.argv[1]
-        filedir = os.path.dirname(os.path.abspath(filepath))
-        base = os.path.basename(filepath)
-        filename = os.path.splitext(base)[0]
 
         # extension
         fmt = "musicxml"
-        if len(sys.argv) == 3:
+        if len(sys.argv) >= 3:
             if sys.argv[2] not in ["musicxml", "midi"]:
                 raise SyntaxError(sys.argv[2] + " is not a valid format.")
             fmt = sys.argv[2]
-        fileext = {"musicxml" : ".xml", "xml" : ".xml", "midi" : ".midi", "mid" : ".midi"}
+
+        # worker processes translating the score (0: one per CPU)
+        processes = int(sys.argv[3]) if len(sys.argv) >= 4 else 1
 
         # output path
-        wrtpath = os.path.join(filedir, filename)
-        nakedpath = wrtpath
-        i = 0
-        while os.path.isfile(nakedpath + fileext[fmt]):
-            i += 1
-            nakedpath = wrtpath + ("%02d" % i)
-            if i > 99:
-                break
-        wrtpath = nakedpath + fileext[fmt]
+        wrtpath = outputFilename(filepath, fmt)
 
         # write
-        with open(filepath, "rt") as fin:
-            tree = parse(fin.read())
-            score = translator.translateToMusic21(tree)
-            if len(sys.argv) == 2:
-                translator.writeStream(score, format='musicxml', wrtpath=wrtpath)
-            if len(sys.argv) == 3:
-                translator.writeStream(score, format=sys.argv[2], wrtpath=wrtpath)
+        pipeline = Pipeline.fromFile(filepath, keepTree=False, processes=processes or None)
+        pipeline.writeStream(fmt, wrtpath, ConversionCache.fromEnvironment())
 
     else:
-        print("Usage:\n\t$ python rtf2xml.py [path] [format]\nOutput path is current working directory. Available formats are 'musicxml' (default) and 'midi'.")
+        print("Usage:\n\t$ python rtf2xml.py [path] [format] [processes]\nOutput path is current working directory. Available formats are 'musicxml' (default) and 'midi'.")
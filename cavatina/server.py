@@ -0,0 +1,208 @@
+"""
+Local conversion server: keeps worker processes with music21 imported, so
+that a conversion does not pay for interpreter and library startup.
+
+Usage:
+    $ python -m cavatina.server [-p port] [-j jobs] [-q queue] [-P processes]
+
+API (HTTP on localhost):
+    POST /convert?format=musicxml&layout=US&title=...&composer=...&tempo=90&instruments=Piano,Violin
+        request body: Cavatina text or RTF document (UTF-8)
+        response: the exported file, 400 with the error message for invalid
+                  input, 503 when all workers and queue places are taken
+    GET /status
+        response: JSON with the number of workers and requests in progress
+
+See client.py for a command line client.
+"""
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from .batch import initWorker
+from .io.formats import findFormat
+
+serverVariable = 'CAVATINA_SERVER'  # host:port
+defaultAddress = ('127.0.0.1', 8765)
+
+contentTypes = {
+    'musicxml': 'application/vnd.recordare.musicxml+xml',
+    'midi': 'audio/midi',
+    'lilypond': 'text/x-lilypond',
+    'text': 'text/plain; charset=utf-8'
+}
+
+
+def serverAddress():
+    """
+    (host, port) configured by $CAVATINA_SERVER, or the default address.
+    """
+    address = os.environ.get(serverVariable)
+    if not address:
+        return defaultAddress
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def requestOptions(query):
+    """
+    writeStream / setMetadata arguments of the query string of a request.
+    """
+    options = {}
+    for name, key, parse in (('title', 'scoreTitle', str),
+                             ('composer', 'scoreComposer', str),
+                             ('tempo', 'scoreTempo', int),
+                             ('instruments', 'scoreInstruments', lambda s: s.split(','))):
+        if name in query:
+            options[key] = parse(query[name][-1])
+    return options
+
+
+def convertContent(content, fmt, inputLanguage=None, backend='music21', processes=1, **metadata):
+    """
+    Converts a document in a worker process. Returns the exported bytes.
+    processes: processes translating the document (see Pipeline)
+    """
+    from .pipeline import Pipeline
+    from .io.cache import ConversionCache
+
+    fd, wrtpath = tempfile.mkstemp(suffix=findFormat(fmt)[1])
+    os.close(fd)
+    try:
+        pipeline = Pipeline(content, inputLanguage, keepTree=False, processes=processes, **metadata)
+        pipeline.writeStream(fmt, wrtpath, ConversionCache.fromEnvironment(), backend)
+        with open(wrtpath, 'rb') as f:
+            return f.read()
+    except SyntaxError as e:
+        raise SyntaxError(str(e).strip())  # syntax.SyntaxException cannot be unpickled in the server
+    finally:
+        os.remove(wrtpath)
+
+
+class ConversionServer(ThreadingHTTPServer):
+    """
+    jobs: number of worker processes, by default one per CPU
+    queueSize: number of requests that may wait for a worker; further
+               requests are rejected until a place frees up
+    backend: default backend of the requests, imported by the workers on start
+    processes: processes each worker translates a document with (see
+               translator.translateToMusic21)
+    """
+    daemon_threads = True
+
+    def __init__(self, address=None, jobs=None, queueSize=16, backend='music21', verbose=False, processes=1):
+        ThreadingHTTPServer.__init__(self, address or serverAddress(), RequestHandler)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.backend = backend
+        self.verbose = verbose
+        self.processes = processes
+        self.places = threading.BoundedSemaphore(self.jobs + queueSize)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.executor = ProcessPoolExecutor(self.jobs, initializer=initWorker, initargs=(backend,))
+        self.warm()
+
+    def warm(self):
+        """
+        Starts all workers now rather than on the first requests.
+        """
+        for future in [self.executor.submit(os.getpid) for _ in range(self.jobs)]:
+            future.result()
+
+    def convert(self, content, fmt, inputLanguage=None, backend=None, **metadata):
+        """
+        Returns the exported bytes, or None if the server is saturated.
+        """
+        if not self.places.acquire(False):
+            return None
+        with self.lock:
+            self.active += 1
+        try:
+            return self.executor.submit(convertContent, content, fmt, inputLanguage, backend or self.backend,
+                                        self.processes, **metadata).result()
+        finally:
+            with self.lock:
+                self.active -= 1
+            self.places.release()
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self.executor.shutdown(wait=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def respond(self, status, data, contentType='text/plain; charset=utf-8'):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/status':
+            return self.respond(404, 'Not found')
+        self.respond(200, json.dumps({'jobs': self.server.jobs, 'active': self.server.active}),
+                     'application/json')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/convert':
+            return self.respond(404, 'Not found')
+        query = parse_qs(url.query)
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            content = self.rfile.read(length).decode('utf-8')
+            fmt = findFormat(query.get('format', ['musicxml'])[-1])[0]
+            options = requestOptions(query)
+        except Exception as e:
+            return self.respond(400, '{}: {}'.format(type(e).__name__, e))
+        if fmt not in contentTypes:
+            return self.respond(400, 'Unsupported format')
+        layout = query.get('layout', [None])[-1]
+        backend = query.get('backend', [None])[-1]
+
+        try:
+            data = self.server.convert(content, fmt, layout, backend, **options)
+        except SyntaxError as e:
+            return self.respond(400, str(e))
+        except Exception as e:
+            return self.respond(500, '{}: {}'.format(type(e).__name__, e))
+        if data is None:
+            return self.respond(503, 'Server busy')
+        self.respond(200, data, contentTypes.get(fmt, 'application/octet-stream'))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m cavatina.server', description='Local Cavatina conversion server.')
+    parser.add_argument('-p', '--port', type=int, help='port (default: ${} or {})'.format(serverVariable, defaultAddress[1]))
+    parser.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('-q', '--queue', type=int, default=16, help='requests that may wait for a worker')
+    parser.add_argument('-b', '--backend', default='music21', choices=['music21', 'native'])
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+    parser.add_argument('-P', '--processes', type=int, default=1,
+                        help='processes translating each document (0: one per CPU)')
+    args = parser.parse_args()
+
+    host, port = serverAddress()
+    server = ConversionServer((host, args.port or port), args.jobs, args.queue, args.backend, args.verbose,
+                              args.processes or None)
+    print("Serving on http://{}:{}/ with {} workers".format(host, server.server_address[1], server.jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,7 +1,43 @@
+import copy
+import io
+import json
+import os
+import pickle
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import warnings
+import xml.etree.ElementTree as ET
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 from music21 import *
-from .language.syntax import parse
-from .translator import translateToMusic21
+from .language.syntax import parse, parse_iter, tokenize, getTextAndRTFBoldRegion, BoldRegion
+from .language.symbols import note_range, pitch_index, symbol_classes
+from .language.structures import token_structures, RepeatSectionStart, Flyweight, KeySignature, TimeSignature, \
+    Splitter, MeasureEnd, SystemicBarline, RepeatFrom, RepeatTo, RepeatSectionEnd, FromTo
+from .language.document import Document
+from .io.readRTF import lexRTF
+from .io.cache import ConversionCache, convertCached, tokenDigest
+from .io.writeRTF import writeRTFshort
+from .io.writeMusicXML import MusicXMLWriter
+from .io.writeMIDI import MIDIWriter, ticksPerQuarter
+from .pipeline import Pipeline
+from .batch import convertBatch, findInputs
+from .rtf2xml import outputFilename
+from .watch import Watcher
+from .server import ConversionServer
+from .client import convert, ServerError
+from .instrumentation import Recorder, listeners
+from .fuzz import fuzz, registered, randomDocument, musicXMLNotes, midiNotes, shrink, differences
+from .benchmark import syntheticScore, countNotes, runBenchmark, compareResults, scalingExponent
+from .translator import translateToMusic21, MeasureBuilder, RepeatEndingError, RepeatEndingWarning, splitParts, \
+    translateParts, splitSegments, translateSegments, translatePart, translateSegment, WorkerError
 
 testStrings = {
     'key signatures' : '+------- F F F,_-- F F F,+_= F F F,',
@@ -182,6 +218,26 @@ class GlobalTester(unittest.TestCase):
         t = parse(s)
         score = translateToMusic21(t)
         _show(score)
+        # every duration of a chord is an octave higher
+        pitches = lambda s: [[str(p) for p in n.pitches] for n in translateToMusic21(parse(s)).recurse().notes]
+        self.assertEqual(pitches('9X'), [['D7'], ['D3']])
+        self.assertEqual(pitches('O9X'), [['D8'], ['D4']])
+
+    def testLineBreaks(self):
+        def measures(s):
+            part = translateToMusic21(parse(s)).parts[0]
+            return [(m.number, m.offset, [str(p) for p in m.recurse().pitches], isinstance(m.rightBarline, bar.Repeat))
+                    for m in part.getElementsByClass(stream.Measure)]
+
+        # a line going on without a barline keeps its notes
+        self.assertEqual(measures(',\n5'), [(0, 0.0, ['G6'], False)])
+        self.assertEqual(measures(',\ns d,'), [(0, 0.0, ['D4', 'E4'], False)])
+        self.assertEqual(measures(', A A A A,\nB B.'), [(0, 0.0, ['C4'] * 4, False), (1, 4.0, ['G3'] * 2, False)])
+        # a closing barline opening the line ends the previous measure
+        self.assertEqual(measures(', A A A A,\n: B B.'), [(0, 0.0, ['C4'] * 4, True), (1, 4.0, ['G3'] * 2, False)])
+        for s in ['w 3<}~~,\n:m Z', 'w 3<}~~,\n.m Z']:
+            self.assertEqual([m[:2] for m in measures(s)], [(0, 0.0), (1, 5.25)])
+            musicxml.m21ToXml.GeneralObjectExporter(translateToMusic21(parse(s))).parse()
         
     def testPedal(self):
         pass
@@ -216,6 +272,884 @@ class GlobalTester(unittest.TestCase):
                 self.assertEqual(len(score.parts), 2)
             _show(score)
 
+    def testPartRegistry(self):
+        # signatures are remembered for any number of parts
+        s = ',+ D,\n,\\_ F,\\\n,\\+ G,\\\n,\\_ A,\\\n,\\+ B,\\'
+        score = translateToMusic21(parse(s))
+        self.assertEqual(len(score.parts), 5)
+        self.assertEqual(len(score.getElementsByClass(layout.StaffGroup)), 1)
+        # repeat brackets in a part do not hide its measures
+        s = ', A A,o A A o`,oo A A o`, B B, Gh A,'
+        part = translateToMusic21(parse(s)).parts[0]
+        self.assertEqual([m.number for m in part.getElementsByClass(stream.Measure)], [0, 1, 2, 3, 4])
+        self.assertEqual(len(part.getElementsByClass(spanner.RepeatBracket)), 2)
+
+    def testRepeatEndings(self):
+        def brackets(s):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                score = translateToMusic21(parse(s))
+            return [[(rb.number, [m.number for m in rb.getSpannedElements()])
+                     for rb in p.getElementsByClass(spanner.RepeatBracket)] for p in score.parts], \
+                [type(w.message) for w in caught]
+
+        self.assertEqual(brackets(', A,oo B o`,o C, o`,'), ([[('2', [1]), ('1', [2])]], []))
+        # endings closed in another part are placed in that part
+        self.assertEqual(brackets(', A,oo B o`,\n,\\ C,o D,\\\n, E,\n,\\ F o`,\\'),
+                         ([[('2', [1])], [('1', [1, 2])]], []))
+        # invalid endings are still placed, with a warning
+        self.assertEqual(brackets(', A A,o A A,'), ([[]], [RepeatEndingWarning]))
+        self.assertEqual(brackets(',oo A o`,\n,\\oo B,\\\n, C o`,\n,\\ D,\\'),
+                         ([[('2', [0]), ('2', [0, 1])], []], [RepeatEndingWarning]))
+        self.assertRaises(RepeatEndingError, translateToMusic21, parse(', A A o`,'))
+        # an ending closed by the final barline keeps its number, and no empty measure follows
+        for s, numbers, expected in [('_==,oo.', [0, 1], ('2', [1])), ('+--,U m,oo.', [0, 1, 2], ('2', [2]))]:
+            part = translateToMusic21(parse(s)).parts[0]
+            self.assertEqual([m.number for m in part.getElementsByClass(stream.Measure)], numbers)
+            self.assertEqual(brackets(s), ([[expected]], []))
+
+    def testParallelParts(self):
+        # parts translated by worker processes make the same score
+        def export(score):
+            xml = musicxml.m21ToXml.GeneralObjectExporter(score).parse().decode('utf-8')
+            return re.sub(r'<encoding-date>.*?</encoding-date>| id="[^"]*"', '', xml)
+
+        for s in [testStrings['grand staff']['muliple parts'][0],
+                  ',+ A; B, C,o D o`,oo E :,\n,\\_ F; G, H,o J o`,oo K :,\\\n,+ Q,\n,\\_ W,\\']:
+            tree = parse(s)
+            structures, events = splitParts(tree)
+            self.assertTrue(len(structures) > 1)
+            self.assertEqual(export(translateParts(structures, events, processes=2)), export(translateToMusic21(tree)))
+        # an ending continued in another part needs the whole tree
+        self.assertIsNone(splitParts(parse(',o A,\n,\\_ B o`,\\')))
+        # the error of a part is raised as by the serial translation
+        tree = parse(',+ A A o`,\n,\\_ F,\\')
+        structures, events = splitParts(tree)
+        self.assertRaises(WorkerError, translatePart, (structures[0], False))
+        self.assertRaises(RepeatEndingError, translateToMusic21, tree, processes=2)
+
+    def testParallelSegments(self):
+        # sections translated by worker processes make the same part
+        def export(score):
+            xml = musicxml.m21ToXml.GeneralObjectExporter(score).parse().decode('utf-8')
+            return re.sub(r'<encoding-date>.*?</encoding-date>| id="[^"]*"', '', xml)
+
+        for s in [',+~34 A B C,, D E F,\n,+ G A B,, C D E,o F G A o`,,\n, B C D,, DO E F G, A B C.\n,_~44 D E F G,, A B C.',
+                  ', A B,, C D,,\n, E F,,\n\n, G,, A,']:
+            tree = parse(s)
+            segments = splitSegments(tree, 4)
+            self.assertTrue(len(segments) > 1)
+            self.assertEqual(export(translateSegments(segments, processes=2)), export(translateToMusic21(tree)))
+        # no cut inside an ending, nor in a score of several parts
+        self.assertEqual(len(splitSegments(parse(',o A,, B o`,,'), 2)), 1)
+        self.assertIsNone(splitSegments(parse(', A,, B,\n,\\ C,, D,\\'), 2))
+        # the error of a segment is raised as by the serial translation, with the measure numbers of the score
+        tree = parse(', A,, B,, C o`,, D,')
+        segments = splitSegments(tree, 4)
+        self.assertRaises(WorkerError, translateSegment, (segments[2], False))
+        with self.assertRaises(RepeatEndingError) as cm:
+            translateToMusic21(tree, processes=2)
+        self.assertEqual(str(cm.exception), 'Ending closed in measure 2 but none is open')
+
+    def testChordVoices(self):
+        # each duration of a chord gets its own voice, at the offset of the chord
+        m = translateToMusic21(parse(', Gh A, Y~Ty D,')).parts[0].getElementsByClass(stream.Measure)
+        self.assertEqual([v.id for v in m[0].voices], [1, 2])
+        self.assertEqual([(n.offset, n.quarterLength) for n in m[0].voices[0].notes], [(0.0, 1.0), (1.0, 1.0)])
+        self.assertEqual([(n.offset, n.quarterLength) for n in m[0].voices[1].notes], [(0.0, 0.5)])
+        self.assertEqual([[n.offset for n in v.notes] for v in m[1].voices], [[0.0, 2.0], [0.0], [0.0]])
+        self.assertFalse(translateToMusic21(parse(', GH A,')).parts[0].getElementsByClass(stream.Measure)[0].voices)
+        # what follows a chord comes after its longest duration
+        m = translateToMusic21(parse(', dG~} A,')).parts[0].getElementsByClass(stream.Measure)
+        self.assertEqual([e.offset for e in m[0].voices[0].notesAndRests], [0.0, 2.0, 3.0])
+        # a measure running past its bar keeps its chords side by side, as music21 cannot tie voices over
+        for s in ['sD f~~ ]~~', 'a~~ sD]~~', ', a~~ sD]~~,', ']<7 @ N< $_w bZ', '_~34, Gh A S D,',
+                  ',+ F f dG~} A,\n,\\_ F f dG~} A,\\']:
+            score = translateToMusic21(parse(s))
+            self.assertFalse(any(m.voices for m in score.recurse().getElementsByClass(stream.Measure)
+                                 if m.highestTime > m.barDuration.quarterLength))
+            musicxml.m21ToXml.GeneralObjectExporter(score).parse()
+
+    def testMeasureBuilder(self):
+        # a builder orders its elements as the measure it builds would
+        def operations():
+            yield 'append', note.Note('C', quarterLength=1)
+            yield 'append', dynamics.Dynamic('p')
+            yield 'append', chord.Chord(['E', 'G'], quarterLength=0.5)
+            yield 'insert', 1.0, chord.Chord(['C5'], quarterLength=2)
+            yield 'insert', 1.0, dynamics.Dynamic('f')
+            yield 'insert', 0.0, key.KeySignature(2)
+            yield 'append', note.Rest(quarterLength=0.25)
+            yield 'append', repeat.Coda()
+
+        builder = MeasureBuilder(3)
+        m = stream.Measure()
+        for built, direct in zip(operations(), operations()):
+            getattr(builder, built[0])(*built[1:])
+            getattr(m, direct[0])(*direct[1:])
+            self.assertIs(type(builder[-1]), type(m[-1]))
+            self.assertEqual(builder.offsetOf(-1), m[-1].offset)
+        self.assertEqual(len(builder), len(m))
+        self.assertEqual(builder.highestTime, m.highestTime)
+        built = builder.build()
+        self.assertEqual(built.number, 3)
+        self.assertEqual([(e.offset, type(e)) for e in built], [(e.offset, type(e)) for e in m])
+
+class FactoryTester(unittest.TestCase):
+    def testNotesAreIndependent(self):
+        score = translateToMusic21(parse(', a- a- a-\' a-, A A- A,'))
+        notes = list(score.parts[0].recurse().notes)
+        self.assertEqual([n.nameWithOctave for n in notes], ['C-4', 'C-4', 'C-4', 'C-4', 'C4', 'C-4', 'C4'])
+        self.assertEqual([n.quarterLength for n in notes], [0.5] * 4 + [1.0] * 3)
+        self.assertTrue(notes[0].pitch is not notes[1].pitch)
+        self.assertTrue(notes[0].duration is not notes[1].duration)
+        self.assertEqual([type(a) for a in notes[2].articulations], [articulations.Staccato])
+
+        notes[0].transpose('p8', inPlace=True)
+        notes[4].quarterLength = 2.0
+        notes = list(translateToMusic21(parse(', a- A,')).parts[0].recurse().notes)
+        self.assertEqual(notes[0].nameWithOctave, 'C-4')
+        self.assertEqual(notes[1].quarterLength, 1.0)
+
+    def testAccidentals(self):
+        # written accidentals and those of the key signature are spelled in the pitch
+        for s, expected in [('a- s= d,', [('C-4', 59), ('D#4', 63), ('E4', 64)]),
+                            ('a-- s== d-= f,', [('C--4', 58), ('D##4', 64), ('E4', 64), ('F4', 65)]),
+                            ('+----, a s-= d,', [('C4', 60), ('D4', 62), ('E-4', 63)])]:
+            notes = translateToMusic21(parse(s)).recurse().notes
+            self.assertEqual([(n.nameWithOctave, n.pitch.midi) for n in notes], expected)
+
+
+class RTFTester(unittest.TestCase):
+    def testPlainText(self):
+        s = testStrings['chords']['eighths']
+        txt, boldRegion = getTextAndRTFBoldRegion(s)
+        self.assertEqual(txt, s)
+        self.assertEqual(len(boldRegion), 0)
+
+    def testBoldRegions(self):
+        rtf = writeRTFshort([(c, c in 'sdf') for c in 'as,\nd f\\'])
+        txt, boldRanges = lexRTF(rtf)
+        self.assertEqual(txt, 'as,\nd f\\')
+        self.assertEqual(boldRanges, [(1, 2), (4, 5), (6, 7)])
+        boldRegion = getTextAndRTFBoldRegion(rtf)[1]
+        self.assertEqual([i for i in range(len(txt)) if i in boldRegion], [1, 4, 6])
+
+    def testBoldRegionLookup(self):
+        boldRegion = BoldRegion([(8, 10), (2, 5)])
+        self.assertEqual(len(boldRegion), 5)
+        self.assertEqual([i for i in range(12) if i in boldRegion], [2, 3, 4, 8, 9])
+        self.assertTrue(3 in boldRegion)  # backwards lookup
+        self.assertFalse(7 in boldRegion)
+
+    def testEscapes(self):
+        rtf = writeRTFshort([(c, False) for c in u'\u00f6{}\u03bc'])
+        self.assertEqual(lexRTF(rtf)[0], u'\u00f6{}\u03bc')
+
+    def testFontSelection(self):
+        rtf = (r'{\rtf1\ansi{\fonttbl\f0\fswiss Helvetica;\f1\fnil Cavatina-Regular;}'
+               r'{\*\expandedcolortbl;;}\f0 title\par \f1 a {\b s}d\par\f0 x\f1 f}')
+        self.assertEqual(lexRTF(rtf), ('a sd\nf', [(2, 3)]))
+
+
+class TokenizerTester(unittest.TestCase):
+    def testEnginesAgree(self):
+        for s in _strings(testStrings):
+            self.assertEqual(tokenize(s, 'tables'), tokenize(s, 'reference'))
+
+    def testGroupingRules(self):
+        s = r'_+-- ~128 d[[[` ]~< \\| oo` O` ki ,,\ a/s'
+        self.assertEqual(tokenize(s, 'tables'), tokenize(s, 'reference'))
+        self.assertEqual(tokenize(s, 'tables')[-1], 'as')  # pseudo-space
+
+
+class ParseIterTester(unittest.TestCase):
+    def testSameAsParse(self):
+        for s in _strings(testStrings):
+            self.assertEqual([str(n) for n in parse_iter(s)], [str(n) for n in parse(s)])
+
+    def testMutations(self):
+        structures = list(parse_iter(', ADGP ]~<,'))
+        self.assertTrue(structures[2].arpeggio)
+        self.assertEqual(str(structures[4]), '(rest [3/8])')
+
+    def testLazy(self):
+        structures = parse_iter(', d' * 10000 + ' >')  # invalid symbol at the end
+        self.assertEqual(str(next(structures)), '(measure end)')
+        self.assertRaises(SyntaxError, list, structures)
+
+
+class DocumentTester(unittest.TestCase):
+    def assertParsed(self, doc, content=None):
+        content = content or doc.raw
+        self.assertEqual([str(n) for n in doc.tree()], [str(n) for n in parse(content)])
+        self.assertEqual(doc.tokens(), tokenize(doc.raw))
+
+    def testEdits(self):
+        doc = Document('+--~44, A S D,\n, F G H,\n\n, J Q,')
+        segments = list(doc.segments)
+        doc.edit(21, 22, 'W')  # H -> W
+        self.assertParsed(doc)
+        self.assertTrue(doc.segments[0] is segments[0])
+        self.assertTrue(doc.segments[3] is segments[3])
+        doc.edit(20, 20, '\n, d')
+        self.assertParsed(doc)
+        doc.edit(0, 0, ', a a,\n')
+        self.assertParsed(doc)
+
+    def testKeySignatureContext(self):
+        doc = Document('+--~44, A,\n, A,')
+        doc.edit(1, 3, '==')  # flats -> sharps
+        self.assertParsed(doc)
+        self.assertEqual(str(doc.tree()[-2]), 'chord (C(s)4 [2/8])')
+
+    def testRTF(self):
+        doc = Document(writeRTFshort([(c, c == 'd') for c in ', a d,\n, d f,']))
+        rtf = writeRTFshort([(c, c == 'f') for c in ', a d,\n, d f,'])
+        doc.update(rtf)
+        self.assertParsed(doc, rtf)
+
+
+class CacheTester(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testKey(self):
+        cache = ConversionCache(self.directory)
+        rtf = writeRTFshort([(c, False) for c in ', a s,'])
+        self.assertEqual(cache.key(rtf, 'midi'), cache.key(rtf.replace('\\fs288', '\\fs100'), 'midi'))
+        self.assertEqual(cache.key(rtf, 'midi'), cache.key(', a s,', 'midi'))
+        self.assertNotEqual(cache.key(rtf, 'midi'), cache.key(', a s,', 'musicxml'))
+        self.assertNotEqual(cache.key(', a s,', 'midi'), cache.key(', a s,', 'midi', scoreTempo=90))
+        bold = writeRTFshort([(c, c == 'a') for c in ', a s,'])
+        self.assertNotEqual(cache.key(rtf, 'midi'), cache.key(bold, 'midi'))
+
+    def testConvertCached(self):
+        cache = ConversionCache(self.directory)
+        wrtpath = os.path.join(self.directory, 'out.mid')
+        calls = []
+
+        def convert():
+            calls.append(1)
+            with open(wrtpath, 'wb') as f:
+                f.write(b'MThd')
+
+        self.assertFalse(convertCached(cache, ', a s,', 'midi', wrtpath, convert))
+        os.remove(wrtpath)
+        self.assertTrue(convertCached(cache, ', a s,', 'midi', wrtpath, convert))
+        self.assertEqual(len(calls), 1)
+        with open(wrtpath, 'rb') as f:
+            self.assertEqual(f.read(), b'MThd')
+        self.assertEqual((cache.hits, cache.misses, cache.writes), (1, 1, 1))
+
+    def testEviction(self):
+        cache = ConversionCache(self.directory, maxBytes=100)
+        for i in range(5):
+            key = cache.key(', a' * (i + 1), 'midi')
+            cache.put(key, b'x' * 40)
+            os.utime(cache.path(key), (i, i))  # distinct last-use times
+        self.assertEqual(len(list(cache.entries())), 2)
+        self.assertEqual(cache.evictions, 3)
+        self.assertEqual(cache.get(cache.key(', a' * 5, 'midi')), b'x' * 40)
+
+    def testEvictionScans(self):
+        cache = ConversionCache(self.directory, maxBytes=1000)
+        entries, scans = cache.entries, []
+
+        def countedEntries():
+            scans.append(1)
+            return entries()
+
+        cache.entries = countedEntries
+        for i in range(100):
+            cache.put('{:064x}'.format(i), b'x' * 40)
+        self.assertEqual(len(list(entries())), 24)
+        self.assertTrue(len(scans) <= 25, len(scans))  # instead of one per put
+        self.assertTrue(cache.size <= 1000)
+
+
+class PipelineTester(unittest.TestCase):
+    def testStages(self):
+        content = writeRTFshort([(c, c == 'a') for c in ', a s~ D,'])
+        pipeline = Pipeline(content)
+        self.assertTrue(pipeline.tokens is pipeline.tokens)
+        self.assertTrue(pipeline.tree is pipeline.tree)
+        self.assertEqual([str(n) for n in pipeline.tree], [str(n) for n in parse(content)])
+        self.assertEqual(pipeline.digest, tokenDigest(content))
+
+    def testWriteText(self):
+        directory = tempfile.mkdtemp()
+        try:
+            outfilename = os.path.join(directory, 'out.txt')
+            pipeline = Pipeline(testStrings['key signatures'])
+            pipeline.writeText(outfilename)
+            with open(outfilename) as f:
+                self.assertEqual(f.read(), '\n'.join(str(n) for n in parse(testStrings['key signatures'])))
+        finally:
+            shutil.rmtree(directory)
+
+    def testCacheHit(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ConversionCache(directory)
+            wrtpath = os.path.join(directory, 'out.mid')
+            cache.put(cache.key(', a s,', 'midi', scoreTempo=90), b'MThd')
+            pipeline = Pipeline(', a s,', scoreTempo=90)
+            self.assertEqual(pipeline.writeStream('midi', wrtpath, cache), wrtpath)
+            self.assertTrue(pipeline._score is None)  # nothing translated
+            with open(wrtpath, 'rb') as f:
+                self.assertEqual(f.read(), b'MThd')
+            # stem directions change the output
+            Pipeline(', a s,', preserveStemDirection=True, scoreTempo=90).writeStream('midi', wrtpath, cache)
+            with open(wrtpath, 'rb') as f:
+                self.assertNotEqual(f.read(), b'MThd')
+        finally:
+            shutil.rmtree(directory)
+
+
+    def testProcesses(self):
+        s = ',+ A; B, C,o D o`,\n,\\_ F; G, H,o J o`,\\'
+        scores = [musicxml.m21ToXml.GeneralObjectExporter(Pipeline(s, processes=p).score).parse().decode('utf-8')
+                  for p in (1, 2)]
+        self.assertEqual(*[re.sub(r'<encoding-date>.*?</encoding-date>| id="[^"]*"', '', x) for x in scores])
+
+    def testSingleOutput(self):
+        directory = tempfile.mkdtemp()
+        try:
+            outputs = []
+            for keepTree in (True, False):
+                wrtpath = os.path.join(directory, '{}.xml'.format(keepTree))
+                pipeline = Pipeline(testStrings['grand staff']['muliple parts'][0], keepTree=keepTree)
+                pipeline.writeStream('musicxml', wrtpath, backend='native')
+                self.assertEqual(pipeline._tree is None, not keepTree)  # parsed while written
+                with open(wrtpath) as f:
+                    outputs.append(f.read())
+            self.assertEqual(outputs[0], outputs[1])
+        finally:
+            shutil.rmtree(directory)
+
+
+class MusicXMLTester(unittest.TestCase):
+    def _write(self, s, **options):
+        f = io.StringIO()
+        MusicXMLWriter(f, **options).write(parse(s))
+        return ET.fromstring(f.getvalue())
+
+    def testWellFormed(self):
+        for s in _strings(testStrings):
+            score = self._write(s)
+            self.assertEqual(score.tag, 'score-partwise')
+            self.assertTrue(len(score.findall('part')) > 0)
+
+    def testNotes(self):
+        score = self._write(', DG~ a-\' s=.., A`,', scoreTempo=90)
+        notes = score.findall('part/measure/note')
+        self.assertEqual([n.findtext('duration') for n in notes], ['8', '4', '4', '16', '8'])
+        self.assertEqual(notes[3].findtext('voice'), '2')  # overlapping chord voice
+        self.assertEqual(notes[1].find('pitch/alter').text, '-1')
+        self.assertTrue(notes[1].find('notations/articulations/staccato') is not None)
+        self.assertEqual([n.findtext('beam') for n in notes[1:3]], ['begin', 'end'])
+        self.assertEqual(score.find('part/measure/direction/sound').get('tempo'), '90')
+
+    def testGrandStaff(self):
+        score = self._write(testStrings['grand staff']['muliple parts'][0])
+        self.assertEqual(len(score.findall('part')), 3)
+        self.assertEqual(score.findtext('part-list/part-group/group-symbol'), 'line')
+
+    def testEndings(self):
+        score = self._write(testStrings['repetition markings']['endings'][0])
+        endings = score.findall('part/measure/barline/ending')
+        self.assertEqual([(e.get('number'), e.get('type')) for e in endings],
+                         [('1', 'start'), ('1', 'discontinue'), ('2', 'start'), ('2', 'stop')])
+
+    def testBoundedMemory(self):
+        writer = MusicXMLWriter(io.StringIO())
+        for structure in parse_iter(', a s d f' * 2000 + ','):
+            writer.add(structure)
+            self.assertTrue(len(writer.part.measures) <= 2)
+        writer.close()
+
+    def testSpoolsClosedOnError(self):
+        def tree():
+            yield from parse_iter(testStrings['grand staff']['simple'][1])
+            raise ValueError('bad input')
+        writer = MusicXMLWriter(io.StringIO())
+        self.assertRaises(ValueError, writer.write, tree())
+        self.assertEqual(len(writer.parts), 2)
+        self.assertTrue(all(part.spool.closed for part in writer.parts))
+        self.assertTrue(MusicXMLWriter(io.StringIO()).part.spool is None)  # nothing to close before write
+
+
+class MIDITester(unittest.TestCase):
+    def _write(self, s, **options):
+        f = io.BytesIO()
+        MIDIWriter(f, **options).write(parse(s))
+        return f.getvalue()
+
+    def _notes(self, data):
+        """
+        [(start, end, key)] of the notes in each track
+        """
+        tracks = []
+        pos = 14
+        while pos < len(data):
+            length = int.from_bytes(data[pos + 4:pos + 8], 'big')
+            track = data[pos + 8:pos + 8 + length]
+            pos += 8 + length
+            i, tick, sounding, notes = 0, 0, {}, []
+            while i < len(track):
+                delta = 0
+                while True:
+                    delta = (delta << 7) | (track[i] & 0x7F)
+                    i += 1
+                    if not track[i - 1] & 0x80:
+                        break
+                tick += delta
+                if track[i] == 0xFF:
+                    i += 3 + track[i + 2]
+                    continue
+                status, key = track[i] & 0xF0, track[i + 1]
+                if status == 0x90:
+                    sounding[key] = tick
+                else:
+                    notes.append((sounding.pop(key), tick, key))
+                i += 3
+            tracks.append(sorted(notes))
+        return tracks
+
+    def testHeader(self):
+        for s in _strings(testStrings):
+            data = self._write(s)
+            self.assertEqual(data[:4], b'MThd')
+            self.assertEqual(int.from_bytes(data[12:14], 'big'), ticksPerQuarter)
+            self.assertEqual(len(self._notes(data)), int.from_bytes(data[10:12], 'big'))
+        data = self._write(testStrings['grand staff']['muliple parts'][0])
+        self.assertEqual(len(self._notes(data)), 4)  # tempo track and three parts
+
+    def testNotes(self):
+        q = ticksPerQuarter
+        notes = self._notes(self._write(', DG~ a-\' s=.., A`,'))[1]
+        self.assertEqual(notes, [(0, q, 64), (0, 2 * q, 67), (2 * q, 2 * q + q // 2, 59),
+                                 (2 * q + q // 2, 3 * q, 63), (3 * q, 4 * q, 60)])
+
+    def testTies(self):
+        q = ticksPerQuarter
+        self.assertEqual(self._notes(self._write(', aL a aL a a,'))[1],
+                         [(0, q, 60), (q, 2 * q, 60), (2 * q, 2 * q + q // 2, 60)])
+        self.assertEqual(self._notes(self._write(', aL , a ,'))[1], [(0, q, 60)])  # across the barline
+
+    def testChannels(self):
+        writer = MIDIWriter(io.BytesIO())
+        while len(writer.parts) < 40:
+            writer.newPart()
+        channels = [writer.channel(part) for part in writer.parts]
+        self.assertEqual(channels[:15], [0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12, 13, 14, 15])
+        self.assertEqual(channels[15:30], channels[:15])
+        self.assertFalse(9 in channels)  # percussion
+
+    def _music21MIDI(self, s):
+        """
+        MIDI file music21 writes for *s*
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = translateToMusic21(parse(s)).write('midi', fp=os.path.join(directory, 'out.mid'))
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            shutil.rmtree(directory)
+
+    def testAgainstMusic21(self):
+        jumps = (RepeatFrom, RepeatTo, RepeatSectionStart, RepeatSectionEnd, FromTo)
+        for s in _strings(testStrings):
+            if any(isinstance(e, jumps) for e in parse(s)):
+                continue  # played out by music21, see below
+            self.assertEqual(midiNotes(self._write(s)), midiNotes(self._music21MIDI(s)))
+        rng = random.Random(0)
+        for _ in range(20):
+            s = randomDocument(rng, noise=0)
+            try:
+                tree = list(parse(s))
+                translateToMusic21(tree)
+            except Exception:
+                continue
+            if not any(isinstance(e, jumps) for e in tree):
+                self.assertEqual(midiNotes(self._write(s)), midiNotes(self._music21MIDI(s)), s)
+
+    def testRepeatsAsNotated(self):
+        # music21 plays repeats out, the native file keeps them as written
+        s = '+, a s d f :, g h j.'
+        self.assertEqual(len(midiNotes(self._music21MIDI(s))[0]), 11)
+        self.assertEqual(midiNotes(self._write(s)), midiNotes(self._music21MIDI(s.replace(':', ''))))
+
+
+class ImportTester(unittest.TestCase):
+    def _modules(self, code):
+        """
+        Names of the modules loaded after running *code* in a fresh interpreter
+        """
+        code = code + '\nimport sys\nprint(" ".join(sys.modules))'
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.check_output([sys.executable, '-c', code], cwd=root).decode().split()
+
+    def testParseWithoutMusic21(self):
+        modules = self._modules('from cavatina.language.syntax import parse\n'
+                                'from cavatina.language.document import Document\n'
+                                'parse("+-- F F F, A\' S- D F; A A A A.")\n'
+                                'Document(", DG~ a s,").tree()')
+        self.assertTrue('cavatina.language.syntax' in modules)
+        self.assertFalse('music21' in modules)
+
+    def testTextAndNativeOutputWithoutMusic21(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'in.txt'), 'wt') as f:
+            f.write(', a s d f,')
+        modules = self._modules('from cavatina.io.write import writeFiles\n'
+                                'from cavatina.pipeline import Pipeline\n'
+                                'writeFiles("in.txt", "out.txt", {0!r}, None)\n'
+                                'Pipeline(", a s,").writeStream("musicxml", {0!r}, backend="native")\n'
+                                'Pipeline(", a s,").writeStream("midi", {0!r}, backend="native")'.format(directory))
+        self.assertTrue(os.path.isfile(os.path.join(directory, 'out.txt')))
+        self.assertTrue(os.path.isfile(os.path.join(directory, 'untitled.musicxml')))
+        self.assertTrue(os.path.isfile(os.path.join(directory, 'untitled.mid')))
+        self.assertFalse('music21' in modules)
+        self.assertFalse('cavatina.translator' in modules)
+
+
+class StructuresTester(unittest.TestCase):
+    def testSlots(self):
+        for s in _strings(testStrings):
+            for structure in parse(s):
+                self.assertFalse(hasattr(structure, '__dict__'))
+
+    def testFlyweights(self):
+        self.assertTrue(KeySignature('F', -2) is KeySignature('F', -2))
+        self.assertTrue(TimeSignature('c') is TimeSignature('c'))
+        self.assertTrue(Splitter(4) is not Splitter(2))
+        self.assertTrue(MeasureEnd() is not SystemicBarline())
+        notes = [n for s in parse('+-- F F, F F.') if hasattr(s, 'notes') for n in s]
+        self.assertTrue(all(n.key_signature is notes[0].key_signature for n in notes))
+
+    def testCopies(self):
+        for s in _strings(testStrings):
+            tree = parse(s)
+            for copied in (pickle.loads(pickle.dumps(tree)), copy.deepcopy(tree)):
+                self.assertEqual([str(c) for c in copied], [str(t) for t in tree])
+                for c, t in zip(copied, tree):
+                    if isinstance(t, Flyweight):
+                        self.assertTrue(c is t)
+
+
+class InstrumentationTester(unittest.TestCase):
+    def testParse(self):
+        with Recorder() as records:
+            tree = parse(', ADG S ]; A A o, D D o`, F F,')
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record['conversion'], 'parse')
+        self.assertEqual(set(record['stages']), {'rtf', 'layout', 'tokenize', 'parse'})
+        self.assertTrue(all(s['calls'] == 1 and s['wall'] >= 0 and s['cpu'] >= 0 for s in record['stages'].values()))
+        self.assertEqual(record['counts'], {'tokens': 27, 'chords': 8, 'notes': 10, 'rests': 1, 'repeat endings': 1})
+        self.assertEqual([str(n) for n in tree], [str(n) for n in parse_iter(', ADG S ]; A A o, D D o`, F F,')])
+
+    def testPipeline(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with Recorder() as records:
+            Pipeline(',+ ADG S D,\n,\\_ a s d f,\\').writeStream('midi', directory, backend='native')
+        self.assertEqual(len(records), 1)  # nested conversions join the outer one
+        record = records[0]
+        self.assertEqual((record['conversion'], record['format'], record['backend']), ('pipeline', 'midi', 'native'))
+        self.assertEqual(set(record['stages']), {'rtf', 'layout', 'tokenize', 'parse', 'export'})
+        self.assertEqual((record['counts']['parts'], record['counts']['measures']), (2, 2))
+        self.assertTrue(record['wall'] >= record['stages']['export']['wall'])
+        self.assertEqual(record['error'], None)
+
+    def testErrors(self):
+        with Recorder() as records:
+            self.assertRaises(SyntaxError, parse, ', d >')
+        self.assertEqual(records[0]['error'], 'SyntaxException')
+
+    def testDisabled(self):
+        self.assertEqual(listeners, [])
+        with Recorder() as records:
+            pass
+        parse(', A S,')
+        self.assertEqual(records, [])
+        self.assertEqual(listeners, [])
+
+
+class FuzzTester(unittest.TestCase):
+    def testGenerator(self):
+        documents = [randomDocument(random.Random(seed), noise=0) for seed in range(200)]
+        self.assertEqual(documents, [randomDocument(random.Random(seed), noise=0) for seed in range(200)])
+        valid = 0
+        for d in documents:
+            try:
+                parse(d, 'US')
+                valid += 1
+            except Exception:
+                pass
+        self.assertTrue(valid > 150)
+
+    def testNoteReaders(self):
+        s = ', DG~ a-\' s=.., A`, aL , a,'
+        xml = io.StringIO()
+        MusicXMLWriter(xml).write(parse(s))
+        midi = io.BytesIO()
+        MIDIWriter(midi).write(parse(s))
+        expected = [[(0, 1, 64), (0, 2, 67), (2, 2.5, 59), (2.5, 3, 63), (3, 4, 60), (4, 5, 60)]]
+        self.assertEqual(musicXMLNotes(xml.getvalue()), expected)
+        self.assertEqual(midiNotes(midi.getvalue()), expected)
+
+    def testShrink(self):
+        checks = {'tokens': (tokenize, {'broken': lambda text: tokenize(text.replace('L', ''))})}
+        self.assertEqual(list(differences(', A S, D,', checks)), [])
+        self.assertEqual(shrink(', A S, DL F, G,', lambda t: any(True for _ in differences(t, checks))), 'L')
+        failures = fuzz(20, 0, checks)
+        self.assertEqual([(f['alternative'], f['minimal']) for f in failures], [('broken', 'L')])
+
+    def testReferenceCrashes(self):
+        # a reference crashing where the alternative does not fails once per exception
+        def reference(text):
+            if 'L' in text:
+                raise KeyError('L')
+            return tokenize(text.replace('P', ''))
+        checks = {'tokens': (reference, {'lenient': tokenize})}
+        failures = fuzz(20, 0, checks)
+        self.assertEqual([(f['crash'], f['minimal'], f['expected']) for f in failures],
+                         [(None, 'P', ['']), ('KeyError', 'L', 'KeyError')])
+
+    def testFoundDivergences(self):
+        # ottava over a mixed chord, notes after a line break without a barline or before a closing one
+        for s in ['O9X', ',\n5', ',\ns d,', 'w 3<}~~,\n:m Z', ', A,o B,\n:oo C,']:
+            self.assertEqual(list(differences(s)), [], s)
+
+    def testAlternativesAgree(self):
+        self.assertEqual(fuzz(500, 1, registered(['tokens', 'tree'])), [])
+        self.assertEqual(fuzz(300, 2, registered(music21=False), noise=0), [])
+
+
+class BenchmarkTester(unittest.TestCase):
+    def testSyntheticScore(self):
+        self.assertEqual(syntheticScore(12), syntheticScore(12))
+        self.assertNotEqual(syntheticScore(12), syntheticScore(12, seed=1))
+        self.assertEqual(countNotes(parse(syntheticScore(10, chordDensity=0))), 40)
+        self.assertEqual(countNotes(parse(syntheticScore(10, chordDensity=1))), 120)
+        self.assertEqual(countNotes(parse(syntheticScore(10, parts=3, chordDensity=0))), 120)
+        for parts in (2, 3):
+            f = io.StringIO()
+            MusicXMLWriter(f).write(parse(syntheticScore(10, parts=parts)))
+            self.assertEqual(len(ET.fromstring(f.getvalue()).findall('part')), parts)
+
+    def testRTF(self):
+        text = syntheticScore(10, parts=2, boldRatio=0.5)
+        rtf = syntheticScore(10, parts=2, boldRatio=0.5, rtf=True)
+        rawText, boldRegion = getTextAndRTFBoldRegion(rtf)
+        self.assertEqual(rawText, text)
+        self.assertTrue(boldRegion.ranges)
+        self.assertFalse(getTextAndRTFBoldRegion(syntheticScore(10, rtf=True))[1].ranges)
+
+    def testScalingExponent(self):
+        self.assertAlmostEqual(scalingExponent([(10, 0.1), (100, 1.0), (1000, 10.0)]), 1.0)
+        self.assertAlmostEqual(scalingExponent([(10, 0.1), (100, 10.0)]), 2.0)
+        self.assertEqual(scalingExponent([(10, 0.1)]), None)
+
+    def testRun(self):
+        results = json.loads(json.dumps(runBenchmark((4, 8), 1, ['DE'], ('native',), parts=2)))
+        self.assertEqual([s['measures'] for s in results['sizes']], [4, 8])
+        self.assertEqual(set(results['stages']), {'getTextAndRTFBoldRegion', 'inputTranslate:DE', 'tokenize', 'parse',
+                                                  'writeNative:musicxml', 'writeNative:midi'})
+        self.assertEqual(len(results['stages']['parse']['notesPerSecond']), 2)
+        compared = list(compareResults(results, results))
+        self.assertEqual(len(compared), 12)
+        self.assertTrue(all(before == after for _, _, before, after in compared))
+
+
+class BatchTester(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.makedirs(os.path.join(self.directory, 'sub'))
+        self.files = {
+            'small.txt': ', a s,',
+            'large.txt': ', a s d f, A S D F;' * 20,
+            'bad.txt': '====',
+            os.path.join('sub', 'small.txt'): ', D F,'
+        }
+        for name, content in self.files.items():
+            with open(os.path.join(self.directory, name), 'wt') as f:
+                f.write(content)
+
+    def testFindInputs(self):
+        inputs = findInputs([self.directory, os.path.join(self.directory, '*.txt')])
+        self.assertEqual(len(inputs), 4)
+        self.assertEqual(findInputs([os.path.join(self.directory, 'sub', '*.rtf')]), [])
+
+    def testConvert(self):
+        manifest = os.path.join(self.directory, 'manifest.json')
+        results = convertBatch([self.directory], 'musicxml', jobs=2, backend='native', manifest=manifest)
+        self.assertEqual(len(results), 4)
+        outputs = dict((os.path.relpath(r['input'], self.directory), r) for r in results)
+
+        self.assertFalse(outputs['bad.txt']['ok'])  # failures are isolated
+        self.assertTrue(outputs['bad.txt']['error'].startswith('SyntaxException'))
+        self.assertFalse(os.path.exists(outputs['bad.txt']['output']))
+        for name in ('small.txt', 'large.txt', os.path.join('sub', 'small.txt')):
+            self.assertTrue(outputs[name]['ok'])
+            ET.parse(outputs[name]['output'])
+        self.assertEqual(os.path.basename(outputs['small.txt']['output']), 'small.xml')
+
+        with open(manifest) as f:
+            data = json.load(f)
+        self.assertEqual((data['converted'], data['failed']), (3, 1))
+        self.assertEqual(len(data['files']), 4)
+
+    def testProcesses(self):
+        # the batch workers cannot start processes: files translated by several are converted one at a time
+        self.assertRaises(ValueError, convertBatch, [self.directory], jobs=2, processes=2)
+        results = convertBatch([os.path.join(self.directory, 'large.txt')], outdir=os.path.join(self.directory, 'out'),
+                               processes=2)
+        self.assertTrue(results[0]['ok'])
+
+    def testOutputNames(self):
+        outdir = os.path.join(self.directory, 'out')
+        results = convertBatch([self.directory], 'midi', outdir, jobs=1, backend='native')
+        names = sorted(os.path.basename(r['output']) for r in results if r['ok'])
+        self.assertEqual(names, ['large.midi', 'small.midi', 'small01.midi'])  # as rtf2xml.py
+
+        reserved = set(os.path.join(outdir, 'small%s.midi' % n) for n in [''] + ['%02d' % i for i in range(1, 101)])
+        self.assertEqual(outputFilename('small.txt', 'midi', outdir, reserved), os.path.join(outdir, 'small101.midi'))
+
+
+class WatchTester(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'score.txt')
+        self._save(', a s d f,')
+        self.results = []
+        self.watcher = Watcher([self.directory], backend='native', delay=0.2,
+                               onResult=self.results.append, poll=0.05)
+        self.watcher.start()
+        self.addCleanup(self.watcher.stop)
+        self.assertTrue(self.watcher.waitIdle(10))
+
+    def _save(self, content):
+        with open(self.path, 'wt') as f:
+            f.write(content)
+
+    def testInitialBuild(self):
+        self.assertEqual([r['ok'] for r in self.results], [True])
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, 'score.xml')))
+
+    def testDebounce(self):
+        for content in (', a,', ', a s,', ', a s d,'):
+            self._save(content)
+            time.sleep(0.02)
+        time.sleep(0.3)
+        self.assertTrue(self.watcher.waitIdle(10))
+        self.assertEqual(len(self.results), 2)  # one conversion for the burst
+        score = ET.parse(os.path.join(self.directory, 'score.xml'))
+        self.assertEqual(len(score.findall('part/measure/note')), 3)
+
+    def testUnchangedContent(self):
+        self._save(', a s d f,')
+        self.watcher.notify(self.path)
+        self.assertTrue(self.watcher.waitIdle(10))
+        self.assertEqual(len(self.results), 1)
+
+    def testCoalesce(self):
+        self.watcher.running.add(self.path)  # as if a conversion were running
+        for content in (', a,', ', a s,'):
+            self._save(content)
+            self.watcher.notify(self.path)
+        time.sleep(0.3)
+        self.assertEqual(len(self.results), 1)  # waits for the running conversion
+        with self.watcher.condition:
+            self.watcher.running.discard(self.path)
+            self.watcher.condition.notify_all()
+        self.assertTrue(self.watcher.waitIdle(10))
+        self.assertEqual(len(self.results), 2)
+
+
+class ServerTester(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ConversionServer(('127.0.0.1', 0), jobs=1, queueSize=1, backend='native')
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+        cls.server.server_close()
+
+    def _convert(self, content, fmt='musicxml', **options):
+        return convert(content, fmt, self.server.server_address, **options)
+
+    def testConvert(self):
+        self.assertEqual(self._convert(', a s d f,', 'midi')[:4], b'MThd')
+        score = ET.fromstring(self._convert(', a s d f,', title='Title', tempo=90, instruments=['Piano']))
+        self.assertEqual(score.findtext('work/work-title'), 'Title')
+        self.assertEqual(score.findtext('part-list/score-part/part-name'), 'Piano')
+        self.assertEqual(score.find('part/measure/direction/sound').get('tempo'), '90')
+
+    def testErrors(self):
+        with self.assertRaises(ServerError) as cm:
+            self._convert('====')
+        self.assertEqual(cm.exception.status, 400)
+        self.assertTrue('Invalid input' in str(cm.exception))
+        with self.assertRaises(ServerError) as cm:
+            self._convert(', a,', tempo='fast')
+        self.assertEqual(cm.exception.status, 400)
+        host, port = self.server.server_address
+        request = Request('http://{}:{}/convert'.format(host, port), b', a \xff,')
+        with self.assertRaises(HTTPError) as cm:
+            urlopen(request, timeout=10)
+        self.assertEqual(cm.exception.code, 400)
+        self.assertTrue('UnicodeDecodeError' in cm.exception.read().decode('utf-8'))
+
+    def testBusy(self):
+        places = self.server.places
+        self.assertTrue(places.acquire(False) and places.acquire(False))  # one worker, one queue place
+        try:
+            with self.assertRaises(ServerError) as cm:
+                self._convert(', a,')
+            self.assertEqual(cm.exception.status, 503)
+        finally:
+            places.release()
+            places.release()
+        self.assertEqual(self._convert(', a,', 'midi')[:4], b'MThd')
+
+
+class SymbolTablesTester(unittest.TestCase):
+    def testPitchIndex(self):
+        for i, symbol in enumerate(note_range):
+            self.assertEqual(pitch_index[symbol], i)
+            self.assertEqual(symbol_classes[symbol], 'note')
+        self.assertEqual(symbol_classes['~'], 'prolonger')
+        self.assertEqual(symbol_classes['.'], 'beam')
+        self.assertTrue(']' not in symbol_classes)
+
+    def testTokenStructures(self):
+        self.assertEqual(token_structures['//']().length, 1)
+        self.assertTrue(isinstance(token_structures['oo'](), RepeatSectionStart))
+        self.assertTrue(token_structures[' ']() is token_structures[' ']())  # flyweights
+
+
+def _strings(d):
+    if isinstance(d, dict):
+        d = d.values()
+    elif not isinstance(d, list):
+        return [d]
+    return [s for v in d for s in _strings(v)]
+
 def _show(stream, format=None):
     if __name__ != '__main__':
         if not format:
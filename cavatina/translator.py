@@ -1,11 +1,27 @@
+import bisect
+import copy
+import gc
+import multiprocessing
+import pickle
+import warnings
+
 from music21 import stream, note, chord, key, meter, bar, dynamics, tie, repeat, spanner, layout, metadata, tempo, \
-    instrument
+    instrument, pitch, duration, clef, common, sites
 
+from .io.formats import outputPath, writeNative
+from .instrumentation import instrumented, stage, count, annotate, enabled
 from .language.structures import Note, Chord, Rest, KeySignature, Dynamic, BoldSystemicBarline, TimeSignature, MeasureEnd, RepeatFrom, RepeatTo, End, SystemicBarline, SectionEnd, GradualDynamic, RepeatSectionStart, RepeatSectionEnd, Coda, Segno, FromTo, OctavationStart, OctavationEnd, GrandStaff, Newline
 
+def create_m21Pitch(nobj):
+    return pitch.Pitch(nobj.get_m21name(), accidental=nobj.get_m21accidental())
+
+
+def create_m21Duration(interval):
+    return duration.Duration(interval.get_quarterLength())
+
+
 def create_m21Note(nobj):
-    n = note.Note(nobj.get_m21name(), quarterLength=nobj.get_quarterLength())
-    n.accidental = nobj.get_m21accidental()
+    n = note.Note(create_m21Pitch(nobj), duration=create_m21Duration(nobj))
     n.articulations = [a() for a in nobj.get_m21articulations()]
     n.expressions = [e() for e in nobj.get_m21expressions()]
     if nobj.is_tied():
@@ -31,47 +47,669 @@ def extractMergedDiacritics(n1, n2):
     return [artic, expre]
 
 
-def translateToMusic21(tree, preserveStemDirection=False):
+class MeasureBuilder(object):
+    """
+    Contents of a measure under construction, kept in plain lists and handed
+    to the music21 measure in one go by build(). Each append or insert on a
+    music21 stream recomputes offsets and clears the caches of the stream and
+    of all its sites, which makes building long scores quadratic.
+
+    Elements are offset and ordered as music21 would (by offset, priority,
+    class sort order and insertion), so indexing a builder gives the same
+    element as indexing the measure would. Notes, chords and rests go to
+    voice 1 unless inserted in another voice; a measure with more than one
+    voice gets them as stream.Voice objects, unless its contents run past the
+    bar. music21 cannot tie voices over to the next measure, so such a
+    measure keeps its overlapping notes and chords side by side.
+    """
+
+    def __init__(self, number=0):
+        self.measure = stream.Measure()
+        self.measure.number = number
+        self.number = number
+        self.elements = []  # sorted (offset, priority, classSortOrder, insertion, element)
+        self.endElements = []  # right barline
+        self.inserted = 0
+        self.voices = {}  # insertion : voice, for voices other than 1
+        self.voiceCount = 1
+        self.timeSignature = None
+        self.highestTime = 0.0
+        self.offset = 0.0  # in the part
+
+    def __len__(self):
+        return len(self.elements) + len(self.endElements)
+
+    def __getitem__(self, i):
+        return self.entry(i)[-1]
+
+    def entry(self, i):
+        if i < 0 and self.endElements:
+            if -i <= len(self.endElements):
+                return (self.highestTime, self.endElements[i])  # stored at the end
+            i += len(self.endElements)
+        return self.elements[i]
+
+    def offsetOf(self, i):
+        """
+        Offset of the element at index *i*.
+        """
+        return self.entry(i)[0]
+
+    def insert(self, offset, element, voice=1):
+        offset = common.opFrac(offset)
+        bisect.insort(self.elements, (offset, element.priority, element.classSortOrder, self.inserted, element))
+        if voice != 1:
+            self.voices[self.inserted] = voice
+            self.voiceCount = max(self.voiceCount, voice)
+        elif isinstance(element, meter.TimeSignature):
+            self.timeSignature = element
+        self.inserted += 1
+        self.highestTime = common.opFrac(max(self.highestTime, offset + element.duration.quarterLength))
+
+    def append(self, element):
+        self.insert(self.highestTime, element)
+
+    def remove(self, element):
+        self.elements = [e for e in self.elements if e[-1] is not element]
+
+    def setClef(self, newClef):
+        for entry in self.elements:
+            if entry[0] == 0 and isinstance(entry[-1], clef.Clef):
+                self.remove(entry[-1])
+                break
+        self.insert(0.0, newClef)
+
+    def setLeftBarline(self, barline):
+        barline.location = 'left'
+        for entry in self.elements:
+            if entry[0] == 0 and isinstance(entry[-1], bar.Barline):
+                self.remove(entry[-1])
+                break
+        self.insert(0.0, barline)
+
+    def setRightBarline(self, barline):
+        barline.location = 'right'
+        self.endElements = [barline]
+
+    def build(self, barLength=4.0):
+        """
+        Inserts the contents in the music21 measure and returns it.
+        barLength: quarter length of the bar, from the time signature in effect
+        """
+        m = self.measure
+        if self.voiceCount == 1 or self.highestTime > barLength:
+            for offset, _, _, _, element in self.elements:
+                m.coreInsert(offset, element, ignoreSort=True)
+        else:
+            voices = [stream.Voice() for _ in range(self.voiceCount)]
+            for offset, _, _, inserted, element in self.elements:
+                if isinstance(element, note.GeneralNote):
+                    voices[self.voices.get(inserted, 1) - 1].coreInsert(offset, element, ignoreSort=True)
+                else:
+                    m.coreInsert(offset, element, ignoreSort=True)
+            for number, v in enumerate(voices):
+                v.id = number + 1
+                v.coreElementsChanged()
+                m.coreInsert(0.0, v, ignoreSort=True)
+        for element in self.endElements:
+            m.coreStoreAtEnd(element)
+        m.coreElementsChanged()
+        return m
+
+
+class ScorePart(object):
+    """
+    A part of the score being translated, with its measures indexed so that
+    the translator never has to search the music21 streams. Measures are
+    only inserted in the music21 part by build().
+    """
+
+    def __init__(self, part, index):
+        self.part = part
+        self.index = index  # position among the parts of the score
+        self.measures = []  # MeasureBuilder in order, the last one is the current measure
+        self.first = 0  # index of the first measure of the part, see SegmentStart
+        self.highestTime = 0.0  # end of the measures before the last one
+        self.pendingRemoval = False  # last measure dropped if still empty when the part goes on
+        self.timeSignature = None  # in effect before the first measure, see SegmentStart
+        self.lastKeySign = None
+        self.lastClef = None
+        self.lastTimeSign = None
+
+    def resolveRemoval(self):
+        if self.pendingRemoval:
+            self.pendingRemoval = False
+            self.removeEmptyMeasure()
+
+    def appendMeasure(self, m):
+        self.resolveRemoval()
+        if self.measures:  # the previous measure is complete
+            previous = self.measures[-1]
+            self.highestTime = common.opFrac(max(self.highestTime, previous.offset + previous.highestTime))
+        m.offset = self.highestTime
+        self.measures.append(m)
+
+    def removeEmptyMeasure(self):
+        if len(self.measures) > self.first and len(self.measures[-1]) == 0:
+            self.measures.pop()
+
+    def lastNumber(self):
+        self.resolveRemoval()
+        return self.measures[-1].number if self.measures else -1
+
+    def build(self):
+        """
+        Inserts the contents of all measures, and the measures in the part.
+        """
+        timeSignature = self.timeSignature
+        for m in self.measures[self.first:]:
+            timeSignature = m.timeSignature or timeSignature
+            barLength = timeSignature.barDuration.quarterLength if timeSignature is not None else 4.0
+            self.part.coreInsert(m.offset, m.build(barLength), ignoreSort=True)
+        self.part.coreElementsChanged()
+
+    def numberedMeasures(self):
+        """
+        Returns {number: first measure with it} of the measures in the built part.
+        """
+        numbers = {}
+        for e in self.part._elements:
+            if isinstance(e, stream.Measure):
+                numbers.setdefault(e.number, e)
+        return numbers
+
+
+class RepeatEndingError(ValueError):
+    """
+    A repeat ending closed without being opened, ending before it starts, or
+    starting on a measure that does not exist.
+    """
+
+
+class RepeatEndingWarning(UserWarning):
+    """
+    A repeat ending left open at the end of the score, or overlapping another
+    ending of its part. The score is translated as before.
+    """
+
+
+def insertRepeatEndings(endings, unclosed=()):
+    """
+    Inserts a RepeatBracket in the built parts for each ending of *endings*,
+    in order, as repeat.insertRepeatEnding would.
+
+    endings: [(ScorePart, first measure number, last measure number, ending number)]
+    unclosed: [(first measure number, ending number)] of the endings never closed
+    """
+    with stage('repeats'):
+        numbers = {}  # ScorePart : {measure number : first measure with it}
+        covered = {}  # ScorePart : {measure number : number of the ending spanning it}
+        for part, start, end, endingNo in endings:
+            if part not in numbers:
+                numbers[part] = part.numberedMeasures()
+                covered[part] = {}
+            if end < start:
+                raise RepeatEndingError("Ending {} ends (measure {}) before it starts (measure {})".format(
+                    endingNo, end, start))
+            if start not in numbers[part]:
+                raise RepeatEndingError("Ending {} starts on measure {}, which does not exist in part {}".format(
+                    endingNo, start, part.index + 1))
+            # measures removed for being empty leave gaps in the numbers
+            measures = [numbers[part][n] for n in range(start, end + 1) if n in numbers[part]]
+
+            overlapped = set(covered[part][n] for n in range(start, end + 1) if n in covered[part])
+            if overlapped:
+                warnings.warn("Ending {} (measures {} to {}) overlaps ending {} in part {}".format(
+                    endingNo, start, end, ', '.join(str(no) for no in sorted(overlapped)), part.index + 1),
+                    RepeatEndingWarning)
+            for n in range(start, end + 1):
+                covered[part][n] = endingNo
+
+            rb = spanner.RepeatBracket(measures, number=endingNo)
+            part.part.coreInsert(part.part.elementOffset(measures[0]), rb, ignoreSort=True)
+        for part in numbers:
+            part.part.coreElementsChanged()
+
+    for start, endingNo in unclosed:
+        warnings.warn("Ending {} from measure {} is never closed".format(endingNo, start), RepeatEndingWarning)
+
+
+class PartChange(object):
+    """
+    Where the translation leaves (entering=False) or resumes (entering=True)
+    a part, in the structures of that part given by splitParts.
+    systemic: the part is left at a systemic barline, which closes its
+              current measure first
+    """
+    __slots__ = ('entering', 'systemic')
+
+    def __init__(self, entering, systemic=False):
+        self.entering = entering
+        self.systemic = systemic
+
+
+def splitParts(tree):
+    """
+    Splits a parse tree into the structures of each part, replaying only the
+    part changes of translateStructures, so that each part can be translated
+    on its own.
+
+    Returns (structures of each part, score events) or None if an ending or
+    an ottava continues in another part, which only the translation of the
+    whole tree reproduces. Score events, in order, are ('part', i) for each
+    part, ('staffGroup', symbol, i) for a staff group of parts i-1 and i, and
+    ('joinStaffGroup', i) for part i added to the first staff group.
+    """
+    structures = [[]]
+    events = [('part', 0)]
+    staffGroups = 0
+    current = 0
+    catchPartitioning = False
+    endingOpen = False
+    octavationSwitch = False
+    octavationParts = set()  # parts of the octavation signs since the last spanning one
+
+    for structure in tree:
+        target = None
+        if catchPartitioning:
+            if isinstance(structure, KeySignature) or (isinstance(structure, MeasureEnd) and
+                                                       not isinstance(structure, SystemicBarline)):
+                target = 0  # return to first part
+            elif isinstance(structure, GrandStaff) or isinstance(structure, SystemicBarline):
+                target = current + 1
+
+        if target is None:
+            if isinstance(structure, Newline):
+                catchPartitioning = True
+            elif isinstance(structure, RepeatSectionStart):
+                endingOpen = True
+            elif isinstance(structure, (RepeatTo, End, RepeatSectionEnd)):
+                endingOpen = False
+            elif isinstance(structure, OctavationStart):
+                if structure.octaveTranspositions in (1, 2):
+                    octavationParts = set([current])
+                    octavationSwitch = True
+                elif structure.octaveTranspositions == 0:
+                    octavationParts.add(current)
+            elif isinstance(structure, OctavationEnd):
+                if octavationParts != set([current]):
+                    return None
+                octavationSwitch = False
+            structures[current].append(structure)
+            continue
+
+        if target != current:
+            if endingOpen or octavationSwitch:
+                return None
+            structures[current].append(PartChange(False, isinstance(structure, SystemicBarline)))
+        if target == len(structures):  # new part
+            structures.append([])
+            events.append(('part', target))
+            if isinstance(structure, GrandStaff):
+                events.append(('staffGroup', 'brace', target))
+                staffGroups += 1
+            elif staffGroups:
+                events.append(('joinStaffGroup', target))
+            else:
+                events.append(('staffGroup', 'line', target))
+                staffGroups += 1
+        else:
+            structures[target].append(PartChange(True))
+            if isinstance(structure, KeySignature):
+                structures[target].append(structure)
+        current = target
+        catchPartitioning = False
+
+    return structures, events
+
+
+def partStreams(part):
+    """
+    Returns the streams of *part* (the part, its measures and their voices)
+    and the storages of its spanners.
+    """
+    streams = [part]
+    storages = []
+    for s in streams:
+        for e in s._elements:
+            if e.isStream:
+                streams.append(e)
+            elif isinstance(e, spanner.Spanner):
+                storages.append(e.spannerStorage)
+    return streams, storages
+
+
+def packPart(part):
+    """
+    Pickles *part* for another process. music21 keys the links between
+    streams and their elements by object id, which does not survive a
+    pickle, so they are left out and restored by unpackPart.
+    """
+    streams, storages = partStreams(part)
+    for s in streams + storages:
+        for e in s._elements + s._endElements:
+            e.sites = sites.Sites()
+    part.sites = sites.Sites()
+    return pickle.dumps(part, pickle.HIGHEST_PROTOCOL)
+
+
+def unpackPart(data):
+    """
+    Unpickles a part pickled by packPart. Elements are linked to their
+    streams again in the order of the streams, which keeps the order of the
+    elements at the same position.
+
+    The garbage collector is paused meanwhile: the many objects created
+    would otherwise trigger collections scanning all the parts unpacked so
+    far, which takes longer than the unpacking itself.
+    """
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        part = pickle.loads(data)
+        streams, storages = partStreams(part)
+        for s in streams + storages:
+            s._offsetDict = dict((id(e), (offset, e)) for offset, e in s._offsetDict.values())
+            s._cache = {}
+            for e in s._elements + s._endElements:
+                e.sites.add(s)
+        for s in streams:
+            for e in s._elements + s._endElements:
+                e.activeSite = s
+    finally:
+        if collecting:
+            gc.enable()
+    return part
+
+
+class WorkerError(Exception):
+    """
+    Raised in place of an error translating the structures given to a
+    worker process. translateToMusic21 then translates the whole tree, which
+    raises the error as the serial translation does.
+    """
+
+
+def translatePart(job):
+    """
+    Translates the structures of one part given by splitParts, in a worker
+    process. Returns the packed part and the warnings issued meanwhile.
+    """
+    structures, preserveStemDirection = job
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            part = translateStructures(structures, preserveStemDirection).parts[0]
+    except Exception as e:
+        raise WorkerError('{}: {}'.format(type(e).__name__, e))
+    return packPart(part), [w.message for w in caught]
+
+
+def translateParts(structures, events, preserveStemDirection=False, processes=None):
+    """
+    Translates the parts given by splitParts on a pool of worker processes,
+    and assembles them in a score as translateStructures would.
+    """
+    parts = []
+    messages = []
+    pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(structures)))
+    try:
+        for data, caught in pool.imap(translatePart, [(s, preserveStemDirection) for s in structures]):
+            parts.append(unpackPart(data))  # while the next parts are translated
+            messages.extend(caught)
+    finally:
+        pool.close()
+        pool.join()
+    for message in messages:
+        warnings.warn(message)
+
+    score = stream.Score()
+    score.insert(metadata.Metadata())
+    staffGroups = []
+    for event in events:
+        if event[0] == 'part':
+            score.insert(0.0, parts[event[1]])
+        elif event[0] == 'staffGroup':
+            staffGroup = layout.StaffGroup([parts[event[2] - 1], parts[event[2]]], symbol=event[1])
+            score.insert(0.0, staffGroup)
+            staffGroups.append(staffGroup)
+        else:
+            staffGroups[0].addSpannedElements(parts[event[1]])
+    return score
+
+
+class SegmentStart(object):
+    """
+    Where a segment given by splitSegments starts, after the barline of a
+    section or of an end. Measures of the segment are numbered from 0, after
+    a placeholder measure -1 standing for the last measure of the previous
+    segment, and offset from 0.
+    keySignature, timeSignature: last structures of these in the previous
+                                 segments, or None
+    """
+    __slots__ = ('keySignature', 'timeSignature')
+
+    def __init__(self, keySignature=None, timeSignature=None):
+        self.keySignature = keySignature
+        self.timeSignature = timeSignature
+
+
+def splitSegments(tree, count):
+    """
+    Splits the parse tree of a score with one part into at most *count*
+    segments of similar length, so that each can be translated on its own.
+    Segments are cut after a SectionEnd or End, where the translator keeps
+    only the signatures of the part: no ending, ottava or part change may be
+    open there.
+
+    Returns the structures of each segment, the ones after the first starting
+    with a SegmentStart, or None if the score has more than one part.
+    """
+    segments = [[]]
+    length = float(len(tree)) / count
+    catchPartitioning = False
+    endingOpen = False
+    octavationSwitch = False
+    keySignature = None
+    timeSignature = None
+
+    for structure in tree:
+        segments[-1].append(structure)
+        if isinstance(structure, Newline):
+            catchPartitioning = True
+        elif isinstance(structure, KeySignature):
+            keySignature = structure
+            catchPartitioning = False
+        elif isinstance(structure, TimeSignature):
+            timeSignature = structure
+        elif isinstance(structure, (GrandStaff, SystemicBarline)) and catchPartitioning:
+            return None  # new part
+        elif isinstance(structure, MeasureEnd):
+            catchPartitioning = False
+        elif isinstance(structure, RepeatSectionStart):
+            endingOpen = True
+        elif isinstance(structure, (RepeatTo, RepeatSectionEnd)):
+            endingOpen = False
+        elif isinstance(structure, OctavationStart):
+            if structure.octaveTranspositions in (1, 2):
+                octavationSwitch = True
+        elif isinstance(structure, OctavationEnd):
+            octavationSwitch = False
+
+        if isinstance(structure, End):
+            endingOpen = False
+        if isinstance(structure, (SectionEnd, End)) and not (catchPartitioning or endingOpen or octavationSwitch):
+            if len(segments[-1]) >= length and len(segments) < count:
+                segments.append([SegmentStart(keySignature, timeSignature)])
+
+    if len(segments[-1]) == 1 and len(segments) > 1:  # nothing after the last cut
+        segments.pop()
+    return segments
+
+
+def translateSegment(job):
+    """
+    Translates the structures of one segment given by splitSegments, in a
+    worker process. Returns the packed part, the offset where the next
+    segment starts, the endings (first measure number, last measure number,
+    ending number) and open endings of the segment, and the warnings issued
+    meanwhile.
+    """
+    structures, preserveStemDirection = job
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            score, parts, endings, unclosed = buildScore(structures, preserveStemDirection)
+    except Exception as e:
+        raise WorkerError('{}: {}'.format(type(e).__name__, e))
+    return (packPart(parts[0].part), parts[0].highestTime, [ending[1:] for ending in endings], unclosed,
+            [w.message for w in caught])
+
+
+def translateSegments(segments, preserveStemDirection=False, processes=None):
+    """
+    Translates the segments given by splitSegments on a pool of worker
+    processes, and joins their measures in one part, numbered and offset as
+    translateStructures would.
+    """
+    part = ScorePart(stream.Part(), 0)
+    spanners = []  # (offset, element) of the segments, inserted first as in the serial translation
+    measures = []  # (offset, measure)
+    endings = []
+    unclosed = []
+    number = 0  # of the first measure of the segment
+    offset = 0.0
+    pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(segments)))
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for data, length, segmentEndings, segmentUnclosed, messages in pool.imap(
+                    translateSegment, [(s, preserveStemDirection) for s in segments]):
+                for message in messages:
+                    warnings.warn(message)
+                segment = unpackPart(data)
+                for e in segment._elements:
+                    e.sites.remove(segment)
+                    if isinstance(e, stream.Measure):
+                        measures.append((common.opFrac(offset + segment.elementOffset(e)), e))
+                        e.number += number
+                    else:
+                        spanners.append((segment.elementOffset(e), e))
+                endings.extend((part, start + number, end + number, endingNo)
+                               for start, end, endingNo in segmentEndings)
+                unclosed.extend((start + number, endingNo) for start, endingNo in segmentUnclosed)
+                number = measures[-1][1].number + 1
+                offset = common.opFrac(offset + length)
+
+            for elementOffset, e in spanners + measures:
+                part.part.coreInsert(elementOffset, e, ignoreSort=True)
+            part.part.coreElementsChanged()
+            insertRepeatEndings(endings, unclosed)
+    finally:
+        pool.close()
+        pool.join()
+    for w in caught:
+        warnings.warn(w.message)
+
+    score = stream.Score()
+    score.insert(metadata.Metadata())
+    score.insert(0.0, part.part)
+    return score
+
+
+@instrumented('translate', 'translate')
+def translateToMusic21(tree, preserveStemDirection=False, processes=1):
+    """
+    tree: iterable of structures, e.g. a list returned by syntax.parse or the
+    generator returned by syntax.parse_iter (consumed only once)
+    processes: number of worker processes translating the parts of a score
+               with several parts, or the sections of a score with one part,
+               at the same time (None: one per CPU)
+    """
+    score = None
+    failure = None
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes > 1:
+        tree = list(tree)
+        split = splitParts(tree)
+        try:
+            if split is not None and len(split[0]) > 1:
+                score = translateParts(split[0], split[1], preserveStemDirection, processes)
+            elif split is not None:
+                segments = splitSegments(tree, processes)
+                if segments is not None and len(segments) > 1:
+                    score = translateSegments(segments, preserveStemDirection, processes)
+        except (WorkerError, RepeatEndingError) as e:  # an ending of the segments joined is invalid
+            failure = e  # translated again below, to fail as the whole tree does
+    if score is None:
+        score = translateStructures(tree, preserveStemDirection)
+        if failure is not None:
+            warnings.warn("Translated serially after a worker failed: {}".format(failure), RuntimeWarning)
+
+    if enabled():
+        count('parts', len(score.parts))
+        count('measures', sum(len(p.getElementsByClass(stream.Measure)) for p in score.parts))
+    return score
+
+
+def translateStructures(tree, preserveStemDirection=False):
+    """
+    Translates the structures of *tree*, see translateToMusic21.
+    """
+    score, parts, endings, unclosed = buildScore(tree, preserveStemDirection)
+    insertRepeatEndings(endings, unclosed)
+    return score
+
+
+def buildScore(tree, preserveStemDirection=False):
+    """
+    Translates the structures of *tree* but the repeat endings. Returns the
+    score, its ScoreParts, and the endings and open endings to be given to
+    insertRepeatEndings.
+    """
     score = stream.Score()
 
     score.insert(metadata.Metadata())
     # score.metadata.title = 'Untitled'
     # score.metadata.composer = 'Unknown Composer'
 
-    score.append(stream.Part())
-    part = score[-1]
-    part.append(stream.Measure()
-                )  # measure['current'] is always already contained in part
+    parts = [ScorePart(stream.Part(), 0)]  # in score order
+    staffGroups = []  # layout.StaffGroup, in score order
+    current = parts[0]
+    score.append(current.part)
+    current.appendMeasure(MeasureBuilder()
+                          )  # measure['current'] is always already contained in part
     measure = {
-        'current': part[-1],
+        'current': current.measures[-1],
         'counter': 0
     }  # because measure numbers are not set automatically
     # (dict as work-around for *nonlocal* statement in Python 3)
-    repeatEnds = []
-    makeVoices = []  # for multi-voice chords
-    lastKeySign = {
-        0: None,
-        1: None,
-        2: None,
-        3: None,
-        4: None
-    }  # part number : int
-    lastClef = {0: None, 1: None, 2: None, 3: None, 4: None}
-    lastTimeSign = {0: None, 1: None, 2: None, 3: None, 4: None}
+    repeatEnds = []  # [first measure number, ending number] of the open endings
+    endings = []  # closed endings, see insertRepeatEndings
 
     # states
     octavationSwitch = False
     catchPartitioning = False  # watch-state triggered by a Newline
 
     def insertNewMeasure():
-        part.append(stream.Measure())
-        measure['current'] = part[-1]
         measure['counter'] += 1
-        measure['current'].number = measure['counter']
+        measure['current'] = MeasureBuilder(measure['counter'])
+        current.appendMeasure(measure['current'])
+
+    def closePreviousMeasure():
+        # a closing barline that opens a line going on from an empty measure
+        # ends the measure before it, as at the end of the previous line
+        if current.pendingRemoval and len(measure['current']) == 0 and len(current.measures) > current.first + 1 \
+                and not any(start == measure['current'].number for start, _ in repeatEnds):
+            current.resolveRemoval()
+            measure['current'] = current.measures[-1]
+            measure['counter'] = measure['current'].number
 
     for structure in tree:
         # (time structures)
         if isinstance(structure, Chord):
+            placed = []  # the chord or note of each voice
             if len(structure) > 1:
                 noteList = []
 
@@ -94,26 +732,24 @@ def translateToMusic21(tree, preserveStemDirection=False):
                     else:
                         currentVoice.append(n)
 
-                # Make chords
-                for nlist in chordVoices:
+                # Make chords, one voice each
+                for v, nlist in enumerate(chordVoices):
                     c = chord.Chord(nlist)
                     chordArticulations, chordExpressions = extractMergedDiacritics(
                         c[0], c[-1]
                     )  # transfer first-note and last-note diacritics to chord diacritics
                     c.articulations = chordArticulations  # some articulations are not yet translated from music21 into Lilypond (staccato, tenuto, etc.)
                     c.expressions = chordExpressions  # idem. (mordent, turn, trill, etc.)
-                    if nlist == chordVoices[0]:
+                    if v == 0:
                         measure['current'].append(c)
-                        chordOffset = measure['current'][-1].offset
+                        chordOffset = measure['current'].offsetOf(-1)
                     else:
-                        measure['current'].insert(chordOffset, c)  # overlap
-
-                if len(chordVoices) > 1:  # if overlap
-                    makeVoices.append((part.id, measure['current'].number
-                                       ))  # remember overlap locations
+                        measure['current'].insert(chordOffset, c, voice=v + 1)  # overlap
+                    placed.append(c)
 
             else:
-                measure['current'].append(create_m21Note(structure[0]))
+                placed.append(create_m21Note(structure[0]))
+                measure['current'].append(placed[0])
 
             # Beams
             if structure.beamToPrevious:
@@ -125,14 +761,15 @@ def translateToMusic21(tree, preserveStemDirection=False):
 
             # Ottava
             if octavationSwitch:
-                measure['current'][-1].transpose('p8', inPlace=True)
-                ottava.addSpannedElements(measure['current'][-1])
+                for element in placed:
+                    element.transpose('p8', inPlace=True)
+                    ottava.addSpannedElements(element)
 
             continue
 
         if isinstance(structure, Rest):
             measure['current'].append(
-                note.Rest(quarterLength=structure.get_quarterLength()))
+                note.Rest(duration=create_m21Duration(structure)))
             continue
         # (end time structures)
 
@@ -140,28 +777,26 @@ def translateToMusic21(tree, preserveStemDirection=False):
         if isinstance(structure, KeySignature):
             if catchPartitioning:
                 # Return to first part
-                part = score[1]  # score[0] is the metadata object
-                measure['counter'] = part[-1].number
+                current = parts[0]
+                measure['counter'] = current.lastNumber()
                 insertNewMeasure()
                 catchPartitioning = False
 
-            i = score.index(part)
             newClef = structure.get_m21clef()()
             newKeySign = structure.getm21signature()
 
-            if newKeySign != lastKeySign[i] or newClef.sign != lastClef[i]:
-                lastKeySign[i] = newKeySign
-                lastClef[i] = newClef.sign
-                measure['current'].clef = newClef  # instantiation
+            if newKeySign != current.lastKeySign or newClef.sign != current.lastClef:
+                current.lastKeySign = newKeySign
+                current.lastClef = newClef.sign
+                measure['current'].setClef(newClef)  # instantiation
                 measure['current'].insert(0.0, key.KeySignature(newKeySign))
             continue
 
         if isinstance(structure, TimeSignature):
             newTimeSignature = meter.TimeSignature(
                 structure.get_m21fractionalTime())
-            i = score.index(part)
-            if newTimeSignature.ratioString != lastTimeSign[i]:
-                lastTimeSign[i] = newTimeSignature.ratioString
+            if newTimeSignature.ratioString != current.lastTimeSign:
+                current.lastTimeSign = newTimeSignature.ratioString
                 measure['current'].insert(0.0, newTimeSignature)
             continue
         # (end signatures)
@@ -171,8 +806,8 @@ def translateToMusic21(tree, preserveStemDirection=False):
             if catchPartitioning and not isinstance(structure,
                                                     SystemicBarline):
                 # Return to first part
-                part = score[1]  # score[0] is the metadata object
-                measure['counter'] = part[-1].number
+                current = parts[0]
+                measure['counter'] = current.lastNumber()
                 insertNewMeasure()
                 catchPartitioning = False
 
@@ -180,19 +815,17 @@ def translateToMusic21(tree, preserveStemDirection=False):
                 insertNewMeasure()
 
         if isinstance(structure, SectionEnd):
+            closePreviousMeasure()
             measure['current'].append(bar.Barline(style='double'))
             insertNewMeasure()
             continue
 
         if isinstance(structure, End):
+            closePreviousMeasure()
             if len(repeatEnds) != 0:  # close last repeat section
                 startMeasureNo, endingNo = repeatEnds.pop()
                 endMeasureNo = measure['current'].number
-                repeat.insertRepeatEnding(part,
-                                          startMeasureNo,
-                                          endMeasureNo,
-                                          endingNumber=endingNo,
-                                          inPlace=True)
+                endings.append((current, startMeasureNo, endMeasureNo, endingNo))
 
             measure['current'].append(bar.Barline(style='final'))
             insertNewMeasure()
@@ -204,7 +837,7 @@ def translateToMusic21(tree, preserveStemDirection=False):
             if len(measure['current']) > 0 and isinstance(
                     measure['current'][-1], chord.Chord) or isinstance(
                         measure['current'][-1], note.Note):
-                lastChordOffset = measure['current'][-1].offset
+                lastChordOffset = measure['current'].offsetOf(-1)
                 measure['current'].insert(
                     lastChordOffset,
                     dynamics.Dynamic(structure.get_m21dynamic()))
@@ -216,7 +849,7 @@ def translateToMusic21(tree, preserveStemDirection=False):
         if isinstance(structure, GradualDynamic):
             if len(measure['current']) > 0 and isinstance(
                     measure['current'][-1], chord.Chord):
-                lastChordOffset = measure['current'][-1].offset
+                lastChordOffset = measure['current'].offsetOf(-1)
                 if structure.get_name() == 'crescendo':
                     measure['current'].insert(lastChordOffset,
                                               dynamics.Crescendo())
@@ -236,20 +869,17 @@ def translateToMusic21(tree, preserveStemDirection=False):
             if len(measure['current']) > 0 and not isinstance(
                     measure['current'][-1], bar.Repeat):
                 insertNewMeasure()
-            measure['current'].leftBarline = bar.Repeat(direction='start')
+            measure['current'].setLeftBarline(bar.Repeat(direction='start'))
             continue
 
         if isinstance(structure, RepeatTo):
+            closePreviousMeasure()
             if len(repeatEnds) != 0:  # close last repeat section
                 startMeasureNo, endingNo = repeatEnds.pop()
                 endMeasureNo = measure['current'].number
-                repeat.insertRepeatEnding(part,
-                                          startMeasureNo,
-                                          endMeasureNo,
-                                          endingNumber=endingNo,
-                                          inPlace=True)
+                endings.append((current, startMeasureNo, endMeasureNo, endingNo))
 
-            measure['current'].rightBarline = bar.Repeat(direction='end')
+            measure['current'].setRightBarline(bar.Repeat(direction='end'))
             insertNewMeasure()
             continue
 
@@ -260,11 +890,7 @@ def translateToMusic21(tree, preserveStemDirection=False):
                     endMeasureNo = measure['current'].number - 1
                 else:
                     endMeasureNo = measure['current'].number
-                repeat.insertRepeatEnding(part,
-                                          startMeasureNo,
-                                          endMeasureNo,
-                                          endingNumber=endingNo,
-                                          inPlace=True)
+                endings.append((current, startMeasureNo, endMeasureNo, endingNo))
 
             endingNo = structure.get_m21no()
             if len(measure['current']) == 0:
@@ -274,16 +900,15 @@ def translateToMusic21(tree, preserveStemDirection=False):
             continue
 
         if isinstance(structure, RepeatSectionEnd):
+            if not repeatEnds:
+                raise RepeatEndingError("Ending closed in measure {} but none is open".format(
+                    measure['current'].number))
             startMeasureNo, endingNo = repeatEnds.pop()
             if len(measure['current']) == 0:
-                endMeasureNo = part[-2].number
+                endMeasureNo = current.measures[-2].number
             else:
                 endMeasureNo = measure['current'].number
-            repeat.insertRepeatEnding(part,
-                                      startMeasureNo,
-                                      endMeasureNo,
-                                      endingNumber=endingNo,
-                                      inPlace=True)
+            endings.append((current, startMeasureNo, endMeasureNo, endingNo))
             continue
 
         if isinstance(structure, Coda):
@@ -330,7 +955,7 @@ def translateToMusic21(tree, preserveStemDirection=False):
             continue
 
         if isinstance(structure, OctavationEnd):
-            part.insert(0.0, ottava)
+            current.part.insert(0.0, ottava)
             octavationSwitch = False
             continue
         # (end ottava)
@@ -349,61 +974,77 @@ def translateToMusic21(tree, preserveStemDirection=False):
         if isinstance(structure, GrandStaff) or isinstance(
                 structure, SystemicBarline):
             if catchPartitioning:
-                if part == score.parts[-1]:  # part is last part
+                if current is parts[-1]:  # part is last part
                     # Create new part and re-initialize
-                    part = stream.Part()
-                    score.append(part)
-                    part.offset = 0.0
+                    current = ScorePart(stream.Part(), len(parts))
+                    parts.append(current)
+                    score.append(current.part)
+                    current.part.offset = 0.0
                     measure['counter'] = -1
                     insertNewMeasure()
 
                     if isinstance(structure, GrandStaff):
-                        p1 = score.parts[-2]
-                        p2 = score.parts[-1]  # = part
-                        staffGroup = layout.StaffGroup([p1, p2],
+                        staffGroup = layout.StaffGroup([parts[-2].part, current.part],
                                                        symbol='brace')
                         score.insert(0.0, staffGroup)
+                        staffGroups.append(staffGroup)
 
                     if isinstance(structure, SystemicBarline):
-                        SystBarline = score.getElementsByClass(
-                            layout.StaffGroup)[0] if len(
-                                score.getElementsByClass(
-                                    layout.StaffGroup)) > 0 else None
-                        if not SystBarline:
-                            p1 = score.parts[-2]
-                            p2 = score.parts[-1]  # = part
-                            staffGroup = layout.StaffGroup([p1, p2],
+                        if not staffGroups:
+                            staffGroup = layout.StaffGroup([parts[-2].part, current.part],
                                                            symbol='line')
                             score.insert(0.0, staffGroup)
+                            staffGroups.append(staffGroup)
                         else:
-                            SystBarline.addSpannedElements(part)
+                            staffGroups[0].addSpannedElements(current.part)
 
                 else:  # next parts already exist
-                    part = part.next('Part')
-                    measure['counter'] = part[-1].number if isinstance(part[-1], stream.Measure) else part[-1].measureNumber
+                    current = parts[current.index + 1]
+                    measure['counter'] = current.lastNumber()
                     insertNewMeasure()
 
                 catchPartitioning = False
                 continue
         # (end grand staff)
 
+        # (parts translated apart, see splitParts)
+        if isinstance(structure, PartChange):
+            if structure.entering:
+                current = parts[0]
+                measure['counter'] = current.lastNumber()
+                insertNewMeasure()
+                catchPartitioning = False
+            else:
+                if structure.systemic and len(measure['current']) > 0:
+                    insertNewMeasure()
+                current = None  # until the part is entered again
+            continue
+
+        # (segments translated apart, see splitSegments)
+        if isinstance(structure, SegmentStart):
+            if structure.keySignature is not None:
+                current.lastKeySign = structure.keySignature.getm21signature()
+                current.lastClef = structure.keySignature.get_m21clef()().sign
+            if structure.timeSignature is not None:
+                current.timeSignature = meter.TimeSignature(structure.timeSignature.get_m21fractionalTime())
+                current.lastTimeSign = current.timeSignature.ratioString
+            current.measures.insert(0, MeasureBuilder(-1))  # last measure of the previous segment
+            current.first = 1
+            continue
+
         # New line
         if isinstance(structure, Newline):
-            # Clean-up
-            if type(part[-1]) is stream.Measure and len(part[-1]) == 0:
-                part.remove(part[-1])  # measure['current']
+            # Clean-up, unless the line goes on without a barline
+            current.pendingRemoval = True  # measure['current']
             catchPartitioning = True  # trigger watch-state
             continue
 
     # Clean-up
-    if type(part[-1]) is stream.Measure and len(part[-1]) == 0:
-        part.remove(part[-1])  # measure['current']
-
-    # Separate overlaps
-    for partId, measureNo in makeVoices:
-        p = score.getElementById(partId)
-        p[measureNo].makeVoices(
-        )  # ugly results when durations don't fit, automatically generated rests
+    if current is not None:
+        current.removeEmptyMeasure()  # measure['current']
+    for p in parts:
+        p.resolveRemoval()
+        p.build()
 
     # Automatic beams
     # if autoBeams:
@@ -418,7 +1059,7 @@ def translateToMusic21(tree, preserveStemDirection=False):
     #     for p in score.parts: # make auto-beams
     #         p.makeBeams(inPlace=True)
 
-    return score
+    return score, parts, endings, repeatEnds
 
 
 def setMetadata(m21stream,
@@ -465,18 +1106,23 @@ def setMetadata(m21stream,
                     parts[n].insert(0, instrument.fromString(i))
 
 
+@instrumented('writeStream')
 def writeStream(m21stream,
                 format='midi',
                 wrtpath=None,
                 scoreTitle=None,
                 scoreComposer=None,
                 scoreTempo=None,
-                scoreInstruments=None):
+                scoreInstruments=None,
+                backend='music21'):
     """
     scoreTitle: str
     scoreComposer: str
     scoreTempo: int
     scoreInstruments: list[ str ]
+    backend: 'music21', or 'native' to write the file straight from the
+             Cavatina structures; m21stream is then a tree as returned by
+             syntax.parse or syntax.parse_iter
 
     Write out Music21 stream in a given format. If wrtpath is not specified
     the file is written in the current working directory (as 'untitled.ext'),
@@ -484,46 +1130,49 @@ def writeStream(m21stream,
 
     The possible output formats are
         musicxml lily(pond) midi
+    and for the native backend
+        musicxml midi
     """
-    import os
-    from music21.common import findFormat
-
-    fmt, ext = findFormat(format)
-
-    if not wrtpath:
-        wrtpath = os.path.join(os.getcwd(), 'untitled' + ext)
-    if os.path.isdir(wrtpath):
-        wrtpath = os.path.join(wrtpath, 'untitled' + ext)
+    wrtpath = outputPath(format, wrtpath)
+    annotate(format=format, backend=backend)
+
+    if backend == 'native':
+        writeNative(m21stream,
+                    format,
+                    wrtpath,
+                    scoreTitle=scoreTitle,
+                    scoreComposer=scoreComposer,
+                    scoreTempo=scoreTempo,
+                    scoreInstruments=scoreInstruments)
+        return
 
     # Part writing (app.py: MyFrame.getOffsetScore)
     if isinstance(m21stream, stream.Part):
-        import copy
         score = stream.Score()
         score.append(copy.deepcopy(m21stream))
         m21stream = score
 
     # Metadata
-    setMetadata(m21stream,
-                scoreTitle=scoreTitle,
-                scoreComposer=scoreComposer,
-                scoreTempo=scoreTempo,
-                scoreInstruments=scoreInstruments,
-                midiPrograms=False)
+    with stage('metadata'):
+        setMetadata(m21stream,
+                    scoreTitle=scoreTitle,
+                    scoreComposer=scoreComposer,
+                    scoreTempo=scoreTempo,
+                    scoreInstruments=scoreInstruments,
+                    midiPrograms=False)
 
-    m21stream.write(format, wrtpath)
+    with stage('export'):
+        m21stream.write(format, wrtpath)
 
 
 if __name__ == '__main__':
     import sys
-    from .language.syntax import parse
+    from .pipeline import Pipeline
+    from .io.cache import ConversionCache
 
     if len(sys.argv) >= 2:
-        t = parse(sys.argv[1])
-        s = translateToMusic21(t)
-        if len(sys.argv) == 2:
-            writeStream(s)
-        if len(sys.argv) == 3:
-            writeStream(s, format=sys.argv[2])
+        fmt = sys.argv[2] if len(sys.argv) == 3 else 'midi'
+        Pipeline(sys.argv[1], keepTree=False).writeStream(fmt, outputPath(fmt), ConversionCache.fromEnvironment())
     else:
         print(
             "Usage:\n\t$ python translator.py [string] [format]\nOutput path is current working directory."
@@ -0,0 +1,245 @@
+"""
+Watch mode: converts Cavatina .rtf/.txt files again whenever their content
+changes. Bursts of change events are debounced per file, and conversions
+run on a pool of worker processes that keep music21 imported.
+
+Usage:
+    $ python -m cavatina.watch [options] path|directory ...
+
+File system events come from watchdog if it is installed, otherwise the
+watched paths are polled.
+"""
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .batch import findInputs, initWorker, convertFile, inputExtensions
+from .rtf2xml import fileext
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+def fileDigest(path):
+    """
+    Hash of the content of *path*, or None if it cannot be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+class Watcher(object):
+    """
+    Converts the input files of *paths* (see batch.findInputs) once on start
+    and then each time one of them changes.
+
+    delay: seconds without further events after which a burst of changes of
+           a file is converted
+    convert: function(job) -> result run in the workers, see batch.convertFile
+    onResult: called with the result of every conversion
+    poll: seconds between scans of the watched paths, or None to use watchdog
+          if available (and scan every second otherwise)
+    processes: processes each worker translates a file with (see
+               translator.translateToMusic21)
+    """
+
+    def __init__(self,
+                 paths,
+                 fmt='musicxml',
+                 outdir=None,
+                 jobs=1,
+                 backend='music21',
+                 delay=0.5,
+                 convert=convertFile,
+                 onResult=None,
+                 poll=None,
+                 processes=1):
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.fmt = fmt
+        self.outdir = outdir
+        self.jobs = jobs
+        self.backend = backend
+        self.delay = delay
+        self.convert = convert
+        self.onResult = onResult
+        self.poll = poll if poll or Observer else 1.0
+        self.processes = processes
+
+        self.condition = threading.Condition()
+        self.due = {}  # path : time after which its latest burst of changes is converted
+        self.running = set()  # paths being converted; changes meanwhile wait in *due*
+        self.digests = {}  # path : digest of the last converted content
+        self.stopped = False
+        self.executor = None
+        self.threads = []
+        self.observer = None
+
+    # -- events
+
+    def isInput(self, path):
+        if os.path.splitext(path)[1].lower() not in inputExtensions:
+            return False
+        return any(path == p or path.startswith(os.path.join(p, '')) for p in self.paths)
+
+    def notify(self, path):
+        """
+        Reports a change of *path*; restarts its debounce delay.
+        """
+        path = os.path.abspath(path)
+        if not self.isInput(path):
+            return
+        with self.condition:
+            self.due[path] = time.time() + self.delay
+            self.condition.notify_all()
+
+    # -- scheduling
+
+    def outputPath(self, path):
+        outdir = self.outdir or os.path.dirname(path)
+        return os.path.join(outdir, os.path.splitext(os.path.basename(path))[0] + fileext[self.fmt])
+
+    def schedule(self):
+        with self.condition:
+            while not self.stopped:
+                now = time.time()
+                for path, due in list(self.due.items()):
+                    if due <= now and path not in self.running:
+                        del self.due[path]
+                        self.submit(path)
+                waiting = [due - now for path, due in self.due.items() if path not in self.running]
+                self.condition.wait(max(min(waiting), 0) if waiting else None)
+
+    def submit(self, path):
+        digest = fileDigest(path)
+        if digest is None or digest == self.digests.get(path):
+            self.condition.notify_all()
+            return  # deleted, or saved without changes
+        self.digests[path] = digest
+        self.running.add(path)
+        future = self.executor.submit(self.convert,
+                                      (path, self.outputPath(path), self.fmt, self.backend, self.processes))
+        future.add_done_callback(lambda future: self.done(path, future))
+
+    def done(self, path, future):
+        try:
+            result = future.result()
+        except Exception as e:  # the worker process died
+            result = {'input': path, 'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+        with self.condition:
+            self.running.discard(path)
+            self.condition.notify_all()
+        if self.onResult:
+            self.onResult(result)
+
+    def waitIdle(self, timeout=None):
+        """
+        Waits until no conversion is pending or running. Returns False on timeout.
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.due or self.running:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    # -- sources
+
+    def scan(self):
+        known = {}  # path : (mtime, size)
+        while not self.stopped:
+            for path in findInputs(self.paths):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if known.get(path) != (st.st_mtime, st.st_size):
+                    if path in known:
+                        self.notify(path)
+                    known[path] = (st.st_mtime, st.st_size)
+            time.sleep(self.poll)
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(self.jobs, initializer=initWorker, initargs=(self.backend,))
+        threads = [self.schedule]
+        if self.poll:
+            threads.append(self.scan)
+        else:
+            self.observer = Observer()
+            handler = ChangeHandler(self)
+            for path in self.paths:
+                directory = path if os.path.isdir(path) else os.path.dirname(path)
+                self.observer.schedule(handler, directory, recursive=True)
+            self.observer.start()
+        for target in threads:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        for path in findInputs(self.paths):
+            self.notify(path)
+
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.executor.shutdown(wait=True)
+
+
+class ChangeHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        self.watcher.notify(getattr(event, 'dest_path', None) or event.src_path)
+
+
+def printResult(result):
+    if result['ok']:
+        print("{} {} -> {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), result['input'], result['output']))
+    else:
+        print("{} {}: {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), result['input'], result['error']))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m cavatina.watch',
+                                     description='Convert Cavatina .rtf/.txt files whenever they change.')
+    parser.add_argument('paths', nargs='+', help='input files or directories')
+    parser.add_argument('-f', '--format', default='musicxml', choices=['musicxml', 'midi'])
+    parser.add_argument('-o', '--outdir', help='output directory (default: next to each input)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='worker processes')
+    parser.add_argument('-b', '--backend', default='music21', choices=['music21', 'native'])
+    parser.add_argument('-d', '--delay', type=float, default=0.5, help='debounce delay in seconds')
+    parser.add_argument('-p', '--poll', type=float, help='poll every POLL seconds instead of using watchdog')
+    parser.add_argument('-P', '--processes', type=int, default=1,
+                        help='processes translating each file (0: one per CPU)')
+    args = parser.parse_args()
+
+    watcher = Watcher(args.paths, args.format, args.outdir, args.jobs, args.backend, args.delay,
+                      onResult=printResult, poll=args.poll, processes=args.processes or None)
+    watcher.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        watcher.stop()